@@ -0,0 +1,448 @@
+#!/usr/bin/env python2.7
+
+"""
+End-to-end throughput benchmark for obs_analyse.py, without MASS or the odb binaries.
+
+A fake MASS archive is filled with synthetic ODB2 files for one cycle of several suites, with one file per instrument
+whose size follows INSTRUMENT_ROWS (huge iasi/cris, tiny aod) times --scale. Stand-in 'moo' and 'odb' executables are
+put at the front of the PATH:
+    moo ls  lists the fake archive
+    moo get copies files out of it, taking --mass-latency seconds per request plus the time to move the bytes at
+            --mass-bandwidth MB/s
+    odb sql answers the flag and region query with odb2_reader.py, printing the output in the odb sql layout
+Each stand-in call appends a timing record to a log, so the time spent in each stage can be reported.
+
+obs_analyse.py is then run for each suite and cycle exactly as in the cylc suite (CYLC_TASK_CYCLE_POINT and SUITE_I
+set), with --batch-mode as one job for all of them, or with --concurrent-suites as one job for each cycle running all
+the suites at once (CONCURRENT_SUITE_IDS set), with its settings as they are in the file. The statistics it
+saves are checked against the synthetic data.
+
+Usage: python bench_obs_analyse.py --suites 4 --scale 0.01
+"""
+
+import numpy as np
+import os
+import sys
+import time
+import glob
+import shutil
+import argparse
+import subprocess
+import tempfile
+import datetime as dt
+
+import odb2_reader
+import grid_counts
+import cycle_stats_file
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+# rows (observations) in each instrument's file at --scale 1, roughly as in a real cycle
+INSTRUMENT_ROWS = {'iasi': 2000000, 'cris': 1500000, 'airs': 800000, 'atovs': 400000, 'atms': 300000,
+                   'satwind': 300000, 'ssmis': 250000, 'aircraft': 200000, 'scatwind': 150000, 'gpsro': 150000,
+                   'surface': 120000, 'sonde': 100000, 'amsr': 100000, 'seviriclr': 80000, 'abiclr': 80000,
+                   'ahiclr': 80000, 'saphir': 60000, 'gmihigh': 50000, 'gmilow': 50000, 'mwri': 50000,
+                   'mwsfy3': 40000, 'mwsfy3b': 40000, 'goesimclr': 40000, 'groundgps': 30000, 'aod': 2000}
+
+# bitfield members of the flag columns
+DATUM_STATUS_BITS = [('active', 1), ('passive', 1), ('rejected', 1), ('blacklisted', 1)]
+REPORT_FLAGS_BITS = [('surplus', 1), ('other', 3)]
+
+MODEL_RUN = 'glu'
+
+# ==============================================================================
+# Stand-in executables
+# ==============================================================================
+
+
+def log_timing(stage, start, **kwargs):
+    """
+    Append a timing record for a stand-in call to the log in $FAKE_TIMING_LOG: stage, start, end and key=value pairs
+    """
+
+    log_path = os.getenv('FAKE_TIMING_LOG')
+    if log_path is None:
+        return
+    fields = [stage, '%.6f' % start, '%.6f' % time.time()] + ['%s=%s' % (k, v) for k, v in sorted(kwargs.items())]
+    with open(log_path, 'a') as f:
+        f.write(' '.join(fields) + '\n')
+
+    return
+
+
+def moose_to_local(moosepath):
+    """
+    Path in the fake archive of a moose path, e.g. moose:/devfc/u-bo796/adhoc.file/x.gz => $FAKE_MASS_DIR/devfc/...
+    """
+
+    return os.getenv('FAKE_MASS_DIR') + '/' + moosepath.split('moose:/', 1)[1]
+
+
+def fake_moo(argv):
+    """
+    Stand-in for moo: 'moo ls [-l] [moose path, or glob]' and 'moo get [-f] [moose paths...] [destination directory]'
+    """
+
+    start = time.time()
+    command = argv[0]
+    args = [a for a in argv[1:] if not a.startswith('-')]
+
+    if command == 'ls':
+        mass_dir = os.getenv('FAKE_MASS_DIR')
+        local_path = moose_to_local(args[0])
+        # a directory lists its contents
+        paths = sorted(glob.glob(local_path + '/*' if os.path.isdir(local_path) else local_path))
+        if len(paths) == 0:
+            sys.stderr.write('moo ls: no files match ' + args[0] + '\n')
+            return 2
+        for path in paths:
+            moosepath = 'moose:/' + os.path.relpath(path, mass_dir)
+            if '-l' in argv:
+                sys.stdout.write('F fakeuser %d 2019-06-15 18:00:00 GMT %s\n' % (os.path.getsize(path), moosepath))
+            else:
+                sys.stdout.write(moosepath + '\n')
+        log_timing('ls', start, files=len(paths))
+
+    elif command == 'get':
+        sources, destdir = args[:-1], args[-1]
+        local_paths = [moose_to_local(s) for s in sources]
+        missing = [s for s, p in zip(sources, local_paths) if not os.path.exists(p)]
+        if len(missing) > 0:
+            sys.stderr.write('moo get: file(s) not found: ' + ' '.join(missing) + '\n')
+            return 2
+        n_bytes = sum([os.path.getsize(p) for p in local_paths])
+        # one request's latency, then each file is transferred in turn
+        time.sleep(float(os.getenv('FAKE_MASS_LATENCY', '0')))
+        for p in local_paths:
+            time.sleep(os.path.getsize(p) / (float(os.getenv('FAKE_MASS_BANDWIDTH', 'inf')) * 1024.0 ** 2))
+            shutil.copy(p, destdir)
+        log_timing('get', start, files=len(sources), bytes=n_bytes)
+
+    else:
+        sys.stderr.write('moo: command not supported by the stand-in: ' + command + '\n')
+        return 2
+
+    return 0
+
+
+def fake_odb(argv):
+    """
+    Stand-in for odb: 'odb sql [select statement] -i [filepath]', for the query made in obs_analyse.py
+    """
+
+    start = time.time()
+    if argv[0] != 'sql':
+        sys.stderr.write('odb: command not supported by the stand-in: ' + argv[0] + '\n')
+        return 2
+
+    statement = argv[1]
+    filepath = argv[argv.index('-i') + 1]
+
+    # select datum_status.active, ops_report_flags.surplus, [floor(lat/res), floor(lon/res), count(*),]
+    #   [region expressions...]
+    select_list = [s.strip() for s in statement.strip().split('select', 1)[1].split(',')]
+    grid_resolution = None
+    n_key_columns = 2
+    if select_list[2].startswith('floor('):
+        grid_resolution = float(select_list[2].split('/')[1].rstrip(')'))
+        n_key_columns = 5
+    region_names = [str(i) for i in range(len(select_list) - n_key_columns)]
+    region_bounds = dict(zip(region_names, select_list[n_key_columns:]))
+
+    out_array = odb2_reader.odb2_select_query(region_bounds, region_names, filepath, grid_resolution=grid_resolution)
+
+    sys.stdout.write('\t'.join(select_list) + '\n')
+    for row in out_array:
+        sys.stdout.write('\t'.join(['%11d' % v for v in row]) + '\n')
+    log_timing('sql', start, rows=out_array.shape[0])
+
+    return 0
+
+
+def install_stand_ins(bin_dir):
+    """
+    Write 'moo' and 'odb' executables into bin_dir, which call this script.
+    """
+
+    for name in ['moo', 'odb']:
+        path = bin_dir + '/' + name
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec ' + sys.executable + ' ' + os.path.abspath(__file__) + ' --fake-' + name +
+                    ' "$@"\n')
+        os.chmod(path, 0755)
+
+    return
+
+
+# ==============================================================================
+# Synthetic archive
+# ==============================================================================
+
+
+def write_instrument_file(filepath, n_rows, n_extra_columns, rng):
+    """
+    Write a synthetic ODB2 file for one instrument: lat, lon, the two flag bitfields and some extra real columns to
+    bring the file size up to something like a real one.
+    """
+
+    columns = [('lat@hdr', 'real', rng.uniform(-90.0, 90.0, n_rows)),
+               ('lon@hdr', 'real', rng.uniform(-180.0, 180.0, n_rows)),
+               ('datum_status@body', 'bitfield', rng.randint(0, 16, n_rows), DATUM_STATUS_BITS),
+               ('ops_report_flags@hdr', 'bitfield', rng.randint(0, 16, n_rows), REPORT_FLAGS_BITS)]
+    columns += [('extra_' + str(i) + '@body', 'real', rng.normal(size=n_rows)) for i in range(n_extra_columns)]
+
+    odb2_reader.write_odb2(filepath, columns)
+
+    return
+
+
+def build_fake_archive(mass_dir, payload_dir, suite_ids, cycle_strs, scale, n_extra_columns, seed=0):
+    """
+    Fill the fake archive with the cycles of files for each suite. Each instrument's file is generated once and
+    hard linked into every suite and cycle, as writing synthetic ODB2 is slow.
+    :return: expected: (dict) instrument => odb2_reader.odb2_select_query() output, to check the results against
+    """
+
+    rng = np.random.RandomState(seed)
+    expected = {}
+
+    for obs_i in sorted(INSTRUMENT_ROWS.keys()):
+        n_rows = max(int(INSTRUMENT_ROWS[obs_i] * scale), 1)
+        payload = payload_dir + '/' + obs_i + '_' + str(n_rows) + '_' + str(n_extra_columns) + '_odb2.gz'
+        if not os.path.exists(payload):
+            write_instrument_file(payload, n_rows, n_extra_columns, rng)
+        expected[obs_i] = odb2_reader.odb2_select_query(oa.region_bounds, oa.regions, payload)
+
+        for suite_id in suite_ids:
+            suite_dir = mass_dir + '/devfc/' + suite_id + '/adhoc.file'
+            if not os.path.exists(suite_dir):
+                os.system('mkdir -p ' + suite_dir)
+            for cycle_str in cycle_strs:
+                os.link(payload, suite_dir + '/' + cycle_str + '_' + MODEL_RUN + '_' + obs_i + '_odb2.gz')
+
+    return expected
+
+
+def check_suite_stats(stats_filepath, expected):
+    """
+    Check a suite's saved cycle statistics against the synthetic data.
+    :return: (bool) True if every instrument's flag and region counts are as expected
+    """
+
+    if not os.path.exists(stats_filepath):
+        return False
+    saved, _, _ = cycle_stats_file.read_cycle_stats(stats_filepath)
+
+    expected_stats = {flag_i: {region_i: {} for region_i in oa.regions + ['GLOBAL']} for flag_i in oa.flags}
+    for obs_i, out_array in expected.iteritems():
+        oa.extract_flag_data(expected_stats, out_array, oa.regions, obs_i)
+
+    for flag_i in oa.flags:
+        for region_i in oa.regions + ['GLOBAL']:
+            for obs_i in expected:
+                if saved[flag_i][region_i].get(obs_i) != expected_stats[flag_i][region_i][obs_i]:
+                    return False
+
+    return True
+
+
+def check_suite_grids(grid_filepath, expected):
+    """
+    Check that the regions worked out from a suite's saved grid counts (grid_counts.py) give the same counts as the
+    synthetic data. The synthetic positions are random, so none lie exactly on a region edge.
+    :return: (bool) True if every instrument's flag and region counts are as expected
+    """
+
+    if not os.path.exists(grid_filepath):
+        return False
+    grid = grid_counts.load_cycle_grid(grid_filepath)
+    derived = grid_counts.region_stats(grid, grid_counts.region_masks_from_bounds(oa.region_bounds,
+                                                                                  grid['resolution']))
+
+    expected_stats = {flag_i: {region_i: {} for region_i in oa.regions + ['GLOBAL']} for flag_i in oa.flags}
+    for obs_i, out_array in expected.iteritems():
+        oa.extract_flag_data(expected_stats, out_array, oa.regions, obs_i)
+
+    for flag_i in oa.flags:
+        for region_i in oa.regions + ['GLOBAL']:
+            for obs_i in expected:
+                if derived[flag_i][region_i].get(obs_i) != expected_stats[flag_i][region_i][obs_i]:
+                    return False
+
+    return True
+
+
+def read_timing_log(log_path):
+    """
+    Read the stand-in timing records
+    :return: list of (stage, start, end, {key: value}) tuples
+    """
+
+    records = []
+    if not os.path.exists(log_path):
+        return records
+    with open(log_path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            records += [(fields[0], float(fields[1]), float(fields[2]),
+                         {k: float(v) for k, v in [field.split('=') for field in fields[3:]]})]
+
+    return records
+
+
+def print_report(job_results, records, wall_time):
+    """
+    Print the per-job and per-stage timings, and the overall throughput.
+    """
+
+    print('\n%-26s %10s %8s %8s' % ('job', 'time [s]', 'files', 'correct'))
+    for name, elapsed, n_files, correct in job_results:
+        print('%-26s %10.2f %8d %8s' % (name, elapsed, n_files, correct))
+
+    # busy time is the summed duration of the calls, span is from the first call starting to the last finishing, so
+    #   busy / span shows how much the calls of a stage overlapped
+    print('\n%-6s %8s %8s %10s %12s %10s %10s' % ('stage', 'calls', 'files', 'MB', 'busy [s]', 'span [s]',
+                                                   'mean [s]'))
+    for stage in ['ls', 'get', 'sql']:
+        stage_records = [r for r in records if r[0] == stage]
+        if len(stage_records) == 0:
+            continue
+        busy = sum([end - start for _, start, end, _ in stage_records])
+        span = max([r[2] for r in stage_records]) - min([r[1] for r in stage_records])
+        n_files = sum([r[3].get('files', 1) for r in stage_records]) if stage == 'get' else len(stage_records)
+        mb = sum([r[3].get('bytes', 0) for r in stage_records]) / 1024.0 ** 2
+        print('%-6s %8d %8d %10.1f %12.2f %10.2f %10.3f' % (stage, len(stage_records), n_files, mb, busy, span,
+                                                            busy / len(stage_records)))
+
+    total_files = sum([r[2] for r in job_results])
+    total_mb = sum([r[3].get('bytes', 0) for r in records if r[0] == 'get']) / 1024.0 ** 2
+    print('\ntotal: %d files, %.1f MB in %.2f s = %.2f files/s, %.2f MB/s' % (total_files, total_mb, wall_time,
+                                                                            total_files / wall_time,
+                                                                            total_mb / wall_time))
+
+    return
+
+
+if __name__ == '__main__':
+
+    # called as one of the stand-in executables
+    if len(sys.argv) > 1 and sys.argv[1] in ['--fake-moo', '--fake-odb']:
+        if sys.argv[1] == '--fake-moo':
+            exit(fake_moo(sys.argv[2:]))
+        exit(fake_odb(sys.argv[2:]))
+
+    # not imported by the stand-ins, as obs_analyse.py prints when imported with the cylc environment set
+    import obs_analyse as oa
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', type=int, default=4, help='number of suites')
+    parser.add_argument('--cycle', default='20190615T1800Z', help='(first) cycle to run')
+    parser.add_argument('--cycles', type=int, default=1, help='number of 6 hourly cycles')
+    parser.add_argument('--batch-mode', action='store_true',
+                        help='run all the suites and cycles in one obs_analyse.py job (--start/--end), instead of one '
+                             'job per suite and cycle')
+    parser.add_argument('--concurrent-suites', action='store_true',
+                        help='run one obs_analyse.py job for each cycle, processing all the suites at once')
+    parser.add_argument('--scale', type=float, default=0.01, help='scale factor on INSTRUMENT_ROWS')
+    parser.add_argument('--extra-columns', type=int, default=20, help='extra columns in each file')
+    parser.add_argument('--mass-latency', type=float, default=0.0, help='seconds per moo request')
+    parser.add_argument('--mass-bandwidth', type=float, default=float('inf'), help='moo get MB/s')
+    parser.add_argument('--parallel-suites', type=int, default=1, help='jobs run at once (as cylc tasks)')
+    parser.add_argument('--workdir', default=None, help='working directory (default: a new temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp() if args.workdir is None else args.workdir
+    dirs = {d: workdir + '/' + d for d in ['bin', 'mass', 'payload', 'data', 'scratch', 'tmp']}
+    for d in dirs.itervalues():
+        if not os.path.exists(d):
+            os.system('mkdir -p ' + d)
+    timing_log = workdir + '/timing.log'
+    if os.path.exists(timing_log):
+        os.remove(timing_log)
+
+    suite_ids = ['u-bench' + str(i) for i in range(args.suites)]
+    first_cycle = dt.datetime.strptime(args.cycle, '%Y%m%dT%H%MZ')
+    cycle_strs = [(first_cycle + dt.timedelta(hours=6 * c)).strftime('%Y%m%dT%H%MZ') for c in range(args.cycles)]
+    if os.path.exists(dirs['mass'] + '/devfc'):
+        shutil.rmtree(dirs['mass'] + '/devfc')
+
+    print('building fake archive in ' + workdir + ' ...')
+    start = time.time()
+    expected = build_fake_archive(dirs['mass'], dirs['payload'], suite_ids, cycle_strs, args.scale,
+                                  args.extra_columns)
+    print('... done in %.1f s: %d files per suite cycle, %.1f MB per suite cycle' % (
+        time.time() - start, len(expected),
+        sum([os.path.getsize(p) for p in
+             glob.glob(dirs['mass'] + '/devfc/' + suite_ids[0] + '/adhoc.file/' + cycle_strs[0] + '*')]) / 1024.0 ** 2))
+
+    install_stand_ins(dirs['bin'])
+
+    env = dict(os.environ)
+    env.update({'PATH': dirs['bin'] + ':' + env.get('PATH', ''),
+                'DATADIR': dirs['data'],
+                'SCRATCH': dirs['scratch'],
+                'TMPDIR': dirs['tmp'],
+                'FAKE_MASS_DIR': dirs['mass'],
+                'FAKE_MASS_LATENCY': str(args.mass_latency),
+                'FAKE_MASS_BANDWIDTH': str(args.mass_bandwidth),
+                'FAKE_TIMING_LOG': timing_log})
+    obs_analyse_path = os.path.dirname(os.path.abspath(__file__)) + '/obs_analyse.py'
+
+    # jobs: one for each suite and cycle, as cylc runs them, one for each cycle in concurrent suites mode, or one for
+    #   everything in batch mode
+    jobs = []
+    if args.concurrent_suites:
+        for cycle_str in cycle_strs:
+            job_env = dict(env)
+            job_env.update({'CYLC_TASK_CYCLE_POINT': cycle_str, 'CONCURRENT_SUITE_IDS': ' '.join(suite_ids)})
+            jobs += [{'name': 'concurrent ' + cycle_str, 'command': [sys.executable, obs_analyse_path],
+                      'env': job_env, 'checks': [(s, cycle_str) for s in suite_ids]}]
+    elif args.batch_mode:
+        jobs += [{'name': 'batch', 'command': [sys.executable, obs_analyse_path, '--start', cycle_strs[0],
+                                               '--end', cycle_strs[-1], '--suites'] + suite_ids,
+                  'env': dict(env), 'checks': [(s, c) for s in suite_ids for c in cycle_strs]}]
+    else:
+        for cycle_str in cycle_strs:
+            for suite_id in suite_ids:
+                job_env = dict(env)
+                job_env.update({'CYLC_TASK_CYCLE_POINT': cycle_str, 'SUITE_I': suite_id})
+                jobs += [{'name': suite_id + ' ' + cycle_str, 'command': [sys.executable, obs_analyse_path],
+                          'env': job_env, 'checks': [(suite_id, cycle_str)]}]
+
+    # run the jobs, up to --parallel-suites at once
+    job_results = []
+    running = []
+    pending = list(jobs)
+    wall_start = time.time()
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < args.parallel_suites:
+            job = pending.pop(0)
+            with open(workdir + '/' + job['name'].replace(' ', '_') + '_stdout.txt', 'w') as stdout:
+                proc = subprocess.Popen(job['command'], env=job['env'], stdout=stdout, stderr=subprocess.STDOUT)
+            running += [(job, proc, time.time())]
+        time.sleep(0.05)
+        for job, proc, job_start in list(running):
+            if proc.poll() is not None:
+                running.remove((job, proc, job_start))
+                correct = proc.returncode == 0 and all(
+                    [check_suite_stats(dirs['data'] + '/R2O_projects/update_cutoff/data/cycle_sql_stats/' + suite_id +
+                                       '/' + cycle_str + '_' + suite_id + '_stats.npy', expected)
+                     for suite_id, cycle_str in job['checks']])
+                if oa.GRID_COUNTS:
+                    correct = correct and all(
+                        [check_suite_grids(grid_counts.cycle_grid_filepath(
+                            dirs['data'] + '/R2O_projects/update_cutoff/data/cycle_grid_counts/' + suite_id,
+                            suite_id, cycle_str), expected)
+                         for suite_id, cycle_str in job['checks']])
+                job_results += [(job['name'], time.time() - job_start, len(expected) * len(job['checks']), correct)]
+    wall_time = time.time() - wall_start
+
+    print_report(sorted(job_results), read_timing_log(timing_log), wall_time)
+
+    if not args.keep and args.workdir is None:
+        shutil.rmtree(workdir)
+
+    exit(0)
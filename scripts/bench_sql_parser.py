@@ -0,0 +1,203 @@
+#!/usr/bin/env python2.7
+
+"""
+Benchmark the streaming odb sql output parser in obs_analyse.py against the previous path, which buffered the whole
+output with subprocess.check_output and converted a list of split strings to a float16 array, and against the
+bounded-memory aggregation (aggregate_ODB2_sql_output), which sums the rows into their flag groups as they stream in.
+
+Synthetic odb sql output (a header line, then tab separated rows with leading spaces, as odb prints them) is written
+to a file and piped through cat, so the parsers read from a subprocess as they would from odb. Each parser is run
+in its own process, so the peak memory reported is its own. Results are exact if the sums of each flag group match.
+
+With --memory-check, the output is made several times larger than --budget-mb, and the check fails (exit code 1)
+unless the bounded-memory aggregation is exact and its memory use (how far the peak RSS rises above the RSS before it
+starts) stays within the budget.
+
+Usage: python bench_sql_parser.py --rows 5000000
+       python bench_sql_parser.py --memory-check --budget-mb 32
+"""
+
+import numpy as np
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+
+import obs_analyse as oa
+import odb2_reader
+
+
+def write_synthetic_sql_output(filepath, n_rows, n_cols, seed=0):
+    """
+    Write synthetic odb sql output, with counts large enough to lose precision as float16.
+    :param filepath: output filepath
+    :param n_rows: number of rows
+    :param n_cols: number of columns (2 flag columns, then the region counts)
+    :keyword seed: random seed
+    :return: values: (numpy array, dtype=int64) the values written
+    """
+
+    rng = np.random.RandomState(seed)
+    values = np.empty((n_rows, n_cols), dtype=np.int64)
+    values[:, :2] = rng.randint(0, 2, size=(n_rows, 2))
+    values[:, 2:] = rng.randint(0, 5000000, size=(n_rows, n_cols - 2))
+
+    with open(filepath, 'w') as f:
+        f.write('\t'.join(['datum_status.active', 'ops_report_flags.surplus'] + oa.regions[:n_cols - 2]) + '\n')
+        # write in blocks to keep the memory down for large files
+        for start in range(0, n_rows, 1000000):
+            block = values[start:start + 1000000]
+            np.savetxt(f, block, fmt='%11d', delimiter='\t')
+
+    return values
+
+
+def legacy_parse(filepath):
+    """
+    The previous parser: buffer the whole output, split it into strings and convert to float16.
+    """
+
+    out = subprocess.check_output('cat ' + filepath, shell=True)
+    out_split = out.split('\n')[1:-1]
+    out_array = np.array([n.replace(' ', '').split('\t') for n in out_split], dtype=np.float16)
+
+    return out_array
+
+
+def stream_parse(filepath, n_cols, budget_mb=None):
+    """
+    The streaming parser, or the bounded-memory aggregation if budget_mb is given, reading from a pipe in the same
+    way as sql_ODB2_select_query.
+    """
+
+    proc = subprocess.Popen('cat ' + filepath, shell=True, stdout=subprocess.PIPE)
+    try:
+        if budget_mb is None:
+            out_array = oa.parse_ODB2_sql_output(proc.stdout, n_cols)
+        else:
+            out_array = oa.aggregate_ODB2_sql_output(proc.stdout, n_cols, 2, budget_mb=budget_mb)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    return out_array
+
+
+def flag_group_sums(values):
+    """
+    Sums of the region columns for each (active, surplus) group, flattened, to compare the parsers' outputs
+    """
+
+    values = values.astype(np.float64)
+    keys, sums = odb2_reader.sum_groups(values[:, :2], values[:, 2:])
+
+    return np.column_stack([keys, sums]).ravel()
+
+
+def proc_status_mb(field):
+    """
+    A memory field of this process from /proc/self/status [MB], e.g. 'VmRSS' (now) or 'VmHWM' (peak)
+    """
+
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.0
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS (VmHWM) to the current RSS (linux 4.0+), so the peak left over from the imports does not hide
+    the peak of the parser
+    """
+
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+    return
+
+
+def run_one(method, filepath, n_cols, budget_mb):
+    """
+    Run a single parser and print its wall time, peak RSS, how far the peak RSS rose above the RSS when it started,
+    and the sums of each flag group (run in a child process).
+    """
+
+    reset_peak_rss()
+    start_rss_mb = proc_status_mb('VmRSS')
+    start = time.time()
+    if method == 'legacy':
+        out_array = legacy_parse(filepath)
+    elif method == 'bounded':
+        out_array = stream_parse(filepath, n_cols, budget_mb=budget_mb)
+    else:
+        out_array = stream_parse(filepath, n_cols)
+    elapsed = time.time() - start
+    end_rss_mb = proc_status_mb('VmHWM')
+
+    group_sums = flag_group_sums(out_array)
+    print('%f %f %f %s' % (elapsed, end_rss_mb, end_rss_mb - start_rss_mb, ' '.join(['%.0f' % i for i in group_sums])))
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000000, help='number of rows of synthetic output')
+    parser.add_argument('--cols', type=int, default=len(oa.regions) + 2, help='number of columns')
+    parser.add_argument('--methods', nargs='+', default=['bounded', 'stream', 'legacy'],
+                        choices=['bounded', 'stream', 'legacy'])
+    parser.add_argument('--budget-mb', type=float, default=oa.QUERY_MEMORY_BUDGET_MB,
+                        help='memory budget of the bounded-memory aggregation [MB]')
+    parser.add_argument('--memory-check', action='store_true',
+                        help='check the bounded-memory aggregation keeps to --budget-mb on output several times '
+                             'larger than it (sets --rows, unless given, and --methods bounded stream)')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--filepath', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(args.run_one, args.filepath, args.cols, args.budget_mb)
+        exit(0)
+
+    if args.memory_check:
+        # each row is written as 12 characters per column: make the output 5 times the budget
+        if '--rows' not in sys.argv:
+            args.rows = int(5 * args.budget_mb * 1024 ** 2 / (12 * args.cols))
+        args.methods = ['bounded', 'stream']
+
+    tmpdir = tempfile.mkdtemp()
+    filepath = tmpdir + '/sql_output.txt'
+    print('writing ' + str(args.rows) + ' rows of synthetic odb sql output...')
+    values = write_synthetic_sql_output(filepath, args.rows, args.cols)
+    true_sums = flag_group_sums(values)
+    file_size_mb = os.path.getsize(filepath) / 1024.0 ** 2
+    print('file size: %.1f MB, memory budget: %.1f MB' % (file_size_mb, args.budget_mb))
+    del values
+
+    print('%-8s %10s %14s %14s %10s' % ('method', 'time [s]', 'peak RSS [MB]', 'RSS growth [MB]', 'exact'))
+    results = {}
+    for method in args.methods:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-one', method,
+                                       '--filepath', filepath, '--cols', str(args.cols),
+                                       '--budget-mb', str(args.budget_mb)])
+        # ignore anything obs_analyse printed on import
+        elapsed, peak_rss, rss_growth, group_sums = out.strip().split('\n')[-1].split(' ', 3)
+        exact = np.array_equal(np.array(group_sums.split(), dtype=np.float64), true_sums)
+        results[method] = (float(rss_growth), exact)
+        print('%-8s %10.2f %14.1f %14.1f %10s' % (method, float(elapsed), float(peak_rss), float(rss_growth), exact))
+
+    os.remove(filepath)
+    os.rmdir(tmpdir)
+
+    if args.memory_check:
+        rss_growth, exact = results['bounded']
+        passed = exact and rss_growth <= args.budget_mb and file_size_mb >= 4 * args.budget_mb
+        print('memory check %s: bounded aggregation of %.1f MB of output used %.1f MB of a %.1f MB budget, exact: %s'
+              % ('passed' if passed else 'FAILED', file_size_mb, rss_growth, args.budget_mb, exact))
+        exit(0 if passed else 1)
+
+    exit(0)
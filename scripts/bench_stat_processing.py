@@ -0,0 +1,261 @@
+#!/usr/bin/env python2.7
+
+"""
+Benchmark odb2_stat_processing.py on a synthetic trial, to see how each phase scales with the number of suites,
+cycles and obs types.
+
+For each trial size, a trial's worth of cycle statistics files is generated, in the same layout and with the same
+suite_cycle_stats / suite_cycle_meta schema as obs_analyse.py saves (the fixed-schema format of cycle_stats_file.py, or
+with --legacy-files the old np.save()d dictionaries, to compare loading the two). odb2_stat_processing.py is then pointed at them
+(its SUITE_LIST, DATE_RANGE, OBS_LIST etc. are replaced) and each phase is timed on its own:
+    load (packing the trial cube, then memory-mapping it again), the summary statistics, the bootstrap confidence
+    intervals against the control, the region summary, each plot function and the tables.
+Each trial size runs in its own process, so the peak memory reported is its own.
+
+Sizes are given as [suites]x[days], e.g. the update trial is about 5x92 and a large future trial 20x730.
+
+Usage: python bench_stat_processing.py --sizes 5x92 10x365 20x730 --obs 25
+"""
+
+import numpy as np
+import os
+import sys
+import time
+import shutil
+import resource
+import argparse
+import subprocess
+import tempfile
+import datetime as dt
+
+import trial_cube as tc
+import cycle_stats_file
+from bench_obs_analyse import INSTRUMENT_ROWS
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+FLAG_LIST = ['active', 'rejected', 'thinned', 'thinned_but_active']
+REGIONS = ['SH', 'NH', 'TR', 'AUS', 'EUR']
+
+# fraction of an instrument's obs in each flag and region
+FLAG_FRACTIONS = {'active': 0.3, 'rejected': 0.2, 'thinned': 0.5, 'thinned_but_active': 0.05}
+REGION_FRACTIONS = {'SH': 0.45, 'NH': 0.55, 'TR': 0.35, 'AUS': 0.05, 'EUR': 0.06}
+
+# chance of an obs type being missing from a cycle (a bad or missing file), and of a whole cycle file being missing
+MISSING_OBS_CHANCE = 0.01
+MISSING_CYCLE_CHANCE = 0.005
+
+CYCLE_HOURS = 6
+START_DATE = dt.datetime(2019, 6, 15, 6, 0, 0)
+
+PHASES = ['load (pack cube)', 'load (memmap cube)', 'cube_to_suite_data', 'cycle_summary_arrays',
+          'create_cycle_summary_stats', 'control_ratio_ci', 'create_region_summary', 'plot_total_mean_obs',
+          'plot_mean_obs_by_type_stacked_line', 'plot_mean_obs_by_type_bar', 'plot_mean_obs_by_type_bar_regions',
+          'save_table_mean_obs_csv', 'save_table_ratio_ci_csv']
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def synthetic_trial(n_suites, n_days, n_obs):
+    """
+    Suites, cycles and obs types of a synthetic trial. The real obs types are used first, then made up ones.
+    :return: suite_list, suite_dict (update lengths and colours, as odb2_stat_processing.SUITE_DICT), date_range,
+        obs_list
+    """
+
+    suite_list = ['u-syn%03d' % s for s in range(n_suites)]
+    suite_dict = {suite_id: {'time_length': 3.0 + 4.25 * s / max(n_suites - 1, 1), 'colour': 'C' + str(s % 10)}
+                  for s, suite_id in enumerate(suite_list)}
+    date_range = [START_DATE + dt.timedelta(hours=CYCLE_HOURS * c) for c in range(n_days * 24 / CYCLE_HOURS)]
+    obs_list = sorted(INSTRUMENT_ROWS.keys())[:n_obs] + ['synth' + str(o) for o in range(n_obs - len(INSTRUMENT_ROWS))]
+
+    return suite_list, suite_dict, date_range, obs_list
+
+
+def write_synthetic_cycle_files(data_dir, suite_list, suite_dict, date_range, obs_list, seed=0, legacy=False):
+    """
+    Write a cycle statistics file for each suite and cycle, as obs_analyse.py saves them. Longer update cut offs get
+    more obs. A few obs types and whole cycles are left out at random, as for bad or missing files.
+    :keyword legacy: write the old np.save()d dictionaries instead of the fixed-schema format
+    :return: number of files written
+    """
+
+    rng = np.random.RandomState(seed)
+    baseline = {obs: INSTRUMENT_ROWS.get(obs, 50000) for obs in obs_list}
+    n_files = 0
+
+    for suite_id in suite_list:
+        suite_dir = data_dir + '/' + suite_id
+        if not os.path.exists(suite_dir):
+            os.system('mkdir -p ' + suite_dir)
+        suite_factor = 0.85 + 0.03 * suite_dict[suite_id]['time_length']
+
+        for date_i in date_range:
+            if rng.uniform() < MISSING_CYCLE_CHANCE:
+                continue
+            present = [obs for obs in obs_list if rng.uniform() >= MISSING_OBS_CHANCE]
+            obs_total = {obs: baseline[obs] * suite_factor * rng.lognormal(0.0, 0.1) for obs in present}
+
+            suite_cycle_stats = {flag_i: {region_i: {} for region_i in REGIONS + ['GLOBAL']} for flag_i in FLAG_LIST}
+            for flag_i in FLAG_LIST:
+                for region_i in REGIONS:
+                    for obs in present:
+                        suite_cycle_stats[flag_i][region_i][obs] = \
+                            int(obs_total[obs] * FLAG_FRACTIONS[flag_i] * REGION_FRACTIONS[region_i])
+                for obs in present:
+                    suite_cycle_stats[flag_i]['GLOBAL'][obs] = \
+                        suite_cycle_stats[flag_i]['SH'][obs] + suite_cycle_stats[flag_i]['NH'][obs]
+                for region_i, region_i_data in suite_cycle_stats[flag_i].iteritems():
+                    region_i_data['all_obs'] = np.sum([region_i_data[obs_j] for obs_j in region_i_data.iterkeys()])
+
+            suite_cycle_meta = {'number_obs_files_on_mass': len(obs_list),
+                                'number_obs_used_in_stats': len(present),
+                                'all_obs_files_ok': len(present) == len(obs_list)}
+            cycle_str = date_i.strftime(tc.CYCLE_FMT)
+            filepath = tc.cycle_stats_filepath(data_dir, suite_id, date_i)
+            if legacy:
+                np.save(filepath, {'suite_cycle_stats': suite_cycle_stats, 'suite_cycle_meta': suite_cycle_meta,
+                                   'cycle': cycle_str})
+            else:
+                cycle_stats_file.save_cycle_stats(filepath, suite_cycle_stats, suite_cycle_meta, cycle_str,
+                                                  flags=FLAG_LIST, regions=REGIONS + ['GLOBAL'])
+            n_files += 1
+
+    return n_files
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far [MB] (ru_maxrss is in kB on linux)
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_one(workdir, n_suites, n_days, n_obs, plots, num_workers, legacy=False):
+    """
+    Generate one trial size and time each phase of odb2_stat_processing.py on it (run in a child process). Prints a
+    line for each phase: phase name, time [s], peak RSS so far [MB]
+    """
+
+    data_dir = workdir + '/data/cycle_sql_stats'
+    cube_dir = workdir + '/data/trial_cube'
+    savedir = workdir + '/figures'
+    for d in [data_dir, savedir]:
+        if not os.path.exists(d):
+            os.system('mkdir -p ' + d)
+
+    suite_list, suite_dict, date_range, obs_list = synthetic_trial(n_suites, n_days, n_obs)
+    start = time.time()
+    n_files = write_synthetic_cycle_files(data_dir, suite_list, suite_dict, date_range, obs_list, legacy=legacy)
+    print('generated %d files in %.1f s' % (n_files, time.time() - start))
+
+    # odb2_stat_processing.py works out its directories from DATADIR when imported
+    os.environ['DATADIR'] = workdir
+    import odb2_stat_processing as osp
+
+    # point odb2_stat_processing.py at the synthetic trial
+    osp.SUITE_LIST = suite_list
+    osp.SUITE_DICT = suite_dict
+    osp.CONTROL_SUITE = suite_list[len(suite_list) / 2]
+    osp.UPDATE_TIME_LIST = [suite_dict[suite_id]['time_length'] for suite_id in suite_list]
+    osp.DATE_RANGE = date_range
+    osp.OBS_LIST = obs_list
+    osp.SAVEDIR = savedir
+    osp.RENDER_WORKERS = num_workers
+
+    def timed(phase, func, *args, **kwargs):
+        phase_start = time.time()
+        out = func(*args, **kwargs)
+        print('phase %s|%f|%f' % (phase, time.time() - phase_start, peak_rss_mb()))
+        return out
+
+    timed('load (pack cube)', tc.get_trial_cube, cube_dir, data_dir, suite_list, date_range, FLAG_LIST,
+          osp.REGION_LIST, obs_list, rebuild=True, num_workers=num_workers)
+    cube, meta_cube, index = timed('load (memmap cube)', tc.get_trial_cube, cube_dir, data_dir, suite_list,
+                                   date_range, FLAG_LIST, osp.REGION_LIST, obs_list)
+    timed('cube_to_suite_data', tc.cube_to_suite_data, cube, meta_cube, index)
+    summary_arrays = timed('cycle_summary_arrays', osp.cycle_summary_arrays, cube)
+    timed('create_cycle_summary_stats', osp.create_cycle_summary_stats, summary_arrays)
+    ratio_ci = timed('control_ratio_ci', osp.control_ratio_ci, cube)
+    region_summary = timed('create_region_summary', osp.create_region_summary, summary_arrays, ratio_ci=ratio_ci)
+
+    if plots:
+        for phase in ['plot_total_mean_obs', 'plot_mean_obs_by_type_stacked_line', 'plot_mean_obs_by_type_bar',
+                      'plot_mean_obs_by_type_bar_regions']:
+            timed(phase, getattr(osp, phase), region_summary)
+    timed('save_table_mean_obs_csv', osp.save_table_mean_obs_csv, region_summary)
+    timed('save_table_ratio_ci_csv', osp.save_table_ratio_ci_csv, region_summary)
+
+    return
+
+
+def print_report(results):
+    """
+    Print the time [s] of each phase (rows) for each trial size (columns), then the peak memory of each size.
+    """
+
+    sizes = [size for size, _ in results]
+    print('\n%-36s' % 'phase [s]' + ''.join(['%12s' % size for size in sizes]))
+    for phase in PHASES:
+        row = ['%12.2f' % phases[phase][0] if phase in phases else '%12s' % '-' for _, phases in results]
+        print('%-36s' % phase + ''.join(row))
+    total = ['%12.2f' % sum([t for t, _ in phases.itervalues()]) for _, phases in results]
+    print('%-36s' % 'total' + ''.join(total))
+    peak = ['%12.0f' % max([rss for _, rss in phases.itervalues()] + [0]) for _, phases in results]
+    print('%-36s' % 'peak RSS [MB]' + ''.join(peak))
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['5x92', '10x365', '20x730'], help='[suites]x[days] to run')
+    parser.add_argument('--obs', type=int, default=25, help='number of obs types')
+    parser.add_argument('--no-plots', action='store_true', help='skip the plot functions')
+    parser.add_argument('--workers', type=int, default=4, help='processes for loading and rendering')
+    parser.add_argument('--workdir', default=None, help='working directory (default: a new temporary directory)')
+    parser.add_argument('--legacy-files', action='store_true',
+                        help='write the cycle files as the old np.save()d dictionaries')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        n_suites, n_days = [int(i) for i in args.run_one.split('x')]
+        run_one(args.workdir, n_suites, n_days, args.obs, not args.no_plots, args.workers, legacy=args.legacy_files)
+        exit(0)
+
+    workdir = tempfile.mkdtemp() if args.workdir is None else args.workdir
+
+    results = []
+    for size in args.sizes:
+        print('running ' + size + ' (suites x days) with ' + str(args.obs) + ' obs types...')
+        size_dir = workdir + '/' + size
+        command = [sys.executable, os.path.abspath(__file__), '--run-one', size, '--workdir', size_dir,
+                   '--obs', str(args.obs), '--workers', str(args.workers)]
+        if args.no_plots:
+            command += ['--no-plots']
+        if args.legacy_files:
+            command += ['--legacy-files']
+        out = subprocess.check_output(command)
+        phases = {}
+        for line in out.split('\n'):
+            if line.startswith('phase '):
+                phase, elapsed, rss = line[len('phase '):].split('|')
+                phases[phase] = (float(elapsed), float(rss))
+            elif line.startswith('generated'):
+                print('... ' + line)
+        results += [(size, phases)]
+        shutil.rmtree(size_dir)
+
+    print_report(results)
+
+    if args.workdir is None:
+        shutil.rmtree(workdir)
+
+    exit(0)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python2.7
+
+"""
+Paired block bootstrap confidence intervals for the trial: how much more (or less) data each suite gets than the
+control suite, allowing for the cycle to cycle sampling uncertainty.
+
+The statistic is the one plotted by odb2_stat_processing.py: for each suite, flag and region, the mean number of obs
+over the cycles of each obs type, summed over all the obs types (the total) and over the obs types in each category,
+divided by the same for the control suite.
+
+Cycles are resampled in blocks of consecutive cycles (circular moving blocks), so the correlation between
+neighbouring cycles (e.g. through the day) is kept within each block. The resampling is paired: every suite uses the
+same resampled cycles as the control in each replicate, so cycles that are poor for all the suites alike do not widen
+the intervals.
+
+Each replicate is a vector of weights, the number of times each cycle was drawn, so the mean of every obs type in
+every suite, flag and region for a whole batch of replicates is one matrix product of the weights with the cube.
+"""
+
+import numpy as np
+import warnings
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def block_weights(n_cycles, n_replicates, block_length, rng):
+    """
+    Circular moving block bootstrap weights: for each replicate, the number of times each cycle is drawn
+    :param n_cycles: number of cycles
+    :param n_replicates: number of replicates
+    :param block_length: number of consecutive cycles in each block
+    :param rng: numpy RandomState
+    :return: weights: (array) [replicate, cycle], each row sums to n_cycles
+    """
+
+    block_length = max(1, min(block_length, n_cycles))
+    n_blocks = int(np.ceil(n_cycles / float(block_length)))
+
+    starts = rng.randint(0, n_cycles, size=(n_replicates, n_blocks))
+    drawn = (starts[:, :, None] + np.arange(block_length)[None, None, :]) % n_cycles
+    drawn = drawn.reshape(n_replicates, -1)[:, :n_cycles]
+
+    rows = np.repeat(np.arange(n_replicates), n_cycles)
+    weights = np.bincount(rows * n_cycles + drawn.ravel(), minlength=n_replicates * n_cycles)
+
+    return weights.reshape(n_replicates, n_cycles).astype(np.float64)
+
+
+def prepare_suite(suite_cube):
+    """
+    Arrange one suite's part of the cube for replicate_sums()
+    :param suite_cube: (array) [cycle, flag, region, obs], NaN where missing
+    :return: (dict) the shape, the values with NaNs as 0, and the distinct patterns of present cycles over the columns
+        with the column to pattern mapping (an obs type missing from a cycle is missing in every flag and region, so
+        there are few patterns)
+    """
+
+    values = np.asarray(suite_cube, dtype=np.float64).reshape(suite_cube.shape[0], -1)
+    present = ~np.isnan(values)
+
+    patterns, pattern_index = np.unique(present.T, axis=0, return_inverse=True)
+
+    return {'shape': suite_cube.shape[1:],
+            'values': np.where(present, values, 0.0),
+            'patterns': patterns.T.astype(np.float64),
+            'pattern_index': pattern_index}
+
+
+def replicate_sums(prepared, weights, cat_matrix):
+    """
+    Mean of each obs type over the resampled cycles of each replicate, summed over all the obs types and over the obs
+    types in each category. Obs types with no cycles present count as 0, as np.nansum of the means would.
+    :param prepared: from prepare_suite()
+    :param weights: (array) [replicate, cycle], from block_weights()
+    :param cat_matrix: (array) [category, obs] category membership, 1.0 or 0.0
+    :return: sums: (array) [replicate, flag, region, 1 + category], the total first
+    """
+
+    totals = np.dot(weights, prepared['values'])
+    counts = np.dot(weights, prepared['patterns'])[:, prepared['pattern_index']]
+
+    mean = np.zeros(totals.shape)
+    np.divide(totals, counts, out=mean, where=counts > 0)
+    mean = mean.reshape((weights.shape[0],) + tuple(prepared['shape']))
+
+    return np.concatenate((mean.sum(axis=-1)[..., None], np.dot(mean, cat_matrix.T)), axis=-1)
+
+
+def paired_block_bootstrap(cube, control_index, cat_matrix, n_replicates=2000, block_length=4, confidence=0.95,
+                           seed=0, batch_size=250):
+    """
+    Paired block bootstrap confidence intervals of each suite's summed mean obs, relative to the control suite
+    :param cube: (array) trial cube [suite, cycle, flag, region, obs] (see trial_cube.py)
+    :param control_index: index of the control suite in the suite axis
+    :param cat_matrix: (array) [category, obs] category membership, 1.0 or 0.0
+    :keyword n_replicates: number of bootstrap replicates
+    :keyword block_length: number of consecutive cycles in each resampled block
+    :keyword confidence: confidence level of the intervals, e.g. 0.95
+    :keyword seed: random seed, so the intervals are repeatable
+    :keyword batch_size: replicates computed at once (bounds the memory used)
+    :return: (dict) arrays [suite, flag, region, 1 + category] (the total first, then each category):
+        'ratio': the ratio to the control from all the cycles
+        'low', 'high': the confidence interval of the ratio (percentile method)
+        'prob_above': fraction of replicates with a ratio above 1
+        NaN where the control has no obs
+    """
+
+    n_suites, n_cycles = cube.shape[:2]
+    batches = [(start, min(start + batch_size, n_replicates)) for start in range(0, n_replicates, batch_size)]
+
+    # the same weights for every suite in each batch: the replicates are paired with the control
+    def batch_weights(b):
+        start, end = batches[b]
+        return block_weights(n_cycles, end - start, block_length, np.random.RandomState([seed, b]))
+
+    every_cycle = np.ones((1, n_cycles))
+
+    control = prepare_suite(cube[control_index])
+    control_point = replicate_sums(control, every_cycle, cat_matrix)[0]
+    control_reps = np.concatenate([replicate_sums(control, batch_weights(b), cat_matrix)
+                                   for b in range(len(batches))], axis=0)
+    del control
+
+    shape = (n_suites,) + control_point.shape
+    ci = {'ratio': np.full(shape, np.nan), 'low': np.full(shape, np.nan), 'high': np.full(shape, np.nan),
+          'prob_above': np.full(shape, np.nan)}
+    ratios = np.empty((n_replicates,) + control_point.shape)
+    tail = 100.0 * (1.0 - confidence) / 2.0
+
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        for s in range(n_suites):
+            prepared = prepare_suite(cube[s])
+            ci['ratio'][s] = replicate_sums(prepared, every_cycle, cat_matrix)[0] / control_point
+            for b, (start, end) in enumerate(batches):
+                ratios[start:end] = replicate_sums(prepared, batch_weights(b), cat_matrix) / control_reps[start:end]
+
+            ci['low'][s], ci['high'][s] = np.percentile(ratios, [tail, 100.0 - tail], axis=0)
+            ci['prob_above'][s] = np.mean(ratios > 1.0, axis=0)
+
+        no_control = ~(control_point > 0)
+        for key in ci:
+            ci[key][:, no_control] = np.nan
+
+    return ci
@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+
+"""
+Checkpoints for obs_analyse.py, so that a cycle task that dies partway through (e.g. on the memory limit or a MASS
+time out) only has to process the instruments it had not finished when it is retried.
+
+As each instrument's file is queried, its entries in suite_cycle_stats (suite_cycle_stats[flag][region][obs]) are
+written to a small json file in the cycle's checkpoint directory. A retry of the cycle loads them back and skips those
+instruments. Bad files are not checkpointed, so they are tried again.
+
+Once a cycle's statistics are saved, the cycle is added to the suite's completion manifest and its checkpoints are
+removed. Cycles in the manifest are skipped, unless the statistics are to be overwritten.
+"""
+
+import os
+import glob
+import json
+import fcntl
+import shutil
+import numpy as np
+import datetime as dt
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+CHECKPOINT_DIR = os.getenv('DATADIR', os.getenv('HOME', '/tmp')) + '/R2O_projects/update_cutoff/data/cycle_checkpoints'
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def cycle_checkpoint_dir(suite_checkpoint_dir, cycle_str):
+    """
+    Checkpoint directory of a cycle
+    """
+
+    return suite_checkpoint_dir + '/' + cycle_str
+
+
+def manifest_filepath(suite_checkpoint_dir, suite_id):
+    """
+    Completion manifest filepath of a suite
+    """
+
+    return suite_checkpoint_dir + '/' + suite_id + '_complete_cycles.json'
+
+
+def save_instrument(checkpoint_dir, obs_i, suite_cycle_stats):
+    """
+    Checkpoint one instrument's entries of suite_cycle_stats. Written to a temporary file and renamed, so a checkpoint
+    is always complete.
+    :param checkpoint_dir: the cycle's checkpoint directory
+    :param obs_i: observation name, e.g. 'iasi'
+    :param suite_cycle_stats: suite_cycle_stats[flag][region][obs] = value, with obs_i filled in
+    :return:
+    """
+
+    entries = {flag_i: {region_i: float(obs_data[obs_i]) for region_i, obs_data in region_data.iteritems()
+                        if obs_i in obs_data}
+               for flag_i, region_data in suite_cycle_stats.iteritems()}
+
+    if not os.path.exists(checkpoint_dir):
+        os.system('mkdir -p ' + checkpoint_dir)
+    filepath = checkpoint_dir + '/' + obs_i + '.json'
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump(entries, f)
+    os.rename(filepath + '.tmp', filepath)
+
+    return
+
+
+def load_instruments(checkpoint_dir, obs_list):
+    """
+    Load the checkpointed instruments of a cycle
+    :param checkpoint_dir: the cycle's checkpoint directory
+    :param obs_list: the cycle's observation names. Checkpoints of any others are ignored.
+    :return: done: (dict) done[obs][flag][region] = value
+    """
+
+    done = {}
+    for filepath in glob.glob(checkpoint_dir + '/*.json'):
+        obs_i = os.path.basename(filepath)[:-len('.json')]
+        if obs_i not in obs_list:
+            continue
+        with open(filepath, 'r') as f:
+            done[obs_i] = json.load(f)
+
+    return done
+
+
+def restore_instruments(suite_cycle_stats, done):
+    """
+    Put checkpointed instruments back into suite_cycle_stats, as the float64 values the queries give
+    :param done: (dict) from load_instruments()
+    :return:
+    """
+
+    for obs_i, entries in done.iteritems():
+        for flag_i, region_data in entries.iteritems():
+            for region_i, value in region_data.iteritems():
+                suite_cycle_stats[str(flag_i)][str(region_i)][obs_i] = np.float64(value)
+
+    return
+
+
+def clear_checkpoints(checkpoint_dir):
+    """
+    Remove a cycle's checkpoints, once its statistics are saved
+    """
+
+    if os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+    return
+
+
+def _load_manifest(filepath):
+    """
+    Load a completion manifest: manifest[cycle] = info, or an empty one if there is none yet
+    """
+
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def is_complete(filepath, cycle_str):
+    """
+    Is the cycle in the suite's completion manifest?
+    """
+
+    return cycle_str in _load_manifest(filepath)
+
+
+def mark_complete(filepath, cycle_str, info):
+    """
+    Add a cycle to the suite's completion manifest. The manifest is updated under a lock, as cycles of a suite can
+    finish at the same time, and written to a temporary file and renamed.
+    :param filepath: completion manifest filepath
+    :param cycle_str: cycle e.g. '20190615T0600Z'
+    :param info: (dict) anything to record with the cycle, e.g. the stats file and number of files used
+    :return:
+    """
+
+    directory = os.path.dirname(filepath)
+    if not os.path.exists(directory):
+        os.system('mkdir -p ' + directory)
+
+    with open(filepath + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = _load_manifest(filepath)
+            manifest[cycle_str] = dict(info, completed=dt.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
+            with open(filepath + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.rename(filepath + '.tmp', filepath)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return
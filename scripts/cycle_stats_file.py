@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+
+"""
+The cycle statistics file saved by obs_analyse.py for each suite and cycle ([cycle]_[suite]_stats.npy).
+
+Files used to be np.save()d python dictionaries ({'suite_cycle_stats', 'suite_cycle_meta', 'cycle'}), which need
+allow_pickle=True and a full unpickle to read. They are now a fixed-schema .npy file holding one record of a
+structured array, with the fields:
+    format_version                  (int32) FORMAT_VERSION
+    cycle                           (string) e.g. '20190615T0600Z'
+    number_obs_files_on_mass        (int64) metadata, as from obs_analyse.create_metadata_num_files()
+    number_obs_used_in_stats        (int64)
+    all_obs_files_ok                (bool)
+    flags, regions, obs             (string arrays) the axis labels, stored once. obs ends with 'all_obs', the total
+    stats                           (float64 array [flag, region, obs]) NaN where an obs type is missing
+No pickling is needed to read them, and they can be memory-mapped, so a single value or obs type can be read
+without reading the rest. Most of the time numpy takes to load a small .npy file goes on parsing its header, so parsed
+headers are kept: the files of a trial share a handful of headers (the obs types are about the only thing that
+varies), so after the first of them a file loads in microseconds.
+
+The readers here accept both formats, so files from before the change can still be read, or converted in place.
+
+Usage: python cycle_stats_file.py [cycle statistics files, or directories of them] to convert the old dictionary
+    files into the new format. Files already in the new format are left as they are.
+"""
+
+import numpy as np
+import os
+import sys
+import glob
+import struct
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+FORMAT_VERSION = 1
+
+STATS_SUFFIX = '_stats.npy'
+
+# metadata fields, in the order of the record
+META_FIELDS = [('number_obs_files_on_mass', '<i8'), ('number_obs_used_in_stats', '<i8'), ('all_obs_files_ok', '?')]
+
+# parsed .npy headers: _HEADER_CACHE[raw header] = (shape, fortran_order, dtype)
+_HEADER_CACHE = {}
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def stats_dtype(flags, regions, obs_list, cycle_str):
+    """
+    Record dtype of a cycle statistics file with these axis labels
+    """
+
+    def label_dtype(labels):
+        return 'S' + str(max([len(label) for label in labels] + [1]))
+
+    return np.dtype([('format_version', '<i4'), ('cycle', label_dtype([cycle_str]))] + META_FIELDS +
+                    [('flags', label_dtype(flags), (len(flags),)),
+                     ('regions', label_dtype(regions), (len(regions),)),
+                     ('obs', label_dtype(obs_list), (len(obs_list),)),
+                     ('stats', '<f8', (len(flags), len(regions), len(obs_list)))])
+
+
+def pack_cycle_stats(suite_cycle_stats, suite_cycle_meta, cycle_str, flags=None, regions=None):
+    """
+    Pack a cycle's statistics dictionaries into a record
+    :param suite_cycle_stats: suite_cycle_stats[flag][region][obs] = value
+    :param suite_cycle_meta: (dict) metadata, with the META_FIELDS keys
+    :param cycle_str: cycle e.g. '20190615T0600Z'
+    :keyword flags: flag order (default: sorted)
+    :keyword regions: region order (default: sorted)
+    :return: record: (numpy structured array, shape (1,))
+    """
+
+    if flags is None:
+        flags = sorted(suite_cycle_stats.keys())
+    if regions is None:
+        regions = sorted(suite_cycle_stats[flags[0]].keys())
+    obs_set = set()
+    for flag_i in flags:
+        for region_i in regions:
+            obs_set.update(suite_cycle_stats[flag_i][region_i].keys())
+    obs_list = sorted(obs_set - set(['all_obs'])) + (['all_obs'] if 'all_obs' in obs_set else [])
+
+    record = np.zeros(1, dtype=stats_dtype(flags, regions, obs_list, cycle_str))
+    record['format_version'] = FORMAT_VERSION
+    record['cycle'] = cycle_str
+    for key, _ in META_FIELDS:
+        record[key] = suite_cycle_meta[key]
+    record['flags'][0] = flags
+    record['regions'][0] = regions
+    record['obs'][0] = obs_list
+    record['stats'][0] = [[[suite_cycle_stats[flag_i][region_i].get(obs_i, np.nan) for obs_i in obs_list]
+                           for region_i in regions]
+                          for flag_i in flags]
+
+    return record
+
+
+def save_cycle_stats(filepath, suite_cycle_stats, suite_cycle_meta, cycle_str, flags=None, regions=None):
+    """
+    Save a cycle's statistics in the fixed-schema format. Written to a temporary file and renamed, so the file is
+    never left half written. See pack_cycle_stats() for the arguments.
+    """
+
+    record = pack_cycle_stats(suite_cycle_stats, suite_cycle_meta, cycle_str, flags=flags, regions=regions)
+    with open(filepath + '.tmp', 'wb') as f:
+        np.save(f, record, allow_pickle=False)
+    os.rename(filepath + '.tmp', filepath)
+
+    return
+
+
+def read_header(f):
+    """
+    Read the .npy header of an open file, leaving the file at the start of the data. Parsed headers are cached.
+    :param f: file object, at the start of the file
+    :return: shape, fortran_order, dtype
+    """
+
+    major, _ = np.lib.format.read_magic(f)
+    length_format = '<H' if major == 1 else '<I'
+    length = struct.unpack(length_format, f.read(struct.calcsize(length_format)))[0]
+    header = f.read(length)
+
+    if header not in _HEADER_CACHE:
+        f.seek(0)
+        np.lib.format.read_magic(f)
+        if major == 1:
+            _HEADER_CACHE[header] = np.lib.format.read_array_header_1_0(f)
+        else:
+            _HEADER_CACHE[header] = np.lib.format.read_array_header_2_0(f)
+
+    return _HEADER_CACHE[header]
+
+
+def is_legacy_file(filepath):
+    """
+    Is the file an old np.save()d dictionary? Only the .npy header is read.
+    """
+
+    with open(filepath, 'rb') as f:
+        _, _, dtype = read_header(f)
+
+    return dtype.hasobject
+
+
+def load_cycle_record(filepath, mmap=False):
+    """
+    Load a cycle statistics file in the fixed-schema format, without unpickling
+    :param filepath: cycle statistics filepath
+    :keyword mmap: memory-map the file, so only the parts used are read (e.g. record['stats'][0][f, r, o]). The
+        files are small, so this only pays when a small part of each of many files is wanted.
+    :return: record: (numpy structured array, shape (1,)), read only
+    """
+
+    with open(filepath, 'rb') as f:
+        shape, fortran_order, dtype = read_header(f)
+        if dtype.hasobject:
+            raise ValueError(filepath + ' is an old dictionary file: read it with read_cycle_stats()')
+        if mmap:
+            return np.memmap(filepath, dtype=dtype, mode='r', shape=shape, offset=f.tell(),
+                             order='F' if fortran_order else 'C')
+        count = int(np.prod(shape))
+        return np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count).reshape(shape)
+
+
+def record_to_dicts(record):
+    """
+    Unpack a record into the dictionaries obs_analyse.py used to save
+    :return: suite_cycle_stats, suite_cycle_meta, cycle_str
+    """
+
+    flags = [str(flag_i) for flag_i in record['flags'][0]]
+    regions = [str(region_i) for region_i in record['regions'][0]]
+    obs_list = [str(obs_i) for obs_i in record['obs'][0]]
+    stats = np.array(record['stats'][0])
+    present = (~np.isnan(stats)).tolist()
+    values = stats.tolist()
+
+    suite_cycle_stats = {flag_i: {region_i: {obs_i: np.float64(values[f][r][o]) for o, obs_i in enumerate(obs_list)
+                                             if present[f][r][o]}
+                                  for r, region_i in enumerate(regions)}
+                         for f, flag_i in enumerate(flags)}
+    suite_cycle_meta = {key: record[key][0].item() for key, _ in META_FIELDS}
+
+    return suite_cycle_stats, suite_cycle_meta, str(record['cycle'][0])
+
+
+def read_cycle_stats(filepath):
+    """
+    Read a cycle statistics file in either format, as dictionaries
+    :return: suite_cycle_stats, suite_cycle_meta, cycle_str
+    """
+
+    if is_legacy_file(filepath):
+        raw = np.load(filepath, allow_pickle=True).flat[0]
+        return raw['suite_cycle_stats'], raw['suite_cycle_meta'], raw.get('cycle')
+
+    return record_to_dicts(load_cycle_record(filepath))
+
+
+def convert_legacy_file(filepath):
+    """
+    Convert an old dictionary file into the fixed-schema format, in place
+    :return: True if converted, False if it was already in the new format
+    """
+
+    if not is_legacy_file(filepath):
+        return False
+
+    raw = np.load(filepath, allow_pickle=True).flat[0]
+    cycle_str = raw.get('cycle', os.path.basename(filepath).split('_')[0])
+    save_cycle_stats(filepath, raw['suite_cycle_stats'], raw['suite_cycle_meta'], cycle_str)
+
+    return True
+
+
+if __name__ == '__main__':
+
+    filepaths = []
+    for path in sys.argv[1:]:
+        filepaths += sorted(glob.glob(path + '/*' + STATS_SUFFIX)) if os.path.isdir(path) else [path]
+
+    n_converted = 0
+    for filepath in filepaths:
+        try:
+            if convert_legacy_file(filepath):
+                n_converted += 1
+        except Exception as e:
+            print('could not convert ' + filepath + ': ' + repr(e))
+    print('converted ' + str(n_converted) + ' of ' + str(len(filepaths)) + ' files')
+
+    exit(0)
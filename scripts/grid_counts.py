@@ -0,0 +1,328 @@
+#!/usr/bin/env python2.7
+
+"""
+Gridded observation counts, and a region engine that works from them.
+
+As obs_analyse.py queries each ODB2 file, it also counts the observations in each lat/lon grid cell (GRID_RESOLUTION
+degrees) for each flag, in the same query. These count grids are saved for each cycle next to the cycle statistics,
+so the number of observations in any region, including new regions or resized versions of the existing ones, can be
+worked out from them without getting and querying the ODB2 files from MASS again.
+
+Each cycle's grids are stored sparsely, as (obs, flag, cell, count) for the cells with observations in them, in an
+.npz file of plain arrays.
+
+Regions are masks on the grid. They can be given as region_bounds style SQL predicates on lat and lon (e.g.
+'sum((70 > lat > 25) and (28 > lon > -10))'), as lat/lon boxes, or as boolean (lat, lon) masks, and are evaluated at
+the cell centres. An observation only counts differently from the SQL predicate if it lies in a cell that the region
+boundary cuts through, so regions whose edges are whole multiples of the grid resolution (as all the existing ones are
+at 1 degree) match the queried statistics, apart from observations lying exactly on an edge.
+
+Usage: python grid_counts.py [grid count files] --region NAME 'SQL predicate' [--region ...]
+    to print the total number of observations in each region, for each flag and obs type, across the files.
+    Without --region, the existing regions from obs_analyse.py are used.
+"""
+
+import numpy as np
+import os
+import glob
+import shutil
+import argparse
+
+import odb2_reader
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+GRID_COUNTS_SUFFIX = '_grid_counts.npz'
+
+# the existing regions, as in obs_analyse.region_bounds. GLOBAL is NH + SH, as in the cycle statistics
+REGION_BOUNDS = {'NH': 'sum(lat > 0)',
+                 'SH': 'sum(lat < 0)',
+                 'TR': 'sum(20 > lat > -20)',
+                 'EUR': 'sum((70 > lat > 25) and (28 > lon > -10))',
+                 'AUS': 'sum((-8 > lat > -45) and (157 > lon > 106))'}
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+# the grid
+
+
+def grid_shape(resolution):
+    """
+    Number of lat and lon cells of a global grid, from -90 to 90 and from -180 to 180
+    :param resolution: cell size [degrees], which should divide 180
+    :return: (n_lat, n_lon)
+    """
+
+    return int(round(180.0 / resolution)), int(round(360.0 / resolution))
+
+
+def cell_centres(resolution):
+    """
+    Latitudes and longitudes of the cell centres, each of shape (n_lat, n_lon)
+    """
+
+    n_lat, n_lon = grid_shape(resolution)
+    lats = -90.0 + resolution * (np.arange(n_lat) + 0.5)
+    lons = -180.0 + resolution * (np.arange(n_lon) + 0.5)
+
+    return np.meshgrid(lats, lons, indexing='ij')
+
+
+def cell_index(lat_cell, lon_cell, resolution):
+    """
+    Flat grid index of each query row, from its floor(lat/res) and floor(lon/res) cells. Latitude 90 goes in the top
+    row of cells, and longitudes wrap around (so 0 to 360 longitudes work too).
+    :return: index: (numpy array, dtype=int64), valid: (numpy array, dtype=bool) False for missing or impossible
+        positions, which are off the grid
+    """
+
+    n_lat, n_lon = grid_shape(resolution)
+    lat_i = np.asarray(lat_cell, dtype=np.int64) + n_lat // 2
+    lon_i = np.mod(np.asarray(lon_cell, dtype=np.int64) + n_lon // 2, n_lon)
+    valid = (lat_i >= 0) & (lat_i <= n_lat) & (np.abs(np.asarray(lon_cell, dtype=np.int64)) <= 2 * n_lon)
+    lat_i = np.clip(lat_i, 0, n_lat - 1)
+
+    return lat_i * n_lon + lon_i, valid
+
+
+def instrument_grid(grid_rows, flag_rows, resolution):
+    """
+    One instrument's count grid for each flag, from the rows of the gridded query
+    :param grid_rows: (numpy array) columns: active, surplus, lat cell, lon cell, count, ...
+    :param flag_rows: (dict) flag: indices of the rows in that flag
+    :param resolution: grid cell size [degrees]
+    :return: grid: (dict) grid[flag] = (cells, counts, off_grid): the flat indices of the cells with observations,
+        their counts, and the number of observations with no valid position
+    """
+
+    n_cells = np.prod(grid_shape(resolution))
+    grid = {}
+    for flag_i, rows in flag_rows.iteritems():
+        index, valid = cell_index(grid_rows[rows, 2], grid_rows[rows, 3], resolution)
+        counts = grid_rows[rows, 4]
+        dense = np.bincount(index[valid], weights=counts[valid], minlength=n_cells)
+        cells = np.nonzero(dense)[0]
+        grid[flag_i] = (cells.astype(np.int32), dense[cells].astype(np.int64), int(np.sum(counts[~valid])))
+
+    return grid
+
+
+# saving and loading
+
+
+def cycle_grid_filepath(grid_dir, suite_id, cycle_str):
+    """
+    Grid counts filepath of a suite cycle
+    """
+
+    return grid_dir + '/' + cycle_str + '_' + suite_id + GRID_COUNTS_SUFFIX
+
+
+def save_instrument_grid(parts_dir, obs_i, grid):
+    """
+    Save one instrument's grids while the rest of the cycle is being processed. Written to a temporary file and
+    renamed, so a saved grid is always complete (it can then be picked up by a retry of the cycle).
+    :param parts_dir: the cycle's directory of instrument grids
+    :param obs_i: observation name, e.g. 'iasi'
+    :param grid: (dict) from instrument_grid()
+    :return:
+    """
+
+    if not os.path.exists(parts_dir):
+        os.system('mkdir -p ' + parts_dir)
+
+    arrays = {}
+    for flag_i, (cells, counts, off_grid) in grid.iteritems():
+        arrays['cells_' + flag_i] = cells
+        arrays['counts_' + flag_i] = counts
+        arrays['off_grid_' + flag_i] = np.array(off_grid, dtype=np.int64)
+
+    filepath = parts_dir + '/' + obs_i + '.npz'
+    np.savez(filepath + '.tmp.npz', **arrays)
+    os.rename(filepath + '.tmp.npz', filepath)
+
+    return
+
+
+def merge_instrument_grids(parts_dir, obs_list, flags, resolution, filepath):
+    """
+    Merge a cycle's instrument grids into its grid counts file, and remove them
+    :param parts_dir: the cycle's directory of instrument grids
+    :param obs_list: the instruments to include (those in the cycle's statistics)
+    :param flags: flag names
+    :param resolution: grid cell size [degrees]
+    :param filepath: grid counts file to save
+    :return:
+    """
+
+    obs_names = sorted([obs_i for obs_i in obs_list if os.path.exists(parts_dir + '/' + obs_i + '.npz')])
+
+    obs_idx, flag_idx, cells, counts = [], [], [], []
+    off_grid = np.zeros((len(obs_names), len(flags)), dtype=np.int64)
+    for o, obs_i in enumerate(obs_names):
+        with np.load(parts_dir + '/' + obs_i + '.npz') as part:
+            for f, flag_i in enumerate(flags):
+                obs_idx += [np.full(part['cells_' + flag_i].shape, o, dtype=np.int16)]
+                flag_idx += [np.full(part['cells_' + flag_i].shape, f, dtype=np.int8)]
+                cells += [part['cells_' + flag_i]]
+                counts += [part['counts_' + flag_i]]
+                off_grid[o, f] = part['off_grid_' + flag_i]
+
+    def joined(parts, dtype):
+        return np.concatenate(parts).astype(dtype) if len(parts) > 0 else np.zeros(0, dtype=dtype)
+
+    np.savez_compressed(filepath + '.tmp.npz',
+                        obs=np.array(obs_names, dtype='S'),
+                        flags=np.array(flags, dtype='S'),
+                        resolution=np.array(resolution),
+                        obs_index=joined(obs_idx, np.int16),
+                        flag_index=joined(flag_idx, np.int8),
+                        cell=joined(cells, np.int32),
+                        count=joined(counts, np.int64),
+                        off_grid=off_grid)
+    os.rename(filepath + '.tmp.npz', filepath)
+
+    if os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+
+    return
+
+
+def load_cycle_grid(filepath):
+    """
+    Load a cycle's grid counts
+    :return: grid: (dict) 'obs', 'flags' (lists of names), 'resolution', and the 'obs_index', 'flag_index', 'cell'
+        and 'count' arrays of the cells with observations, and 'off_grid' (obs, flag) counts
+    """
+
+    with np.load(filepath) as f:
+        grid = {key: f[key] for key in f.files}
+    grid['obs'] = [str(obs_i) for obs_i in grid['obs']]
+    grid['flags'] = [str(flag_i) for flag_i in grid['flags']]
+    grid['resolution'] = float(grid['resolution'])
+
+    return grid
+
+
+def dense_grid(grid, obs_i, flag_i):
+    """
+    The full (lat, lon) count grid of one obs type and flag
+    """
+
+    n_lat, n_lon = grid_shape(grid['resolution'])
+    select = (grid['obs_index'] == grid['obs'].index(obs_i)) & (grid['flag_index'] == grid['flags'].index(flag_i))
+
+    return np.bincount(grid['cell'][select], weights=grid['count'][select],
+                       minlength=n_lat * n_lon).reshape(n_lat, n_lon)
+
+
+# the region engine
+
+
+def expression_mask(expression, resolution):
+    """
+    Region mask from a region_bounds style SQL predicate on lat and lon, evaluated at the cell centres
+    :param expression: e.g. 'sum((70 > lat > 25) and (28 > lon > -10))'
+    :return: mask: (numpy array, dtype=bool, shape=(n_lat, n_lon))
+    """
+
+    lats, lons = cell_centres(resolution)
+    mask = odb2_reader.region_mask(expression, {'lat': lats.ravel(), 'lon': lons.ravel()})
+
+    return mask.reshape(lats.shape)
+
+
+def box_mask(lat_min, lat_max, lon_min, lon_max, resolution):
+    """
+    Region mask of a lat/lon box, of the cells whose centres are in it. A box with lon_min > lon_max crosses the
+    dateline.
+    :return: mask: (numpy array, dtype=bool, shape=(n_lat, n_lon))
+    """
+
+    lats, lons = cell_centres(resolution)
+    in_lat = (lats > lat_min) & (lats < lat_max)
+    if lon_min <= lon_max:
+        in_lon = (lons > lon_min) & (lons < lon_max)
+    else:
+        in_lon = (lons > lon_min) | (lons < lon_max)
+
+    return in_lat & in_lon
+
+
+def region_masks_from_bounds(region_bounds, resolution):
+    """
+    Region masks for region_bounds style SQL predicates, plus GLOBAL (NH + SH) if NH and SH are both given
+    :return: masks: (dict) region: mask
+    """
+
+    masks = {region_i: expression_mask(expression, resolution) for region_i, expression in region_bounds.iteritems()}
+    if 'NH' in masks and 'SH' in masks:
+        masks['GLOBAL'] = masks['NH'] | masks['SH']
+
+    return masks
+
+
+def region_stats(grid, region_masks):
+    """
+    Count the observations in each region, for each flag and obs type, from a cycle's grid counts. Gives the same
+    layout as the cycle statistics from obs_analyse.py.
+    :param grid: (dict) from load_cycle_grid()
+    :param region_masks: (dict) region: (n_lat, n_lon) boolean mask, e.g. from region_masks_from_bounds()
+    :return: stats: (dict) stats[flag][region][obs] = count, with stats[flag][region]['all_obs'] the total
+    """
+
+    n_obs, n_flags = len(grid['obs']), len(grid['flags'])
+    group = grid['obs_index'].astype(np.int64) * n_flags + grid['flag_index']
+
+    stats = {flag_i: {} for flag_i in grid['flags']}
+    for region_i, mask in region_masks.iteritems():
+        in_region = mask.ravel()[grid['cell']]
+        totals = np.bincount(group, weights=grid['count'] * in_region, minlength=n_obs * n_flags)
+        totals = totals.reshape(n_obs, n_flags)
+        for f, flag_i in enumerate(grid['flags']):
+            stats[flag_i][region_i] = {obs_i: totals[o, f] for o, obs_i in enumerate(grid['obs'])}
+            stats[flag_i][region_i]['all_obs'] = np.sum(totals[:, f])
+
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='grid count files, or directories of them')
+    parser.add_argument('--region', nargs=2, action='append', metavar=('NAME', 'PREDICATE'), default=None,
+                        help="region name and SQL predicate on lat and lon, e.g. MED '(46 > lat > 30) and "
+                             "(36 > lon > -6)'")
+    args = parser.parse_args()
+
+    filepaths = []
+    for path in args.paths:
+        filepaths += sorted(glob.glob(path + '/*' + GRID_COUNTS_SUFFIX)) if os.path.isdir(path) else [path]
+    region_bounds = REGION_BOUNDS if args.region is None else dict(args.region)
+
+    # total over all the files
+    totals = {}
+    masks = None
+    for filepath in filepaths:
+        grid = load_cycle_grid(filepath)
+        if masks is None:
+            masks = region_masks_from_bounds(region_bounds, grid['resolution'])
+        for flag_i, flag_data in region_stats(grid, masks).iteritems():
+            for region_i, region_data in flag_data.iteritems():
+                for obs_i, value in region_data.iteritems():
+                    key = (flag_i, region_i, obs_i)
+                    totals[key] = totals.get(key, 0) + value
+
+    print('%d files' % len(filepaths))
+    for flag_i in sorted(set([key[0] for key in totals])):
+        print('\n' + flag_i)
+        for region_i in sorted(set([key[1] for key in totals])):
+            obs_names = sorted([key[2] for key in totals if key[0] == flag_i and key[1] == region_i])
+            print('  %-8s ' % region_i + ', '.join(['%s: %d' % (obs_i, totals[(flag_i, region_i, obs_i)])
+                                                    for obs_i in obs_names]))
+
+    exit(0)
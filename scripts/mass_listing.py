@@ -0,0 +1,274 @@
+#!/usr/bin/env python2.7
+
+"""
+Local index of the files each suite has archived in MASS (moose:/devfc/[suite-id]/adhoc.file), so that finding a
+cycle's ODB2 files does not need a moo ls round trip for every cycle of every suite.
+
+The first time, a suite's whole adhoc.file listing is fetched with one 'moo ls -l', with the file sizes. After that,
+only cycles newer than the ones already indexed are listed, one day at a time from the latest indexed day (which is
+listed again, as its last cycles may not have been archived the last time). The index is a json file per suite,
+keyed by cycle and model run, updated under a lock so that cycles running at the same time do not clash.
+
+When each day was listed is recorded, with the latest cycle in the index at the time. A cycle older than the latest
+is only answered from the index if its files were complete when its day was listed: a later cycle had been archived
+by then (a suite archives its cycles in order), or it was listed ARCHIVE_COMPLETE_HOURS after the cycle. Otherwise, or
+if the cycle is not in the index at all, its day is listed again, so files archived late (e.g. picked up by a retry)
+are found.
+
+Usage: python mass_listing.py [suite-ids] to build or refresh their indexes.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import subprocess
+import datetime as dt
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+MASS_SUITE_DIR = 'moose:/devfc/{suite_id}/adhoc.file'
+
+INDEX_DIR = os.getenv('DATADIR', os.getenv('HOME', '/tmp')) + '/R2O_projects/update_cutoff/data/mass_listing'
+
+CYCLE_FMT = '%Y%m%dT%H%MZ'
+
+# a cycle's files are taken to be complete in a listing made this many hours after the cycle, even if no later cycle
+#   had been archived (e.g. the last cycle of a trial)
+ARCHIVE_COMPLETE_HOURS = 48
+
+# exit status and stderr messages of a 'moo ls' of a path or glob that matches nothing. Any other failure (an outage,
+#   authentication, a timeout...) is raised, so the task fails and is retried rather than finding no files
+MOO_NO_MATCH_STATUS = 2
+MOO_NO_MATCH_MESSAGES = ['ERROR_CLIENT_PATH_DOES_NOT_EXIST', 'no files match']
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def index_filepath(index_dir, suite_id):
+    """
+    Listing index filepath of a suite
+    """
+
+    return index_dir + '/' + suite_id + '_adhoc_listing.json'
+
+
+def parse_moo_ls_long(out):
+    """
+    Parse 'moo ls -l' output into moose paths and sizes. Each line ends with the moose path, and the size is the
+    last whole number before it (the date and time fields are not whole numbers).
+    :param out: (str) moo ls -l output
+    :return: files: list of (moosepath, size in bytes)
+    """
+
+    files = []
+    for line in out.split('\n'):
+        fields = line.split()
+        paths = [f for f in fields if f.startswith('moose:')]
+        if len(paths) == 0:
+            continue
+        before_path = fields[:fields.index(paths[-1])]
+        sizes = [int(f.replace(',', '')) for f in before_path if f.replace(',', '').isdigit()]
+        files += [(paths[-1], sizes[-1] if len(sizes) > 0 else -1)]
+
+    return files
+
+
+def moo_ls_long(moosepath):
+    """
+    'moo ls -l' a moose path or glob. A path or glob that matches nothing gives no files; any other failure is raised.
+    :return: files: list of (moosepath, size in bytes)
+    """
+
+    proc = subprocess.Popen('moo ls -l ' + moosepath, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        if proc.returncode == MOO_NO_MATCH_STATUS and len(out.strip()) == 0 and \
+                any([message in err for message in MOO_NO_MATCH_MESSAGES]):
+            return []
+        raise subprocess.CalledProcessError(proc.returncode, 'moo ls -l ' + moosepath, err)
+
+    return parse_moo_ls_long(out)
+
+
+def new_index(suite_id):
+    """
+    Empty listing index: files[cycle][model_run] = [[moosepath, size], ...], and listed_days[day] = {'listed': when the
+    day was last listed, 'latest_cycle': the latest cycle in the index then}
+    """
+
+    return {'suite': suite_id, 'updated': None, 'latest_cycle': None, 'files': {}, 'listed_days': {}}
+
+
+def add_to_index(index, files):
+    """
+    Add listed files to the index. Files not named like '20190615T0600Z_glu_...' are ignored.
+    """
+
+    for moosepath, size in files:
+        filename = moosepath.split('/')[-1]
+        parts = filename.split('_')
+        try:
+            dt.datetime.strptime(parts[0], CYCLE_FMT)
+        except ValueError:
+            continue
+        if len(parts) < 3:
+            continue
+        cycle_files = index['files'].setdefault(parts[0], {}).setdefault(parts[1], [])
+        if moosepath not in [f[0] for f in cycle_files]:
+            cycle_files.append([moosepath, size])
+        else:
+            cycle_files[[f[0] for f in cycle_files].index(moosepath)][1] = size
+
+    if len(index['files']) > 0:
+        index['latest_cycle'] = max(index['files'].keys())
+    index['updated'] = dt.datetime.utcnow().strftime(CYCLE_FMT)
+
+    return
+
+
+def mark_listed(index, days):
+    """
+    Record that the days (e.g. ['20190615']) have just been listed
+    """
+
+    listed = {'listed': dt.datetime.utcnow().strftime(CYCLE_FMT), 'latest_cycle': index['latest_cycle']}
+    for day in days:
+        index.setdefault('listed_days', {})[day] = dict(listed)
+
+    return
+
+
+def listing_complete(index, cycle_str, model_run='glu'):
+    """
+    Can the cycle's files be answered from the index? Only if the cycle is in it, and all its files had been archived
+    when its day was last listed: a later cycle was in the index by then, or the listing was made
+    ARCHIVE_COMPLETE_HOURS after the cycle.
+    """
+
+    if model_run not in index['files'].get(cycle_str, {}):
+        return False
+    listed = index.get('listed_days', {}).get(cycle_str[:8])
+    if listed is None:
+        return False
+    if listed['latest_cycle'] is not None and listed['latest_cycle'] > cycle_str:
+        return True
+
+    complete_time = dt.datetime.strptime(cycle_str, CYCLE_FMT) + dt.timedelta(hours=ARCHIVE_COMPLETE_HOURS)
+    return dt.datetime.strptime(listed['listed'], CYCLE_FMT) >= complete_time
+
+
+def relist_day(index, cycle_str):
+    """
+    List the cycle's day again into the index, for a cycle that was missing or not yet complete when it was listed
+    :return: number of MASS listing requests made
+    """
+
+    day = cycle_str[:8]
+    add_to_index(index, moo_ls_long(MASS_SUITE_DIR.format(suite_id=index['suite']) + '/' + day + 'T*'))
+    mark_listed(index, [day])
+
+    return 1
+
+
+def refresh_index(index, up_to_cycle=None):
+    """
+    List what is new in MASS into the index: the whole adhoc.file directory if the index is empty, else each day from
+    the latest indexed day up to the day of up_to_cycle (default: today). A listing that fails is raised before any
+    day is marked as listed, so the index is not saved with days it may be missing files from.
+    :param index: (dict) listing index
+    :keyword up_to_cycle: (str) cycle e.g. '20190615T0600Z'
+    :return: number of MASS listing requests made
+    """
+
+    suite_dir = MASS_SUITE_DIR.format(suite_id=index['suite'])
+
+    if index['latest_cycle'] is None:
+        add_to_index(index, moo_ls_long(suite_dir))
+        mark_listed(index, set([cycle_str[:8] for cycle_str in index['files']]))
+        return 1
+
+    day = dt.datetime.strptime(index['latest_cycle'], CYCLE_FMT).replace(hour=0, minute=0)
+    last_day = dt.datetime.utcnow() if up_to_cycle is None else dt.datetime.strptime(up_to_cycle, CYCLE_FMT)
+    days = []
+    while day.date() <= last_day.date():
+        days += [day.strftime('%Y%m%d')]
+        add_to_index(index, moo_ls_long(suite_dir + '/' + days[-1] + 'T*'))
+        day += dt.timedelta(days=1)
+    # marked once all are listed, so each day's record has the latest cycle found by the whole refresh
+    mark_listed(index, days)
+
+    return len(days)
+
+
+def load_index(filepath, suite_id):
+    """
+    Load a suite's listing index, or an empty one if there is none yet
+    """
+
+    if not os.path.exists(filepath):
+        return new_index(suite_id)
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def save_index(filepath, index):
+    """
+    Save a listing index. Written to a temporary file and renamed, so the index is never left half written.
+    """
+
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(filepath + '.tmp', filepath)
+
+    return
+
+
+def cycle_files(suite_id, cycle_str, model_run='glu', index_dir=INDEX_DIR, refresh=False):
+    """
+    A cycle's archived files, from the suite's listing index. The index is refreshed first if the cycle is newer than
+    the latest cycle in it (or if refresh is set), and the cycle's day is listed again if the cycle is not in the
+    index, or its files may not all have been archived when it was listed (see listing_complete()).
+    :param suite_id: e.g. 'u-bo796'
+    :param cycle_str: (str) cycle e.g. '20190615T0600Z'
+    :keyword model_run: ('glu' or 'glm')
+    :keyword index_dir: directory of the listing indexes
+    :keyword refresh: refresh the index even if the cycle is already covered by it
+    :return: files: list of (moosepath, size in bytes), sorted by moosepath
+    """
+
+    if not os.path.exists(index_dir):
+        os.system('mkdir -p ' + index_dir)
+    filepath = index_filepath(index_dir, suite_id)
+
+    with open(filepath + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index = load_index(filepath, suite_id)
+            if refresh or index['latest_cycle'] is None or cycle_str >= index['latest_cycle']:
+                n_requests = refresh_index(index, up_to_cycle=cycle_str)
+                save_index(filepath, index)
+                print('refreshed MASS listing index for ' + suite_id + ' (' + str(n_requests) + ' moo ls requests)')
+            elif not listing_complete(index, cycle_str, model_run=model_run):
+                relist_day(index, cycle_str)
+                save_index(filepath, index)
+                print('listed ' + cycle_str[:8] + ' again for ' + suite_id + ', as ' + cycle_str +
+                      ' was missing or incomplete in the MASS listing index')
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    files = index['files'].get(cycle_str, {}).get(model_run, [])
+
+    return sorted([(str(moosepath), size) for moosepath, size in files])
+
+
+if __name__ == '__main__':
+
+    for suite_id in sys.argv[1:]:
+        cycle_files(suite_id, dt.datetime.utcnow().strftime(CYCLE_FMT), refresh=True)
+
+    exit(0)
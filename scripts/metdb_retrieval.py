@@ -0,0 +1,231 @@
+#!/usr/bin/env python2.7
+
+"""
+Chunked, concurrent and cached retrieval of observations from MetDB.
+
+One metdb.obs() call for a long START/END TIME window can run out of memory, and if it fails it has to be repeated in
+full. Here the window is split into time chunks that are retrieved by a few threads at once, and each chunk is cached
+on disk as compressed columns (one array per element) keyed by subtype, elements, other keywords and the chunk's
+window. Repeat analyses of the same window then read the cache instead of MetDB, and a failed chunk is retried on
+its own. Only a few chunks are retrieved ahead of the one being used, so the whole window is never in memory at once
+if each chunk is reduced as it comes (iter_obs_chunks()).
+
+The backend is anything with an obs(contact, subtype, keywords, elements) function returning obs[element].data
+arrays, as the metdb module does. It defaults to metdb, and a local stand-in can be used instead, e.g. for testing.
+"""
+
+import numpy as np
+import datetime as dt
+import os
+import hashlib
+import threading
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+METDB_TIME_FMT = '%Y%m%d/%H%MZ'
+
+# length of each chunk [hours]. Keep this a whole number of hours, so chunks of subtypes stored by the hour do not
+# overlap (an END TIME of 0200Z returns data up to 0259Z for these)
+CHUNK_HOURS = 6
+
+# number of chunks retrieved from MetDB at once
+MAX_CONCURRENT_REQUESTS = 4
+
+# times to retry a chunk that failed, before giving up
+MAX_RETRIES = 2
+
+CACHE_DIR = os.getenv('SCRATCH', '/tmp') + '/metdb_cache'
+
+# chunks ending less than this long ago [hours] are not cached, as late obs could still be arriving for them
+CACHE_MIN_AGE_HOURS = 24
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def parse_metdb_time(keyword):
+    """
+    Time from a MetDB START/END TIME keyword
+    :param keyword: e.g. 'START TIME 20191114/2100Z'
+    :return: (datetime)
+    """
+
+    return dt.datetime.strptime(keyword.split()[-1], METDB_TIME_FMT)
+
+
+def time_chunks(start_time, end_time, chunk_hours=CHUNK_HOURS):
+    """
+    Split a retrieval window into chunks. Each chunk ends a minute before the next one starts, as MetDB END TIMEs are
+    inclusive.
+    :param start_time: (datetime) START TIME of the window
+    :param end_time: (datetime) END TIME of the window (inclusive)
+    :keyword chunk_hours: length of each chunk [hours]
+    :return: list of (chunk start, chunk end) datetimes
+    """
+
+    chunk = dt.timedelta(hours=chunk_hours)
+    chunks = []
+    chunk_start = start_time
+    while chunk_start <= end_time:
+        chunk_end = min(chunk_start + chunk - dt.timedelta(minutes=1), end_time)
+        chunks += [(chunk_start, chunk_end)]
+        chunk_start = chunk_start + chunk
+
+    return chunks
+
+
+def chunk_cache_filepath(cache_dir, subtype, elements, keywords, chunk_start, chunk_end):
+    """
+    Cache filepath of a chunk. Anything that changes what MetDB returns (subtype, elements, other keywords such as
+    the AREA, and the chunk's window) is part of the key.
+    :return: filepath
+    """
+
+    key = '|'.join([subtype, ','.join(elements), ','.join(keywords)])
+    key_hash = hashlib.sha1(key).hexdigest()[:16]
+
+    return cache_dir + '/' + subtype + '/' + chunk_start.strftime('%Y%m%dT%H%M') + '_' + \
+        chunk_end.strftime('%Y%m%dT%H%M') + '_' + key_hash + '.npz'
+
+
+def save_chunk(filepath, obs, elements):
+    """
+    Save a chunk's obs as compressed columns: each element's data, and its mask if it has one. Written to a temporary
+    file and renamed, so a cache file is always complete.
+    """
+
+    columns = {}
+    for element in elements:
+        columns['data_' + element] = np.ma.getdata(obs[element])
+        columns['mask_' + element] = np.ma.getmaskarray(obs[element])
+
+    directory = os.path.dirname(filepath)
+    if not os.path.exists(directory):
+        os.system('mkdir -p ' + directory)
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '_' + str(threading.current_thread().ident) + '.tmp.npz'
+    np.savez_compressed(tmp_filepath, **columns)
+    os.rename(tmp_filepath, filepath)
+
+    return
+
+
+def load_chunk(filepath, elements):
+    """
+    Load a cached chunk
+    :return: obs: (dict) obs[element] = (masked array), so obs[element].data is the data as from metdb.obs()
+    """
+
+    with np.load(filepath) as columns:
+        obs = {element: np.ma.masked_array(columns['data_' + element], mask=columns['mask_' + element])
+               for element in elements}
+
+    return obs
+
+
+def retrieve_chunk(backend, contact, subtype, elements, keywords, chunk_start, chunk_end, max_retries=MAX_RETRIES):
+    """
+    Retrieve one chunk from the backend, retrying it if it fails.
+    :return: obs: (dict) obs[element] = (masked array)
+    """
+
+    chunk_keywords = ['START TIME ' + chunk_start.strftime(METDB_TIME_FMT),
+                      'END TIME ' + chunk_end.strftime(METDB_TIME_FMT)] + list(keywords)
+
+    for attempt in range(max_retries + 1):
+        try:
+            out = backend.obs(contact, subtype, chunk_keywords, elements)
+            break
+        except Exception as e:
+            print('MetDB retrieval failed for ' + subtype + ' ' + chunk_keywords[0] + ' (attempt ' +
+                  str(attempt + 1) + '/' + str(max_retries + 1) + '): ' + repr(e))
+            if attempt == max_retries:
+                raise
+
+    return {element: np.ma.asarray(out[element]) for element in elements}
+
+
+def get_chunk(args):
+    """
+    Thread worker: get one chunk from the cache, or retrieve and cache it.
+    :param args: (backend, contact, subtype, elements, keywords, chunk_start, chunk_end, cache_dir, use_cache)
+    :return: obs: (dict) obs[element] = (masked array)
+    """
+
+    backend, contact, subtype, elements, keywords, chunk_start, chunk_end, cache_dir, use_cache = args
+
+    filepath = chunk_cache_filepath(cache_dir, subtype, elements, keywords, chunk_start, chunk_end)
+    if use_cache and os.path.exists(filepath):
+        return load_chunk(filepath, elements)
+
+    obs = retrieve_chunk(backend, contact, subtype, elements, keywords, chunk_start, chunk_end)
+
+    if use_cache and chunk_end < dt.datetime.utcnow() - dt.timedelta(hours=CACHE_MIN_AGE_HOURS):
+        save_chunk(filepath, obs, elements)
+
+    return obs
+
+
+def iter_obs_chunks(contact, subtype, keywords, elements, backend=None, chunk_hours=CHUNK_HOURS,
+                    max_concurrent=MAX_CONCURRENT_REQUESTS, cache_dir=CACHE_DIR, use_cache=True):
+    """
+    Retrieve obs chunk by chunk, with up to max_concurrent chunks retrieved at once. Chunks are yielded in time order,
+    and at most max_concurrent chunks are retrieved ahead of the one the caller has, so if each is processed and dropped
+    before the next is asked for, at most max_concurrent + 1 chunks are in memory.
+    :param contact: email address, as for metdb.obs()
+    :param subtype: e.g. 'LNDSYN'
+    :param keywords: MetDB keywords, which must include the START TIME and END TIME
+    :param elements: elements to retrieve
+    :keyword backend: module or object with an obs(contact, subtype, keywords, elements) function (default: metdb)
+    :keyword chunk_hours: length of each chunk [hours]
+    :keyword max_concurrent: number of chunks retrieved at once
+    :keyword cache_dir: cache directory
+    :keyword use_cache: read and write the cache
+    :return: generator of obs: (dict) obs[element] = (masked array)
+    """
+
+    if backend is None:
+        import metdb
+        backend = metdb
+
+    start_keyword = [k for k in keywords if k.startswith('START TIME')][0]
+    end_keyword = [k for k in keywords if k.startswith('END TIME')][0]
+    other_keywords = [k for k in keywords if k not in [start_keyword, end_keyword]]
+
+    tasks = [(backend, contact, subtype, elements, other_keywords, chunk_start, chunk_end, cache_dir, use_cache)
+             for chunk_start, chunk_end in time_chunks(parse_metdb_time(start_keyword),
+                                                       parse_metdb_time(end_keyword), chunk_hours)]
+
+    tasks = iter(tasks)
+    pool = ThreadPool(max_concurrent)
+    try:
+        # chunks retrieved, or being retrieved, that the caller has not had yet, oldest first
+        in_flight = collections.deque([pool.apply_async(get_chunk, (task,))
+                                       for task in itertools.islice(tasks, max_concurrent)])
+        while len(in_flight) > 0:
+            obs = in_flight.popleft().get()
+            for task in itertools.islice(tasks, 1):
+                in_flight.append(pool.apply_async(get_chunk, (task,)))
+            yield obs
+            del obs
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_obs(contact, subtype, keywords, elements, **kwargs):
+    """
+    Drop-in for metdb.obs(contact, subtype, keywords, elements), retrieving the window in cached chunks. See
+    iter_obs_chunks() for the keywords. The whole window is joined in memory, so use iter_obs_chunks() instead for
+    windows too large for that.
+    :return: obs: (dict) obs[element] = (masked array) with the chunks joined in time order
+    """
+
+    chunks = list(iter_obs_chunks(contact, subtype, keywords, elements, **kwargs))
+
+    return {element: np.ma.concatenate([obs[element] for obs in chunks]) for element in elements}
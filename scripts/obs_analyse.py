@@ -4,14 +4,36 @@
 Script to analyse the observations that get integrated into the data assimilation process, for a suite run
 
 Ensure PATH=$PATH:~odb/installs/odbapi/odbapi-0.10.3-ukmo-v2/gnu-4.4.7/bin is ran in the shell first!
+(not needed if QUERY_BACKEND = 'numpy', unless a file needs the odb sql fallback)
 
 Created by Elliott Warren - Wed 11th Dec 2019: elliott.warren@metoffice.gov.uk
 """
 
 import numpy as np
 import os
+import sys
 import subprocess
 import datetime as dt
+import time
+import threading
+import Queue
+import gzip
+import zlib
+import shutil
+import tempfile
+import itertools
+import argparse
+import json
+import contextlib
+import traceback
+
+import odb2_reader
+import online_stats
+import stage_timing
+import mass_listing
+import cycle_checkpoint
+import grid_counts
+import cycle_stats_file
 
 # ==============================================================================
 # Setup
@@ -23,6 +45,9 @@ DATADIR = os.getenv('DATADIR')
 SCRATCH = os.getenv('SCRATCH')
 THIS_CYCLE = os.getenv('THIS_CYCLE')
 SUITE_I = os.getenv('SUITE_I')
+# space separated suite ids, set by the cylc suite instead of SUITE_I to run all its suites in one job (see
+#   --concurrent-suites)
+CONCURRENT_SUITE_IDS = os.getenv('CONCURRENT_SUITE_IDS')
 
 THIS_CYCLE = os.getenv('CYLC_TASK_CYCLE_POINT')
 
@@ -67,7 +92,7 @@ else:
     print 'THIS_CYCLE = '+THIS_CYCLE  #  20190615T0600Z
     cycle_range = [dt.datetime.strptime(THIS_CYCLE, '%Y%m%dT%H%MZ')]
     cycle_range_str = [i.strftime('%Y%m%dT%H%MZ') for i in cycle_range]
-    suite_iter_list = [SUITE_I]
+    suite_iter_list = [SUITE_I] if CONCURRENT_SUITE_IDS is None else CONCURRENT_SUITE_IDS.split()
     print '\n\n\nscript ran in online mode!\n\n\n'
 
 # flag headers to check for and create statistics about
@@ -80,6 +105,7 @@ regions = ['SH', 'NH', 'TR', 'AUS', 'EUR']
 
 # regional boundaries and the SQL query into its location
 # SQL query entry NOT for global as this will be done as the sum of NH and SH, and added later!
+# Keep grid_counts.REGION_BOUNDS the same as this
 region_bounds = {
            'NH': 'sum(lat > 0)',
            'SH': 'sum(lat < 0)',
@@ -88,11 +114,171 @@ region_bounds = {
            'AUS': 'sum((-8 > lat > -45) and (157 > lon > 106))'
 }
 
-# override the cycle statistics?
+# override the cycle statistics? If False, cycles in the suite's completion manifest (see cycle_checkpoint.py) are
+#   skipped
 OVERRIDE_CYCLE_STATS = True
 
+# checkpoint each instrument's statistics as it finishes, so a retried cycle only processes the remaining instruments?
+CHECKPOINT_INSTRUMENTS = True
+
+# also count each instrument's observations on a GRID_RESOLUTION degree lat/lon grid, for each flag, in the same
+#   query? The grids are saved with each cycle, so new or resized regions can be worked out from them without
+#   querying the ODB2 files again (see grid_counts.py). Off until the gridded query (grouped by floor(lat/res),
+#   floor(lon/res)) has been checked against real odb sql output: so far only the odb2_reader.py stand-in has run it
+GRID_COUNTS = False
+GRID_RESOLUTION = 1.0
+
+# pipeline the instruments? If True, instrument N+1 is downloaded from MASS while instrument N is being queried.
+# Number of workers for each stage. Keep NUM_FETCH_WORKERS low as each worker holds a file on scratch.
+PIPELINE_MODE = True
+NUM_FETCH_WORKERS = 2
+NUM_QUERY_WORKERS = 2
+
+# find each cycle's files from a local index of each suite's MASS listing, refreshed only for new cycles (see
+#   mass_listing.py), instead of a moo ls for every cycle?
+USE_LISTING_INDEX = True
+LISTING_INDEX_DIR = mass_listing.INDEX_DIR
+
+# get all of a cycle's files from MASS in a single moo get request, instead of one request per file? Files are queried
+#   as they arrive. Poll for arrived files every BATCH_POLL_INTERVAL seconds.
+BATCH_MOO_GET = True
+BATCH_POLL_INTERVAL = 1.0
+
+# multi-cycle batch mode (python obs_analyse.py --start ... --end ...): cycles whose files are got from MASS in one
+#   request. All their files can be on scratch at once.
+BATCH_CYCLES_PER_REQUEST = 4
+CYCLE_HOURS = 6
+
+# stream decompress the ODB2 files? If True, the .gz file is decompressed in-process and fed to odb sql through a
+#   FIFO, so the uncompressed ODB2 file never lands on scratch. FIFOs are made in the node-local TMPDIR.
+STREAM_DECOMPRESS = True
+FIFO_DIR = os.getenv('TMPDIR', '/tmp')
+# bytes read from the gzip file per write into the FIFO
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# rows of odb sql output parsed at a time, as the output streams in
+SQL_PARSE_CHUNK_ROWS = 100000
+
+# bounded-memory queries: sum the query output rows into their flag (and grid cell) groups chunk by chunk as they
+#   stream in, instead of keeping every row, so the query uses at most about QUERY_MEMORY_BUDGET_MB whatever the size
+#   of the file. The chunk size is set from the budget. The tasks get --mem=512 in suite.rc, which odb sql and python
+#   itself also need some of.
+BOUNDED_MEMORY = True
+QUERY_MEMORY_BUDGET_MB = 128
+
+# how to query the ODB2 files: 'odb' = odb sql binary, 'numpy' = in-process reader (odb2_reader.py), which decodes
+#   only the columns needed. The numpy reader falls back to odb sql for files it can not decode. It is experimental:
+#   not yet checked against real ODB2 files and odb sql output (see odb2_reader.py), so keep 'odb' until it has been
+QUERY_BACKEND = 'odb'
+
+# fold each cycle's statistics into the suite's online summary statistics as it finishes (see online_stats.py)?
+ONLINE_STATS = True
+
+# time each stage for each instrument, and write the records next to the log file (see stage_timing.py)?
+STAGE_TIMING = True
+
+# concurrent suites mode (python obs_analyse.py --concurrent-suites, or CONCURRENT_SUITE_IDS set): all the suites of a
+#   cycle are processed at once in one job, each in its own thread, instead of one job per suite. Limits on the MASS
+#   requests, odb queries and disk writes in flight at once, shared by all the suites. What each suite prints goes to
+#   its own file next to its log file.
+MAX_MASS_TRANSFERS = 2
+MAX_ODB_QUERIES = 2
+MAX_DISK_WRITES = 1
+
+# shared limits of the concurrent suites mode: LIMITS[resource] = threading.BoundedSemaphore, or None for no limit
+LIMITS = {'mass': None, 'odb': None, 'disk': None}
+# slots held by each thread, so a thread holding a slot can take it again (e.g. a batched moo get falling back to
+#   single file requests)
+_held_limits = threading.local()
+
+
+def set_limits(max_mass, max_odb, max_disk):
+    """
+    Set the shared limits on the MASS requests, odb queries and disk writes in flight at once
+    :param max_mass: (int) MASS requests (moo get and moo ls), or None for no limit
+    :param max_odb: (int) odb queries, or None for no limit
+    :param max_disk: (int) statistics, grid and checkpoint writes and gunzips, or None for no limit
+    :return:
+    """
+
+    for resource, limit in zip(['mass', 'odb', 'disk'], [max_mass, max_odb, max_disk]):
+        LIMITS[resource] = None if limit is None else threading.BoundedSemaphore(limit)
+
+    return
+
+
+@contextlib.contextmanager
+def limited(resource):
+    """
+    Hold a slot of a shared resource ('mass', 'odb' or 'disk') for the duration of the with block, waiting for one if
+    they are all in use. Does nothing if the resource has no limit, or the thread holds a slot already.
+    """
 
-def find_obs_files(cycle_str, suite_id, model_run='glu'):
+    semaphore = LIMITS[resource]
+    held = getattr(_held_limits, resource, 0)
+    if semaphore is not None and held == 0:
+        semaphore.acquire()
+    setattr(_held_limits, resource, held + 1)
+    try:
+        yield
+    finally:
+        setattr(_held_limits, resource, held)
+        if semaphore is not None and held == 0:
+            semaphore.release()
+
+
+class SuiteOutput(object):
+    """
+    Stand-in for sys.stdout that sends what each thread prints to the file routed for it (its suite's output file), or
+    to the job's stdout if none is.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.files = {}
+
+    def route(self, f):
+        self.files[threading.current_thread().ident] = f
+
+    def unroute(self):
+        self.files.pop(threading.current_thread().ident, None)
+
+    def target(self):
+        return self.files.get(threading.current_thread().ident, self.stdout)
+
+    def write(self, text):
+        self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    # used by the print statement, so kept per file
+    softspace = property(lambda self: self.target().softspace,
+                         lambda self, value: setattr(self.target(), 'softspace', value))
+
+
+def suite_thread(target, args=()):
+    """
+    threading.Thread running target(*args), whose prints go to the same place as the calling thread's (see
+    SuiteOutput)
+    """
+
+    output = sys.stdout
+    if not isinstance(output, SuiteOutput):
+        return threading.Thread(target=target, args=args)
+    f = output.target()
+
+    def run():
+        output.route(f)
+        try:
+            target(*args)
+        finally:
+            output.unroute()
+
+    return threading.Thread(target=run)
+
+
+def find_obs_files(cycle_str, suite_id, model_run='glu', timer=None, use_index=USE_LISTING_INDEX):
     """
     Find the lsit of instruments used in the DA by looking to see which ODB2 files are present in MASS.
     Assume the cycle chosen represents all cycles, and extract the list of instruments from the filepaths from
@@ -101,6 +287,8 @@ def find_obs_files(cycle_str, suite_id, model_run='glu'):
     Assumes file format in the style of: 'moose:/devfc/[suite-id]/adhoc.file/20190615T0600Z_glu_groundgps_odb2.gz'
     :param cycle_str: (str: cycle.strftime('%Y%m%dT%H%MZ')) cycle to get the instruments from
     :keyword model_run: ('glu' or 'glm')
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword use_index: answer from the suite's MASS listing index (see mass_listing.py) instead of a moo ls
     :return: instrument_list: (list of strings) instrument list that get used in the DA
     """
 
@@ -108,70 +296,498 @@ def find_obs_files(cycle_str, suite_id, model_run='glu'):
     if model_run not in ['glu', 'glm']:
         raise ValueError('model_run keyword argument set as {0}. Must be set as \'glu\' or'
                          ' \'glm\''.format(model_run))
+    if use_index:
+        with limited('mass'), stage_timing.stage(timer, 'listing_index') as record:
+            files = [moosepath for moosepath, _ in mass_listing.cycle_files(suite_id, cycle_str, model_run=model_run,
+                                                                            index_dir=LISTING_INDEX_DIR)
+                     if moosepath.endswith('_odb2.gz')]
+            record['rows'] = len(files)
+        return files
+
     #/opt/ukmo/mass/moose-client-wrapper/bin/
     s = 'moo ls moose:/devfc/'+suite_id+'/adhoc.file/' + cycle_str + '_' + model_run + '*_odb2.gz'
-    out = subprocess.check_output(s, shell=True)  # output all in one string
-    # split filepaths by \n. End element is empty therefore do not keep it in the split
-    files = out.split('\n')[:-1]
+    with limited('mass'), stage_timing.stage(timer, 'moo_ls') as record:
+        out = subprocess.check_output(s, shell=True)  # output all in one string
+        # split filepaths by \n. End element is empty therefore do not keep it in the split
+        files = out.split('\n')[:-1]
+        record['rows'] = len(files)
 
     return files
 
 
-def moo_ODB2_get_gunzip_file(moosepath, destdir):
+def moo_ODB2_get_gunzip_file(moosepath, destdir, timer=None):
     """
     moo get and gunzip an ODB2 file from MASS.
     :param moosepath: full path of ODB2 file on MASS
     :param destdir: where to put the file
+    :keyword timer: (dict) stage timer, see stage_timing.py
     :return: filepath_unzipped: unzipped filepath
     """
 
     # download ODB stats into the correct directory
-    s = 'moo get ' + moosepath + ' ' + destdir
-    os.system(s)
-
-    # get the filepath after extraction from MASS
-    filepath = scratchdir + '/' + moosepath.split('/')[-1]
+    filepath = moo_ODB2_get_file(moosepath, destdir, timer=timer)
 
     ## assume all observation files are present with each cycle
     ## ungzip them
-    os.system('gunzip ' + filepath)
+    return gunzip_obs_file(filepath, timer=timer)
+
+
+def gunzip_obs_file(filepath, timer=None):
+    """
+    gunzip a downloaded ODB2 file
+    :param filepath: gzipped filepath
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :return: filepath_unzipped: unzipped filepath
+    """
+
+    with limited('disk'), stage_timing.stage(timer, 'gunzip', filepath.split('_')[-2]) as record:
+        os.system('gunzip ' + filepath)
 
-    # name of file without the .gz extension
-    filepath_unzipped = filepath[:-3]
+        # name of file without the .gz extension
+        filepath_unzipped = filepath[:-3]
+        if os.path.exists(filepath_unzipped):
+            record['bytes'] = os.path.getsize(filepath_unzipped)
 
     return filepath_unzipped
 
 
-def sql_ODB2_select_query(region_bounds, regions, filepath):
+def moo_ODB2_get_file(moosepath, destdir, timer=None):
+    """
+    moo get an ODB2 file from MASS, but keep it gzipped, ready to be stream decompressed.
+    :param moosepath: full path of ODB2 file on MASS
+    :param destdir: where to put the file
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :return: filepath: gzipped filepath
+    """
+
+    # download ODB stats into the correct directory
+    s = 'moo get ' + moosepath + ' ' + destdir
+    filepath = destdir + '/' + moosepath.split('/')[-1]
+    with limited('mass'), stage_timing.stage(timer, 'moo_get', moosepath.split('_')[-2]) as record:
+        os.system(s)
+        if os.path.exists(filepath):
+            record['bytes'] = os.path.getsize(filepath)
+
+    return filepath
+
+
+def fetch_obs_file(moosepath, destdir, timer=None):
+    """
+    Get an ODB2 file from MASS, ready to be queried. Kept gzipped if STREAM_DECOMPRESS is set, else gunzipped.
+    :param moosepath: full path of ODB2 file on MASS
+    :param destdir: where to put the file
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :return: filepath: ODB2 filepath (.gz if it is to be stream decompressed)
+    """
+
+    if STREAM_DECOMPRESS:
+        return moo_ODB2_get_file(moosepath, destdir, timer=timer)
+    else:
+        return moo_ODB2_get_gunzip_file(moosepath, destdir, timer=timer)
+
+
+def gzip_complete(filepath):
+    """
+    Is a gzipped file whole? It is decompressed to the end (without keeping the data), which checks the CRC and length
+    in its trailer, so a file moo has not finished writing is caught before it is queried.
+    :param filepath: gzipped filepath
+    :return: (bool)
+    """
+
+    try:
+        with gzip.open(filepath, 'rb') as f:
+            while len(f.read(STREAM_CHUNK_SIZE)) > 0:
+                pass
+    except (IOError, OSError, EOFError, zlib.error):
+        return False
+
+    return True
+
+
+def moo_ODB2_get_files_batched(moosepaths, destdir, timer=None, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    moo get several ODB2 files from MASS in one request, e.g. all of a cycle's files (or several cycles' files), to pay
+    the MASS request overhead only once. Each file is handed back as soon as it has arrived, so it can be processed
+    while the rest are still coming.
+
+    A file has arrived once moo has finished with no error. Before that, a file that has stopped growing while moo has
+    started on another is only handed back once its gzip trailer checks out (see gzip_complete()), as moo may still be
+    writing it. If the request fails part way, the files it did not get whole are requested again one at a time, so
+    one bad file does not lose the whole cycle, and a partial file is never queried.
+    :param moosepaths: full paths of the ODB2 files on MASS
+    :param destdir: where to put the files
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword poll_interval: seconds between looking for arrived files
+    :return: generator of (moosepath, filepath) in the order the files arrive. filepath is None if the file could not
+        be got from MASS.
+    """
+
+    if len(moosepaths) == 0:
+        return
+
+    filepaths = {m: destdir + '/' + m.split('/')[-1] for m in moosepaths}
+    # moo get will not overwrite files, e.g. left behind by an earlier run that died
+    for filepath in filepaths.itervalues():
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    # the MASS slot is held for the whole request, as moo is busy until the last file
+    with limited('mass'):
+        print '... ... moo get ' + str(len(moosepaths)) + ' files in one request'
+        batch_start = time.time()
+        proc = subprocess.Popen(['moo', 'get'] + list(moosepaths) + [destdir])
+
+        try:
+            pending = list(moosepaths)
+            sizes = {}
+            first_seen = {}
+            # size of each file when it last failed gzip_complete(), so it is only checked again once it has changed
+            checked = {}
+            while len(pending) > 0:
+
+                # check whether moo has finished before looking at the files, so any file present once it has
+                #   succeeded is whole
+                finished = proc.poll() is not None
+                succeeded = finished and proc.returncode == 0
+
+                ready = []
+                for m in pending:
+                    if not os.path.exists(filepaths[m]):
+                        continue
+                    first_seen.setdefault(m, len(first_seen))
+                    size = os.path.getsize(filepaths[m])
+                    stable = sizes.get(m) == size
+                    sizes[m] = size
+                    moved_on = any([n > first_seen[m] for n in first_seen.itervalues()])
+                    if succeeded:
+                        ready += [m]
+                    elif (finished or (stable and moved_on)) and checked.get(m) != size:
+                        with stage_timing.stage(timer, 'gzip_check', m.split('_')[-2]) as record:
+                            record['bytes'] = size
+                            if gzip_complete(filepaths[m]):
+                                ready += [m]
+                            else:
+                                checked[m] = size
+
+                for m in ready:
+                    pending.remove(m)
+                    stage_timing.record_since(timer, 'moo_get', batch_start, obs=m.split('_')[-2], bytes=sizes[m])
+                    yield m, filepaths[m]
+
+                if finished:
+                    if len(pending) > 0:
+                        print '... ... moo get request returned ' + str(proc.returncode) + ' without ' + \
+                              str(len(pending)) + ' whole files. Getting them one at a time'
+                    for m in pending:
+                        # moo get will not overwrite the partial file
+                        if os.path.exists(filepaths[m]):
+                            os.remove(filepaths[m])
+                        filepath = moo_ODB2_get_file(m, destdir, timer=timer)
+                        if os.path.exists(filepath) and not gzip_complete(filepath):
+                            print '... ... ' + m + ' is not a whole gzip file after getting it again'
+                            os.remove(filepath)
+                        yield m, filepath if os.path.exists(filepath) else None
+                    break
+
+                time.sleep(poll_interval)
+        finally:
+            # stop moo if the caller gave up part way
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+
+        stage_timing.record_since(timer, 'moo_get_batch', batch_start, rows=len(moosepaths),
+                                  bytes=sum(sizes.itervalues()))
+
+
+def gunzip_to_fifo(gz_filepath, fifo_dir):
+    """
+    Decompress a gzipped file into a FIFO (named pipe) in a background thread, so that a reader (e.g. odb sql)
+    gets the uncompressed data without it ever being written to disk.
+
+    The writer blocks until the reader opens the FIFO. Use close_fifo() once the reader is done with it.
+    :param gz_filepath: gzipped filepath
+    :param fifo_dir: directory to create the FIFO in
+    :return: fifo: (dict) 'path' of the FIFO, the writer 'thread' and the 'errors' the writer raised, if any
+    """
+
+    fifo_path = tempfile.mkdtemp(dir=fifo_dir) + '/' + os.path.basename(gz_filepath)[:-3]
+    os.mkfifo(fifo_path)
+    fifo = {'path': fifo_path, 'thread': None, 'errors': []}
+
+    def writer():
+        try:
+            # open the FIFO first (blocks until the reader opens the other end) so that the reader is never left
+            #   waiting on a writer that failed to open the gzip file
+            with open(fifo_path, 'wb') as dst:
+                with gzip.open(gz_filepath, 'rb') as src:
+                    shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+        except (IOError, OSError, EOFError) as e:
+            # corrupt or truncated gzip file, or the reader stopped reading (broken pipe)
+            fifo['errors'].append(e)
+
+    fifo['thread'] = threading.Thread(target=writer)
+    fifo['thread'].daemon = True
+    fifo['thread'].start()
+
+    return fifo
+
+
+def close_fifo(fifo):
+    """
+    Wait for the FIFO writer to finish and remove the FIFO. If the reader never opened the FIFO, or stopped
+    reading it early, the writer is released by briefly opening the read end, so it fails with a broken pipe.
+    :param fifo: (dict) output from gunzip_to_fifo()
+    :return:
+    """
+
+    while fifo['thread'].is_alive():
+        fd = os.open(fifo['path'], os.O_RDONLY | os.O_NONBLOCK)
+        os.close(fd)
+        fifo['thread'].join(1.0)
+
+    os.remove(fifo['path'])
+    os.rmdir(os.path.dirname(fifo['path']))
+
+    return
+
+
+def sql_ODB2_select_query(region_bounds, regions, filepath, grid_resolution=None):
 
     """
     Create and carry out SQL query on ODB dataase
     :param region_bounds: the SQL query part that has the boundaries of the region in it
     :param regions: the regions that match region_bounds
     :param filepath: ODB2 filepath
-    :return: out_array: (numpy array, dtype=float) output from the SQL query
+    :keyword grid_resolution: (float) if given, also group the counts by lat/lon grid cell of this size [degrees]
+    :return: out_array: (numpy array, dtype=int64) output from the SQL query. With grid_resolution, the columns are:
+        active, surplus, lat cell, lon cell, count, then one for each region
     """
 
     # construct statement from regions_boundaries, based on the list order of [regions],
     #  to ensure the SQL output and regions list match up
     loc_bound_query_part = ', '.join([region_bounds[loc] for loc in regions])
+    # selecting the grid cells groups the sums by cell as well as by flag
+    if grid_resolution is not None:
+        loc_bound_query_part = 'floor(lat/' + repr(grid_resolution) + '), floor(lon/' + repr(grid_resolution) + \
+                               '), count(*), ' + loc_bound_query_part
     # Add: where(entryno=1) for unique observations if you want to (some obs come in twice and get updated...)
     #   hopefully having entro=1 wont screw up the 'rejected' query by removing overlapping obs ahead of time...
     # statement = 'odb sql \'select datum_status.active, ops_report_flags.surplus, ' + loc_bound_query_part + ' where(entryno=1) \' -i ' + filepath
     #   do not use where(entryno=1) as later duplicate observations (entryno !=1), might become the active observation
     statement = 'odb sql \'select datum_status.active, ops_report_flags.surplus, ' + loc_bound_query_part + '\' -i ' + filepath
-    out = subprocess.check_output(statement, shell=True)
 
-    # ignore the input statement command and the empty string at the end
-    out_split = out.split('\n')[1:-1]
-    # in each row, remove leading spaces and split by tab to reveal the parts of each query combination
-    #   e.g. datum_status.active=1 and ops_report_flags.surplus=1, where surplus is the same as being
-    #   thinned
-    out_array = np.array([n.replace(' ', '').split('\t') for n in out_split], dtype=np.float16)
+    # parse the output as it streams in, rather than holding all of it in memory at once
+    # columns are: datum_status.active, ops_report_flags.surplus, then one for each region, in the order of [regions]
+    n_cols = len(regions) + (2 if grid_resolution is None else 5)
+    proc = subprocess.Popen(statement, shell=True, stdout=subprocess.PIPE)
+    try:
+        if BOUNDED_MEMORY:
+            # key columns: the flags, and the grid cells if there are any
+            out_array = aggregate_ODB2_sql_output(proc.stdout, n_cols, 2 if grid_resolution is None else 4)
+        else:
+            out_array = parse_ODB2_sql_output(proc.stdout, n_cols)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, statement)
+
+    return out_array
+
+
+def parse_ODB2_sql_output(lines, n_cols, chunk_rows=SQL_PARSE_CHUNK_ROWS):
+
+    """
+    Parse the output of odb sql into an exact integer array, chunk by chunk as the rows stream in. Each chunk is
+    parsed in one go by numpy and copied into a preallocated array, which is doubled in size when it fills up.
+    :param lines: iterable of output lines, e.g. the stdout of the odb sql process. The first line is the header.
+    :param n_cols: number of columns in each row
+    :keyword chunk_rows: number of rows to parse at a time
+    :return: out_array: (numpy array, dtype=int64, shape=(rows, n_cols)) output from the SQL query
+    """
+
+    lines = iter(lines)
+
+    # ignore the input statement command
+    next(lines, None)
+
+    out_array = np.empty((chunk_rows, n_cols), dtype=np.int64)
+    n_rows = 0
+
+    while True:
+
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if len(chunk) == 0:
+            break
+
+        chunk_values = parse_ODB2_sql_chunk(chunk, n_cols)
+
+        # grow the array if needed
+        if n_rows + chunk_values.shape[0] > out_array.shape[0]:
+            grown = np.empty((max(2 * out_array.shape[0], n_rows + chunk_values.shape[0]), n_cols), dtype=np.int64)
+            grown[:n_rows] = out_array[:n_rows]
+            out_array = grown
+
+        out_array[n_rows:n_rows + chunk_values.shape[0]] = chunk_values
+        n_rows += chunk_values.shape[0]
+
+    return out_array[:n_rows]
+
+
+def parse_ODB2_sql_chunk(chunk, n_cols):
+
+    """
+    Parse a chunk of odb sql output rows in one go
+    :param chunk: (list) output lines
+    :param n_cols: number of columns in each row
+    :return: (numpy array, dtype=float64, shape=(rows, n_cols))
+    """
+
+    # rows are tab separated with leading spaces, all of which count as whitespace separators here.
+    # Counts are parsed as float64 (exact up to 2**53) and not float16, which is only exact up to 2048
+    values = np.fromstring(''.join(chunk), dtype=np.float64, sep=' ')
+
+    # np.fromstring stops without an error at the first token that is not a number (e.g. NULL, or an odb warning
+    #   line), so check every value of every row was parsed. The file then goes into the bad file log.
+    n_rows = sum([1 for line in chunk if line.strip()])
+    if values.size != n_rows * n_cols:
+        raise ValueError('odb sql output has ' + str(values.size) + ' numbers in ' + str(n_rows) + ' rows of ' +
+                         str(n_cols) + ' columns')
+
+    return values.reshape(-1, n_cols)
+
+
+def query_memory_plan(n_cols, budget_mb=QUERY_MEMORY_BUDGET_MB):
+
+    """
+    Split a memory budget between the rows being parsed and the groups summed so far, for
+    aggregate_ODB2_sql_output() and the numpy reader. The bytes per row are rough upper estimates of the copies made:
+    for a parsed row, the line string, its joined copy, the float64 row and the sorting copies; for a group, the group
+    and the copies made while summing the groups up together.
+    :param n_cols: number of columns in each row
+    :keyword budget_mb: memory budget [MB]
+    :return: chunk_rows: rows to parse at a time, max_group_rows: groups to hold before summing them up together
+    """
+
+    half_budget = budget_mb * 1024 ** 2 / 2
+    chunk_rows = max(1000, half_budget // (64 + 56 * n_cols))
+    max_group_rows = max(1000, half_budget // (8 + 4 * 8 * n_cols))
+
+    return int(chunk_rows), int(max_group_rows)
+
+
+def aggregate_ODB2_sql_output(lines, n_cols, n_key_cols, budget_mb=QUERY_MEMORY_BUDGET_MB):
+
+    """
+    Parse the output of odb sql and sum its rows by their key columns, chunk by chunk as the rows stream in, so no
+    more than one chunk of rows is held at a time. The groups of each chunk are kept until there are more than the
+    budget allows, and are then summed up together. The number of groups is set by the flags (and grid cells) and
+    not by the size of the file, so the memory used stays within about budget_mb.
+    Every use of the query output sums its rows for each flag, so the sums are the same as from the full output.
+    :param lines: iterable of output lines, e.g. the stdout of the odb sql process. The first line is the header.
+    :param n_cols: number of columns in each row
+    :param n_key_cols: number of key columns, at the start of each row, e.g. 2 for active and surplus
+    :keyword budget_mb: memory budget [MB]
+    :return: out_array: (numpy array, dtype=int64, shape=(groups, n_cols)) one row for each distinct key, sorted by key
+    """
+
+    chunk_rows, max_group_rows = query_memory_plan(n_cols, budget_mb)
+
+    lines = iter(lines)
+
+    # ignore the input statement command
+    next(lines, None)
+
+    # (keys, sums) of the chunks parsed so far
+    keys_parts = []
+    sums_parts = []
+    n_group_rows = 0
+
+    while True:
+
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if len(chunk) == 0:
+            break
+
+        chunk_values = parse_ODB2_sql_chunk(chunk, n_cols)
+        del chunk
+        chunk_keys, chunk_sums = odb2_reader.sum_groups(chunk_values[:, :n_key_cols], chunk_values[:, n_key_cols:])
+        del chunk_values
+
+        keys_parts += [chunk_keys]
+        sums_parts += [chunk_sums]
+        n_group_rows += chunk_keys.shape[0]
+        if n_group_rows > max_group_rows:
+            compact_keys, compact_sums = odb2_reader.sum_groups(np.concatenate(keys_parts), np.concatenate(sums_parts))
+            keys_parts, sums_parts = [compact_keys], [compact_sums]
+            n_group_rows = compact_keys.shape[0]
+
+    if len(keys_parts) == 0:
+        return np.zeros((0, n_cols), dtype=np.int64)
+
+    keys, sums = odb2_reader.sum_groups(np.concatenate(keys_parts), np.concatenate(sums_parts))
+
+    return np.column_stack([keys, sums]).astype(np.int64)
+
+
+def ODB2_select_query(region_bounds, regions, filepath, grid_resolution=None):
+
+    """
+    Carry out the flag and region query on an ODB2 file, with the backend set by QUERY_BACKEND. Gzipped files are
+    stream decompressed into the query.
+    :param region_bounds: the SQL query part that has the boundaries of the region in it
+    :param regions: the regions that match region_bounds
+    :param filepath: ODB2 filepath, either unzipped or .gz
+    :keyword grid_resolution: (float) if given, also group the counts by lat/lon grid cell of this size [degrees]
+    :return: out_array: (numpy array, dtype=int64) columns: active, surplus, then one for each region. With
+        grid_resolution: active, surplus, lat cell, lon cell, count, then one for each region
+    """
+
+    if QUERY_BACKEND == 'numpy':
+        # the reader decompresses .gz files itself, so no FIFO is needed
+        try:
+            if BOUNDED_MEMORY and grid_resolution is not None:
+                return odb2_reader.odb2_select_query(region_bounds, regions, filepath, grid_resolution=grid_resolution,
+                                                     max_group_rows=query_memory_plan(len(regions) + 5)[1])
+            return odb2_reader.odb2_select_query(region_bounds, regions, filepath, grid_resolution=grid_resolution)
+        except odb2_reader.ODB2FormatError as e:
+            print '... ... ... numpy ODB2 reader failed (' + str(e) + '), falling back to odb sql'
+
+    if filepath.endswith('.gz'):
+        # stream decompress the file straight into the query
+        fifo = gunzip_to_fifo(filepath, FIFO_DIR)
+        try:
+            out_array = sql_ODB2_select_query(region_bounds, regions, fifo['path'], grid_resolution=grid_resolution)
+        finally:
+            close_fifo(fifo)
+        # a truncated stream can still give a valid looking query output, so treat it as a bad file
+        if len(fifo['errors']) > 0:
+            raise fifo['errors'][0]
+    else:
+        out_array = sql_ODB2_select_query(region_bounds, regions, filepath, grid_resolution=grid_resolution)
 
     return out_array
 
 
+def collapse_grid_query(grid_array):
+
+    """
+    Sum the gridded query output over the grid cells, giving the output of the query without the grid
+    :param grid_array: (numpy array) columns: active, surplus, lat cell, lon cell, count, then one for each region
+    :return: out_array: (numpy array, dtype=int64) columns: active, surplus, then one for each region
+    """
+
+    if grid_array.shape[0] == 0:
+        return np.zeros((0, grid_array.shape[1] - 3), dtype=np.int64)
+
+    combos, combo_i = np.unique(grid_array[:, :2], axis=0, return_inverse=True)
+    region_sums = [np.bincount(combo_i, weights=grid_array[:, j], minlength=len(combos))
+                   for j in range(5, grid_array.shape[1])]
+
+    return np.column_stack([combos] + region_sums).astype(np.int64)
+
+
 def file_error_write(obs_file, log_file):
 
     """
@@ -188,14 +804,12 @@ def file_error_write(obs_file, log_file):
     return
 
 
-def extract_flag_data(suite_cycle_stats, out_array, regions, obs_i):
+def flag_row_index(out_array):
 
     """
-    Extract the data from out_array
-    :param suite_cycle_stats:
-    :param regions:
-    :param obs_i:
-    :return:
+    Rows of the query output in each flag
+    :param out_array: query output, with the active and thinned (surplus) columns first
+    :return: flag_idx: (dict) flag: row indices
     """
 
     # find correct row for the extraction - as sometimes some combinations do not exist and the number
@@ -211,6 +825,21 @@ def extract_flag_data(suite_cycle_stats, out_array, regions, obs_i):
                 'thinned': np.where((active_col == 0.0) & (thinned_col == 1.0))[0],  # specific flag for data thinning
                 'thinned_but_active': np.where((active_col == 1.0) & (thinned_col == 1.0))[0]}
 
+    return flag_idx
+
+
+def extract_flag_data(suite_cycle_stats, out_array, regions, obs_i):
+
+    """
+    Extract the data from out_array
+    :param suite_cycle_stats:
+    :param regions:
+    :param obs_i:
+    :return:
+    """
+
+    flag_idx = flag_row_index(out_array)
+
     # extract and sum up all the relevent columns, for each region and flag where necessary.
     # Some flags combinations are missing from some files, therefore this will set them as np.nan
     for flag_i, flag_idx_i in flag_idx.iteritems():
@@ -259,135 +888,729 @@ def create_metadata_num_files(obs_list, stats, flags, regions):
     return meta
 
 
-if __name__ == '__main__':
+def query_obs_file(obd_odb2_filepath, obs_i, suite_cycle_stats, log_file_path, timer=None, checkpoint_dir=None,
+                   grid_dir=None):
+    """
+    Carry out the SQL query on a downloaded ODB2 file and extract its flag data into suite_cycle_stats.
+    If the file is corrupt the queries will fail: the bad file is written to the log instead. The file is removed
+    once it is done with (whether a good or bad file).
+    :param obd_odb2_filepath: ODB2 filepath, either unzipped or .gz
+    :param obs_i: observation name, e.g. 'iasi'
+    :param suite_cycle_stats: cycle's stats dictionary to be filled
+    :param log_file_path: log file for bad files
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword checkpoint_dir: the cycle's checkpoint directory, to checkpoint the instrument's statistics in (None: no
+        checkpoint)
+    :keyword grid_dir: the cycle's directory of instrument count grids, to save the instrument's grids in (None: no
+        grids)
+    :return:
+    """
 
-    # ==============================================================================
-    # Process
-    # ==============================================================================
+    try:
 
-    # loop through all suite, then plot the cross-suite statistics after the looping
-    # for suite_id in  ['u-bo976']: # suite_list.iterkeys():  # if running multiple suites in one script (offline)
-    for suite_id in suite_iter_list:  # online
+        print '... ... ... working on SQL queries: '+obs_i
 
-        print 'working suite-id: '+suite_id
+        # count number of observations that were 'active' and were'thinned' in the data assimilation,
+        #   for this ob type, cycle, suite.
+        # Pro-tip! Have as much as you can in a single query to save computation time
+        with limited('odb'), stage_timing.stage(timer, 'query', obs_i) as record:
+            if os.path.exists(obd_odb2_filepath):
+                record['bytes'] = os.path.getsize(obd_odb2_filepath)
+            if grid_dir is not None:
+                grid_array = ODB2_select_query(region_bounds, regions, obd_odb2_filepath,
+                                               grid_resolution=GRID_RESOLUTION)
+                out_array = collapse_grid_query(grid_array)
+                record['rows'] = grid_array.shape[0]
+            else:
+                out_array = ODB2_select_query(region_bounds, regions, obd_odb2_filepath)
+                record['rows'] = out_array.shape[0]
 
-        # suite id specific directories
-        scratchdir = SCRATCH + '/ODB2/'+suite_id
-        logdir = scratchdir + '/log'
-        numpysavedir = DATADIR + '/R2O_projects/update_cutoff/data/cycle_sql_stats/'+suite_id
+        print '... ... ... ODB2_select_query successful: '+obs_i
 
-        # ensure scratch and save subdirectories are present for the ODB stats to be copied into, before further processing
-        for d in [scratchdir, logdir, numpysavedir]:
-            if not os.path.exists(d):
-                os.system('mkdir -p '+d)
+        # extract out data based on the flags
+        extract_flag_data(suite_cycle_stats, out_array, regions, obs_i)
 
-        # Go through each cycle in turn
-        for c, cycle_c_str in enumerate(cycle_range_str):
+        print '... ... ... extract_flag_data successful: '+obs_i
+
+        # saved before the checkpoint, so a checkpointed instrument always has its grids
+        with limited('disk'):
+            if grid_dir is not None:
+                grid_counts.save_instrument_grid(grid_dir, obs_i, grid_counts.instrument_grid(
+                    grid_array, flag_row_index(grid_array), GRID_RESOLUTION))
+
+            if checkpoint_dir is not None:
+                cycle_checkpoint.save_instrument(checkpoint_dir, obs_i, suite_cycle_stats)
+
+    except:
+
+        # write bad filename to the log
+        file_error_write(obd_odb2_filepath, log_file_path)
+
+    # remove file once its done with (whether a good or bad file)
+    if os.path.exists(obd_odb2_filepath):
+        os.remove(obd_odb2_filepath)
+
+    return
+
+
+def process_obs_files_serial(obs_filelist, obs_list, suite_cycle_stats, scratchdir, log_file_path, timer=None,
+                             checkpoint_dir=None, grid_dir=None):
+    """
+    Download and query each observation file in turn, one after the other.
+    :param obs_filelist: moose paths of the ODB2 files
+    :param obs_list: observation names, paired with obs_filelist
+    :param suite_cycle_stats: cycle's stats dictionary to be filled
+    :param scratchdir: where to put the downloaded files
+    :param log_file_path: log file for bad files
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword checkpoint_dir: the cycle's checkpoint directory (None: no checkpoints)
+    :keyword grid_dir: the cycle's directory of instrument count grids (None: no grids)
+    :return:
+    """
+
+    # get ODB data for each instrument in turn, as the files can be very large!
+    # loop through its moose path and the paired observation name
+    for obs_moosepath_i, obs_i in zip(obs_filelist, obs_list):
+
+        print '... ... ('+str(obs_list.index(obs_i)+1)+'/'+str(len(obs_list))+') working on obs: '+obs_i
+
+        obd_odb2_filepath = fetch_obs_file(obs_moosepath_i, scratchdir, timer=timer)
 
-            # create empty log file that will be filled with filepaths of bad files, if any are present
-            run_time_str = dt.datetime.now().strftime('%Y%m%dT%H%M')
-            log_file_path = logdir + '/' + suite_id + '_'+ cycle_c_str + '_obs_anaylse_log.txt'
-            with open(log_file_path, 'w') as log_file:
-                log_file.write('log for obs_analyse - ran at ' + run_time_str + '\n')
-
-            # create numpy save path here to check whether it already exists. If so and OVERRIDE_CYCLE_STATS
-            # is set to True, then skip this cycle.
-            # only continue if saves statistics do no exist already, or are to be overwritten
-            numpysavepath = numpysavedir + '/' + cycle_c_str + '_'+suite_id+'_stats.npy'
-            if os.path.exists(numpysavepath) and (OVERRIDE_CYCLE_STATS == False):
-                print numpysavepath + ' already exists! Skipping this cycle\n\n\n'
-                exit(0)
-
-            print '... working cycle: '+cycle_c_str
-
-            # create cycle's stats array that will be numpy saved!
-            # After sql queries for each obs type, will eventually be: suite_cycle_stats[flag_i][region_i][obs] = value
-            # Add an extra entry for 'GLOBAL' on top of the regions, as although it doesn't get called in the SQL query,
-            #   it is calculated at the end separately 
-            suite_cycle_stats = {flag_i:
-                                     {region_i: {} for region_i in regions + ['GLOBAL']}
-                                 for flag_i in flags}
-
-            # get obs filepaths for this cycle
-            # use 'glu' (update run) as this is where the number of obs going in is varying, despite the impact being
-            #   on 'glm' (main run).
-            obs_filelist = find_obs_files(cycle_c_str, suite_id, model_run='glu')
-
-            # are there any observations files for this cycle? Cycle may not have run yet
-            if len(obs_filelist) == 0:
-                print 'no observation files present for cycle: '+cycle_c_str+'\n\n\n'
+        query_obs_file(obd_odb2_filepath, obs_i, suite_cycle_stats, log_file_path, timer=timer,
+                       checkpoint_dir=checkpoint_dir, grid_dir=grid_dir)
+
+    return
+
+
+def query_worker(query_queue, stats_lock):
+    """
+    Query worker thread: query the files from query_queue until it gets None, merging each file's results into its
+    cycle's suite_cycle_stats under stats_lock. The workers can be shared by several cycles.
+    :param query_queue: (Queue) of (filepath, obs name, suite_cycle_stats, log file path, stage timer, checkpoint
+        directory, grid directory) items
+    :param stats_lock: (threading.Lock)
+    """
+
+    while True:
+        item = query_queue.get()
+        if item is None:
+            query_queue.task_done()
+            return
+        obd_odb2_filepath, obs_i, suite_cycle_stats, log_file_path, timer, checkpoint_dir, grid_dir = item
+        try:
+            # each worker writes to a different obs_i entry, but the GLOBAL totals loop over all the flags
+            with stats_lock:
+                worker_stats = {flag_i: {region_i: {} for region_i in region_data}
+                                for flag_i, region_data in suite_cycle_stats.iteritems()}
+            query_obs_file(obd_odb2_filepath, obs_i, worker_stats, log_file_path, timer=timer,
+                           checkpoint_dir=checkpoint_dir, grid_dir=grid_dir)
+            with stats_lock:
+                for flag_i, region_data in worker_stats.iteritems():
+                    for region_i, obs_data in region_data.iteritems():
+                        suite_cycle_stats[flag_i][region_i].update(obs_data)
+        finally:
+            # lets Queue.join() wait for all the files put so far
+            query_queue.task_done()
+
+
+def process_obs_files_pipelined(obs_filelist, obs_list, suite_cycle_stats, scratchdir, log_file_path,
+                                num_fetch_workers=NUM_FETCH_WORKERS, num_query_workers=NUM_QUERY_WORKERS,
+                                timer=None, checkpoint_dir=None, grid_dir=None):
+    """
+    Download and query the observation files as a pipeline, so the network and CPU are both kept busy: a pool of
+    fetch workers moo get (and gunzip, unless streaming) the files, and hand them over to a pool of query workers
+    running the SQL queries. The hand over queue is bounded so the fetch workers cannot run too far ahead and fill
+    up scratch. Each worker's results are merged into suite_cycle_stats under a lock, in the same way as the serial version.
+    :param obs_filelist: moose paths of the ODB2 files
+    :param obs_list: observation names, paired with obs_filelist
+    :param suite_cycle_stats: cycle's stats dictionary to be filled
+    :param scratchdir: where to put the downloaded files
+    :param log_file_path: log file for bad files
+    :keyword num_fetch_workers: (int) number of concurrent moo get + gunzip workers
+    :keyword num_query_workers: (int) number of concurrent odb sql workers
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword checkpoint_dir: the cycle's checkpoint directory (None: no checkpoints)
+    :keyword grid_dir: the cycle's directory of instrument count grids (None: no grids)
+    :return:
+    """
+
+    fetch_queue = Queue.Queue()
+    query_queue = Queue.Queue(maxsize=num_query_workers)
+    stats_lock = threading.Lock()
+
+    for i, (obs_moosepath_i, obs_i) in enumerate(zip(obs_filelist, obs_list)):
+        fetch_queue.put((i, obs_moosepath_i, obs_i))
+    # one stop sentinel for each fetch worker
+    for _ in range(num_fetch_workers):
+        fetch_queue.put(None)
+
+    def fetch_worker():
+        while True:
+            item = fetch_queue.get()
+            if item is None:
+                return
+            i, obs_moosepath_i, obs_i = item
+            print '... ... ('+str(i+1)+'/'+str(len(obs_list))+') fetching obs: '+obs_i
+            # a file that can not be fetched (e.g. the gunzip fails) goes in the bad file log, and the worker carries
+            #   on with the next one
+            try:
+                obd_odb2_filepath = fetch_obs_file(obs_moosepath_i, scratchdir, timer=timer)
+            except Exception as e:
+                print '... ... could not fetch obs: '+obs_i+': '+repr(e)
+                file_error_write(obs_moosepath_i, log_file_path)
+                gz_filepath = scratchdir + '/' + obs_moosepath_i.split('/')[-1]
+                for filepath in [gz_filepath, gz_filepath[:-3]]:
+                    if os.path.exists(filepath):
+                        os.remove(filepath)
                 continue
+            query_queue.put((obd_odb2_filepath, obs_i, suite_cycle_stats, log_file_path, timer, checkpoint_dir,
+                             grid_dir))
+
+    fetch_threads = [suite_thread(fetch_worker) for _ in range(num_fetch_workers)]
+    query_threads = [suite_thread(query_worker, args=(query_queue, stats_lock)) for _ in range(num_query_workers)]
+    for t in fetch_threads + query_threads:
+        t.daemon = True
+        t.start()
+
+    # once all files are fetched, tell the query workers to stop after the remaining files are queried
+    for t in fetch_threads:
+        t.join()
+    for _ in range(num_query_workers):
+        query_queue.put(None)
+    for t in query_threads:
+        t.join()
+
+    return
 
-            # Instrument is the 2nd to last entry. Extract for all files at once as they follow the same naming convention
-            obs_list = [f.split('_')[-2] for f in obs_filelist]
 
-            ##  does this cycle exist
+def process_obs_files_batched(obs_filelist, obs_list, suite_cycle_stats, scratchdir, log_file_path,
+                              num_query_workers=NUM_QUERY_WORKERS, timer=None, checkpoint_dir=None, grid_dir=None):
+    """
+    Get all the observation files from MASS in a single moo get request, and query each file as soon as it arrives
+    with a pool of query workers. Files that could not be got from MASS are written to the bad file log.
+    :param obs_filelist: moose paths of the ODB2 files
+    :param obs_list: observation names, paired with obs_filelist
+    :param suite_cycle_stats: cycle's stats dictionary to be filled
+    :param scratchdir: where to put the downloaded files
+    :param log_file_path: log file for bad files
+    :keyword num_query_workers: (int) number of concurrent odb sql workers
+    :keyword timer: (dict) stage timer, see stage_timing.py
+    :keyword checkpoint_dir: the cycle's checkpoint directory (None: no checkpoints)
+    :keyword grid_dir: the cycle's directory of instrument count grids (None: no grids)
+    :return:
+    """
 
-            # get ODB data for each instrument in turn, as the files can be very large!
-            # loop through its moose path and the paired observation name
-            for obs_moosepath_i, obs_i in zip(obs_filelist, obs_list):
+    obs_names = dict(zip(obs_filelist, obs_list))
+
+    query_queue = Queue.Queue()
+    stats_lock = threading.Lock()
+    query_threads = [suite_thread(query_worker, args=(query_queue, stats_lock)) for _ in range(num_query_workers)]
+    for t in query_threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for n, (obs_moosepath_i, obd_odb2_filepath) in \
+                enumerate(moo_ODB2_get_files_batched(obs_filelist, scratchdir, timer=timer)):
+            obs_i = obs_names[obs_moosepath_i]
+            print '... ... ('+str(n+1)+'/'+str(len(obs_list))+') arrived obs: '+obs_i
+            if obd_odb2_filepath is None:
+                file_error_write(obs_moosepath_i, log_file_path)
+                continue
+            if not STREAM_DECOMPRESS:
+                obd_odb2_filepath = gunzip_obs_file(obd_odb2_filepath, timer=timer)
+            query_queue.put((obd_odb2_filepath, obs_i, suite_cycle_stats, log_file_path, timer, checkpoint_dir,
+                             grid_dir))
+    finally:
+        # let the query workers finish the files that have arrived
+        for _ in range(num_query_workers):
+            query_queue.put(None)
+        for t in query_threads:
+            t.join()
 
-            # testing
-            # for obs_moosepath_i, obs_i in zip(obs_filelist[:2], obs_list[:2]):
-            #     obs_moosepath_i = obs_filelist[6]
-            #     obs_i = obs_list[6]
+    return
 
-                print '... ... ('+str(obs_list.index(obs_i)+1)+'/'+str(len(obs_list))+') working on obs: '+obs_i
 
-                obd_odb2_filepath = moo_ODB2_get_gunzip_file(obs_moosepath_i, scratchdir)
+def suite_dirs(suite_id):
+    """
+    Scratch, log and save directories of a suite, made if they are not there already.
+    :param suite_id: e.g. 'u-bo796'
+    :return: dirs: (dict) 'scratch', 'log', 'numpysave', 'onlinestats', 'checkpoint' and 'grid' directories
+    """
 
-                # try to do SQL queries but if the file is corrupt, the queries will fail.
-                # If file is corrupt - catch exception, remove bad file and add it to a log of bad file names
-                try:
+    # suite id specific directories
+    dirs = {'scratch': SCRATCH + '/ODB2/'+suite_id,
+            'log': SCRATCH + '/ODB2/'+suite_id + '/log',
+            'numpysave': DATADIR + '/R2O_projects/update_cutoff/data/cycle_sql_stats/'+suite_id,
+            'onlinestats': DATADIR + '/R2O_projects/update_cutoff/data/online_stats',
+            'checkpoint': cycle_checkpoint.CHECKPOINT_DIR + '/' + suite_id,
+            'grid': DATADIR + '/R2O_projects/update_cutoff/data/cycle_grid_counts/'+suite_id}
 
-                    print '... ... ... working on SQL queries'
+    # ensure scratch and save subdirectories are present for the ODB stats to be copied into, before further processing
+    for d in dirs.itervalues():
+        if not os.path.exists(d):
+            os.system('mkdir -p '+d)
 
-                    # count number of observations that were 'active' and were'thinned' in the data assimilation,
-                    #   for this ob type, cycle, suite.
-                    # Pro-tip! Have as much as you can in a single query to save computation time
-                    out_array = sql_ODB2_select_query(region_bounds, regions, obd_odb2_filepath)
+    return dirs
 
-                    print '... ... ... ODB2_select_query successful'
 
-                    # extract out data based on the flags
-                    #print suite_cycle_stats
-                    extract_flag_data(suite_cycle_stats, out_array, regions, obs_i)
-                    #print suite_cycle_stats
+def start_cycle(suite_id, cycle_c_str, dirs):
+    """
+    Set up a cycle: its log file, stage timer and empty statistics, and find its observation files. Instruments
+    checkpointed by an earlier, unfinished run of the cycle are put back into the statistics, and only the rest are
+    left to process.
+    :param suite_id: e.g. 'u-bo796'
+    :param cycle_c_str: (str) cycle e.g. '20190615T0600Z'
+    :param dirs: (dict) from suite_dirs()
+    :return: cycle: (dict) with 'status': 'ok', 'complete' (in the completion manifest and not to be overwritten) or
+        'no_files', and the cycle's 'suite', 'cycle', 'log_file_path', 'numpysavepath', 'checkpoint_dir', 'grid_dir',
+        'timer', 'start', 'stats', 'obs_filelist' and 'obs_list' (all the files), and 'todo_filelist' and 'todo_list' (the files
+        still to process)
+    """
 
-                    print '... ... ... extract_flag_data successful'
+    # create empty log file that will be filled with filepaths of bad files, if any are present
+    run_time_str = dt.datetime.now().strftime('%Y%m%dT%H%M')
+    log_file_path = dirs['log'] + '/' + suite_id + '_'+ cycle_c_str + '_obs_anaylse_log.txt'
+    with open(log_file_path, 'w') as log_file:
+        log_file.write('log for obs_analyse - ran at ' + run_time_str + '\n')
+
+    # only continue if the cycle is not complete already, or its statistics are to be overwritten
+    numpysavepath = dirs['numpysave'] + '/' + cycle_c_str + '_'+suite_id+'_stats.npy'
+    checkpoint_dir = cycle_checkpoint.cycle_checkpoint_dir(dirs['checkpoint'], cycle_c_str)
+    manifest_path = cycle_checkpoint.manifest_filepath(dirs['checkpoint'], suite_id)
+    cycle = {'status': 'ok', 'suite': suite_id, 'cycle': cycle_c_str, 'log_file_path': log_file_path,
+             'numpysavepath': numpysavepath, 'checkpoint_dir': checkpoint_dir, 'timer': None, 'start': time.time(),
+             'grid_dir': (dirs['grid'] + '/' + cycle_c_str + '_parts') if GRID_COUNTS else None}
+    if not OVERRIDE_CYCLE_STATS:
+        # statistics saved before there was a manifest, with no unfinished run since, are complete
+        if os.path.exists(numpysavepath) and not os.path.exists(checkpoint_dir) and \
+                not cycle_checkpoint.is_complete(manifest_path, cycle_c_str):
+            cycle_checkpoint.mark_complete(manifest_path, cycle_c_str, {'stats_file': numpysavepath})
+        if cycle_checkpoint.is_complete(manifest_path, cycle_c_str) and os.path.exists(numpysavepath):
+            print numpysavepath + ' already complete! Skipping this cycle\n\n\n'
+            cycle['status'] = 'complete'
+            return cycle
+
+    print '... working cycle: '+cycle_c_str
+
+    # time each stage of this cycle, for each instrument. Written next to the log file at the end of the cycle
+    if STAGE_TIMING:
+        cycle['timer'] = stage_timing.new_timer(stage_timing.timings_filepath(dirs['log'], suite_id, cycle_c_str),
+                                                suite_id, cycle_c_str)
+
+    # create cycle's stats array that will be numpy saved!
+    # After sql queries for each obs type, will eventually be: suite_cycle_stats[flag_i][region_i][obs] = value
+    # Add an extra entry for 'GLOBAL' on top of the regions, as although it doesn't get called in the SQL query,
+    #   it is calculated at the end separately
+    cycle['stats'] = {flag_i:
+                          {region_i: {} for region_i in regions + ['GLOBAL']}
+                      for flag_i in flags}
+
+    # get obs filepaths for this cycle
+    # use 'glu' (update run) as this is where the number of obs going in is varying, despite the impact being
+    #   on 'glm' (main run).
+    cycle['obs_filelist'] = find_obs_files(cycle_c_str, suite_id, model_run='glu', timer=cycle['timer'])
+
+    # are there any observations files for this cycle? Cycle may not have run yet
+    if len(cycle['obs_filelist']) == 0:
+        print 'no observation files present for cycle: '+cycle_c_str+'\n\n\n'
+        if cycle['timer'] is not None:
+            stage_timing.write_timer(cycle['timer'])
+        cycle['status'] = 'no_files'
+        return cycle
+
+    # Instrument is the 2nd to last entry. Extract for all files at once as they follow the same naming convention
+    cycle['obs_list'] = [f.split('_')[-2] for f in cycle['obs_filelist']]
+
+    # carry on from the instruments an earlier run of this cycle finished, if any
+    done = {}
+    if CHECKPOINT_INSTRUMENTS:
+        done = cycle_checkpoint.load_instruments(checkpoint_dir, cycle['obs_list'])
+        cycle_checkpoint.restore_instruments(cycle['stats'], done)
+        if len(done) > 0:
+            print '... resuming cycle: '+str(len(done))+'/'+str(len(cycle['obs_list']))+' instruments checkpointed'
+    else:
+        cycle['checkpoint_dir'] = None
+    cycle['todo_filelist'] = [f for f, obs_i in zip(cycle['obs_filelist'], cycle['obs_list']) if obs_i not in done]
+    cycle['todo_list'] = [obs_i for obs_i in cycle['obs_list'] if obs_i not in done]
 
-                except:
+    return cycle
 
-                    # write bad filename to the log
-                    file_error_write(obd_odb2_filepath, log_file_path)
 
-                # remove file once its done with (whether a good or bad file)
-                if os.path.exists(obd_odb2_filepath):
-                    os.remove(obd_odb2_filepath)
+def finish_cycle(cycle, dirs):
+    """
+    Once all of a cycle's observation files are processed: compute the totals and metadata, save the cycle's
+    statistics, update the online statistics and write the stage timings.
+    :param cycle: (dict) from start_cycle()
+    :param dirs: (dict) from suite_dirs()
+    :return:
+    """
 
-            print '... ... computing observation totals, across flags'
+    suite_id, cycle_c_str = cycle['suite'], cycle['cycle']
+    suite_cycle_stats, obs_list, timer = cycle['stats'], cycle['obs_list'], cycle['timer']
+
+    print '... ... computing observation totals, across flags'
+
+    # store number of obs files present from MASS and stats, and whether the two values are equal
+    suite_cycle_meta = create_metadata_num_files(obs_list, suite_cycle_stats, flags, regions)
+    obs_used = suite_cycle_stats[flags[0]][regions[0]].keys()
+
+    # after all observation values have been acquired for all the flags, if present
+    # This will make the number of keys in region_i, one more than the number of obs files
+    for flag_i in suite_cycle_stats.iterkeys():
+        for region_i, region_i_data in suite_cycle_stats[flag_i].iteritems():
+            suite_cycle_stats[flag_i][region_i]['all_obs'] = \
+                np.sum([region_i_data[obs_j] for obs_j in region_i_data.iterkeys()])
+
+    print '... ... observation totals completed!'
+
+    # a reprocessed cycle's previous statistics, to take out of the online statistics before they are overwritten
+    previous_cycle_stats = None
+    if ONLINE_STATS and os.path.exists(cycle['numpysavepath']):
+        try:
+            previous_cycle_stats = cycle_stats_file.read_cycle_stats(cycle['numpysavepath'])[0]
+        except Exception as err:
+            print '... ... previous statistics could not be read: ' + str(err)
+
+    # save this suite and cycle's statistics, in the fixed-schema format of cycle_stats_file.py
+    with limited('disk'), stage_timing.stage(timer, 'np_save') as record:
+        cycle_stats_file.save_cycle_stats(cycle['numpysavepath'], suite_cycle_stats, suite_cycle_meta, cycle_c_str,
+                                          flags=flags, regions=regions + ['GLOBAL'])
+        record['bytes'] = os.path.getsize(cycle['numpysavepath'])
+
+    print '... ... '+cycle['numpysavepath']+' saved!'
+
+    # gather the instruments' count grids into the cycle's grid counts file
+    if cycle['grid_dir'] is not None:
+        grid_filepath = grid_counts.cycle_grid_filepath(dirs['grid'], suite_id, cycle_c_str)
+        with limited('disk'), stage_timing.stage(timer, 'grid_save') as record:
+            grid_counts.merge_instrument_grids(cycle['grid_dir'], obs_used, flags, GRID_RESOLUTION, grid_filepath)
+            record['bytes'] = os.path.getsize(grid_filepath)
+        print '... ... '+grid_filepath+' saved!'
+
+    # the cycle is complete: record it, and its checkpoints are no longer needed
+    cycle_checkpoint.mark_complete(cycle_checkpoint.manifest_filepath(dirs['checkpoint'], suite_id), cycle_c_str,
+                                   {'stats_file': cycle['numpysavepath'],
+                                    'number_obs_files_on_mass': suite_cycle_meta['number_obs_files_on_mass'],
+                                    'number_obs_used_in_stats': suite_cycle_meta['number_obs_used_in_stats']})
+    if cycle['checkpoint_dir'] is not None:
+        cycle_checkpoint.clear_checkpoints(cycle['checkpoint_dir'])
+
+    # fold this cycle into the live, trial-level summary statistics
+    if ONLINE_STATS:
+        with limited('disk'), stage_timing.stage(timer, 'online_stats'):
+            online_stats.fold_cycle_into_checkpoint(dirs['onlinestats'] + '/' + suite_id + '_online_stats.npz',
+                                                    suite_cycle_stats, cycle_c_str, flags, regions + ['GLOBAL'],
+                                                    previous_cycle_stats=previous_cycle_stats)
+        print '... ... online summary statistics updated'
+
+    if timer is not None:
+        stage_timing.record_since(timer, 'cycle', cycle['start'], rows=len(obs_list))
+        stage_timing.write_timer(timer)
+        print '... ... stage timings saved: ' + timer['filepath']
+    print '\n\n\n'
 
-            # store number of obs files present from MASS and stats, and whether the two values are equal
-            suite_cycle_meta = create_metadata_num_files(obs_list, suite_cycle_stats, flags, regions)
+    return
 
-            # after all observation values have been acquired for all the flags, if present
-            # This will make the number of keys in region_i, one more than the number of obs files
-            for flag_i in suite_cycle_stats.iterkeys():
-                for region_i, region_i_data in suite_cycle_stats[flag_i].iteritems():
-                    suite_cycle_stats[flag_i][region_i]['all_obs'] = \
-                        np.sum([region_i_data[obs_j] for obs_j in region_i_data.iterkeys()])
 
-            print '... ... observation totals completed!'
+def process_cycle(cycle, dirs):
+    """
+    Get and query all of a cycle's observation files, then save its statistics.
+    :param cycle: (dict) from start_cycle(), with status 'ok'
+    :param dirs: (dict) from suite_dirs()
+    :return:
+    """
 
-            # numpy save this suite and cycle's statistics
-            save_dict = {'suite_cycle_stats': suite_cycle_stats,
-                         'suite_cycle_meta': suite_cycle_meta,
-                         'cycle': cycle_c_str}
-            np.save(numpysavepath, save_dict)
+    args = (cycle['todo_filelist'], cycle['todo_list'], cycle['stats'], dirs['scratch'], cycle['log_file_path'])
+    kwargs = {'timer': cycle['timer'], 'checkpoint_dir': cycle['checkpoint_dir'], 'grid_dir': cycle['grid_dir']}
+
+    # get ODB data for each instrument still to do. Either all in one moo get request, queried as they arrive,
+    #   pipelined, so that downloads and queries overlap, or in turn
+    if len(cycle['todo_filelist']) == 0:
+        pass
+    elif BATCH_MOO_GET:
+        process_obs_files_batched(*args, **kwargs)
+    elif PIPELINE_MODE:
+        process_obs_files_pipelined(*args, **kwargs)
+    else:
+        process_obs_files_serial(*args, **kwargs)
 
-            print '... ... '+numpysavepath+' saved!'
-            print '\n\n\n'
+    finish_cycle(cycle, dirs)
 
-    exit(0)
+    return
 
 
+def process_cycles_batched(suite_id, cycle_list, dirs, cycles_per_request=BATCH_CYCLES_PER_REQUEST,
+                           num_query_workers=NUM_QUERY_WORKERS):
+    """
+    Multi-cycle batch mode: process many cycles of a suite in one job. The MASS listing is refreshed once for all the
+    cycles, the files of cycles_per_request cycles at a time are got in a single moo get request, and one pool of
+    query workers queries the files of all the cycles as they arrive. Each cycle's statistics, log and timings are
+    saved as when the cycle is run on its own.
+    :param suite_id: e.g. 'u-bo796'
+    :param cycle_list: (list of str) cycles e.g. ['20190615T0600Z', ...]
+    :param dirs: (dict) from suite_dirs()
+    :keyword cycles_per_request: cycles whose files are got from MASS together. Their files are all on scratch at once.
+    :keyword num_query_workers: (int) number of concurrent odb sql workers
+    :return:
+    """
+
+    # list any new cycles into the index in one go, so the cycles below are all answered locally
+    if USE_LISTING_INDEX and len(cycle_list) > 0:
+        mass_listing.cycle_files(suite_id, max(cycle_list), index_dir=LISTING_INDEX_DIR)
+
+    query_queue = Queue.Queue()
+    stats_lock = threading.Lock()
+    query_threads = [suite_thread(query_worker, args=(query_queue, stats_lock)) for _ in range(num_query_workers)]
+    for t in query_threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for g in range(0, len(cycle_list), cycles_per_request):
+
+            cycles = [start_cycle(suite_id, cycle_c_str, dirs) for cycle_c_str in cycle_list[g:g + cycles_per_request]]
+            cycles = [cycle for cycle in cycles if cycle['status'] == 'ok']
+            if len(cycles) == 0:
+                continue
+
+            # which cycle, and which instrument, each file is for
+            owners = {obs_moosepath_i: (cycle, obs_i) for cycle in cycles
+                      for obs_moosepath_i, obs_i in zip(cycle['todo_filelist'], cycle['todo_list'])}
+
+            batch_start = time.time()
+            for obs_moosepath_i, obd_odb2_filepath in moo_ODB2_get_files_batched(sorted(owners.keys()),
+                                                                                dirs['scratch']):
+                cycle, obs_i = owners[obs_moosepath_i]
+                print '... ... ' + cycle['cycle'] + ' arrived obs: ' + obs_i
+                if obd_odb2_filepath is None:
+                    file_error_write(obs_moosepath_i, cycle['log_file_path'])
+                    continue
+                stage_timing.record_since(cycle['timer'], 'moo_get', batch_start, obs=obs_i,
+                                          bytes=os.path.getsize(obd_odb2_filepath))
+                if not STREAM_DECOMPRESS:
+                    obd_odb2_filepath = gunzip_obs_file(obd_odb2_filepath, timer=cycle['timer'])
+                query_queue.put((obd_odb2_filepath, obs_i, cycle['stats'], cycle['log_file_path'], cycle['timer'],
+                                 cycle['checkpoint_dir'], cycle['grid_dir']))
+
+            # wait for this request's files to be queried, then save its cycles
+            query_queue.join()
+            for cycle in cycles:
+                finish_cycle(cycle, dirs)
+    finally:
+        for _ in range(num_query_workers):
+            query_queue.put(None)
+        for t in query_threads:
+            t.join()
+
+    return
+
+
+def suite_output_filepath(logdir, suite_id, cycle_c_str):
+    """
+    File a suite's printed output goes to in the concurrent suites mode, next to its log file
+    """
+
+    return logdir + '/' + suite_id + '_' + cycle_c_str + '_obs_analyse_out.txt'
+
+
+def run_suite_cycle(suite_id, cycle_c_str, output, results):
+    """
+    Process one suite's cycle, as in the one suite per job mode, with what it prints sent to its own output file.
+    :param suite_id: e.g. 'u-bo796'
+    :param cycle_c_str: (str) cycle e.g. '20190615T0600Z'
+    :param output: (SuiteOutput) the job's sys.stdout
+    :param results: (dict) results[suite_id] is set to the cycle's status from start_cycle(), or 'failed'
+    :return:
+    """
+
+    dirs = suite_dirs(suite_id)
+
+    with open(suite_output_filepath(dirs['log'], suite_id, cycle_c_str), 'w') as out_file:
+        output.route(out_file)
+        try:
+            print 'working suite-id: '+suite_id
+
+            cycle = start_cycle(suite_id, cycle_c_str, dirs)
+
+            # skip cycles that are already complete (and not to be overwritten), or have no files yet
+            if cycle['status'] not in ['complete', 'no_files']:
+                process_cycle(cycle, dirs)
+            results[suite_id] = cycle['status']
+        except Exception:
+            traceback.print_exc(file=out_file)
+            results[suite_id] = 'failed'
+        finally:
+            output.unroute()
+
+    return
+
+
+def concurrent_done_filepath(cycle_c_str):
+    """
+    File listing the suites a failed concurrent suites job finished for a cycle, so its retry can skip them
+    """
+
+    return SCRATCH + '/ODB2/' + cycle_c_str + '_concurrent_suites_done.json'
+
+
+def load_concurrent_done(cycle_c_str):
+    """
+    Suites already finished for the cycle by an earlier try of the concurrent suites job
+    :return: (list of str) suite ids, empty if there was no earlier try, or it succeeded
+    """
+
+    filepath = concurrent_done_filepath(cycle_c_str)
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath, 'r') as f:
+        return [str(suite_id) for suite_id in json.load(f)]
+
+
+def save_concurrent_done(cycle_c_str, done):
+    """
+    Record the suites finished for the cycle, for the retry of a failed job. Written to a temporary file and renamed,
+    so it is never left half written. An empty list removes the record.
+    """
+
+    filepath = concurrent_done_filepath(cycle_c_str)
+    if len(done) == 0:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump(sorted(done), f)
+    os.rename(filepath + '.tmp', filepath)
+
+    return
+
+
+def process_suites_concurrently(suite_ids, cycle_list, max_mass=MAX_MASS_TRANSFERS, max_odb=MAX_ODB_QUERIES,
+                                max_disk=MAX_DISK_WRITES):
+    """
+    Concurrent suites mode: process every suite's cycle at once in one job, one cycle after another, so the startup,
+    directory and listing work is done once and one suite's queries run while another waits on MASS. Each suite runs
+    in its own thread exactly as it does in its own job, and saves the same files, with the MASS requests, odb queries
+    and disk writes of all the suites sharing the limits set here. A suite that fails does not stop the others.
+
+    When a suite fails, the suites that finished the cycle are recorded (see concurrent_done_filepath()), and the retry
+    of the job skips them, whatever OVERRIDE_CYCLE_STATS says, as separate suite jobs would not have run them again.
+    Suites with no files yet are not recorded, so a retry looks for late-archived files. The record is removed once
+    every suite has finished.
+    :param suite_ids: (list of str) e.g. ['u-bo796', 'u-bo895']
+    :param cycle_list: (list of str) cycles e.g. ['20190615T0600Z', ...]
+    :keyword max_mass: (int) MASS requests in flight at once
+    :keyword max_odb: (int) odb queries running at once
+    :keyword max_disk: (int) statistics, grid and checkpoint writes and gunzips running at once
+    :return: failed: (list of (suite id, cycle)) suite cycles that raised an error
+    """
+
+    set_limits(max_mass, max_odb, max_disk)
+    output = SuiteOutput(sys.stdout)
+    sys.stdout = output
+
+    failed = []
+    try:
+        for cycle_c_str in cycle_list:
+
+            print '... working cycle: '+cycle_c_str+' for '+str(len(suite_ids))+' suites at once'
+            cycle_start = time.time()
+
+            # suites finished by an earlier try of this job, which failed on other suites
+            done = [suite_id for suite_id in load_concurrent_done(cycle_c_str) if suite_id in suite_ids]
+            if len(done) > 0:
+                print '... ... skipping '+' '.join(done)+': finished by an earlier try of this job'
+
+            results = {}
+            threads = [threading.Thread(target=run_suite_cycle, args=(suite_id, cycle_c_str, output, results))
+                       for suite_id in suite_ids if suite_id not in done]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            cycle_failed = []
+            for suite_id in suite_ids:
+                if suite_id in done:
+                    continue
+                status = results.get(suite_id, 'failed')
+                print '... ... '+suite_id+': '+status+', output in '+suite_output_filepath(
+                    suite_dirs(suite_id)['log'], suite_id, cycle_c_str)
+                if status in ['ok', 'complete']:
+                    done += [suite_id]
+                elif status == 'failed':
+                    cycle_failed += [suite_id]
+            save_concurrent_done(cycle_c_str, done if len(cycle_failed) > 0 else [])
+            failed += [(suite_id, cycle_c_str) for suite_id in cycle_failed]
+            print '... cycle done in %.1f s\n\n\n' % (time.time() - cycle_start)
+    finally:
+        sys.stdout = output.stdout
+        set_limits(None, None, None)
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    # multi-cycle batch mode: process a range of cycles for a list of suites in one job
+    parser = argparse.ArgumentParser(description='Run for THIS_CYCLE (from cylc), or with --start and --end for '
+                                                 'every cycle in a range, in one job.')
+    parser.add_argument('--start', default=None, help='first cycle, e.g. 20190615T0600Z')
+    parser.add_argument('--end', default=None, help='last cycle, e.g. 20190915T1800Z (default: --start)')
+    parser.add_argument('--suites', nargs='+', default=None, help='suite ids (default: all in suite_list)')
+    parser.add_argument('--cycles-per-request', type=int, default=BATCH_CYCLES_PER_REQUEST,
+                        help='cycles whose files are got from MASS in one request')
+    parser.add_argument('--concurrent-suites', action='store_true',
+                        help='process all the suites of each cycle at once (default if CONCURRENT_SUITE_IDS is set)')
+    args = parser.parse_args()
+
+    concurrent_mode = args.concurrent_suites or CONCURRENT_SUITE_IDS is not None
+    batch_mode = args.start is not None and not concurrent_mode
+    if args.start is not None:
+        start_cycle_dt = dt.datetime.strptime(args.start, '%Y%m%dT%H%MZ')
+        end_cycle_dt = dt.datetime.strptime(args.start if args.end is None else args.end, '%Y%m%dT%H%MZ')
+        cycle_range = [start_cycle_dt + dt.timedelta(hours=CYCLE_HOURS * i)
+                       for i in range(int((end_cycle_dt - start_cycle_dt).total_seconds() // (CYCLE_HOURS * 3600)) + 1)]
+        cycle_range_str = [i.strftime('%Y%m%dT%H%MZ') for i in cycle_range]
+        suite_iter_list = suite_list.keys() if args.suites is None else args.suites
+    if concurrent_mode:
+        suite_iter_list = suite_iter_list if args.suites is None else args.suites
+        print 'concurrent suites mode: ' + str(len(cycle_range_str)) + ' cycles for ' + str(len(suite_iter_list)) + \
+              ' suites'
+    elif batch_mode:
+        print 'batch mode: ' + str(len(cycle_range_str)) + ' cycles for ' + str(len(suite_iter_list)) + ' suites'
+
+    # ==============================================================================
+    # Process
+    # ==============================================================================
+
+    if concurrent_mode:
+        failed = process_suites_concurrently(suite_iter_list, cycle_range_str)
+        # let cylc retry the job if any suite failed
+        exit(1 if len(failed) > 0 else 0)
+
+    # loop through all suite, then plot the cross-suite statistics after the looping
+    # for suite_id in  ['u-bo976']: # suite_list.iterkeys():  # if running multiple suites in one script (offline)
+    for suite_id in suite_iter_list:  # online
+
+        print 'working suite-id: '+suite_id
+
+        # suite id specific directories
+        dirs = suite_dirs(suite_id)
+
+        if batch_mode:
+            process_cycles_batched(suite_id, cycle_range_str, dirs, cycles_per_request=args.cycles_per_request)
+            continue
+
+        # Go through each cycle in turn
+        for c, cycle_c_str in enumerate(cycle_range_str):
+
+            cycle = start_cycle(suite_id, cycle_c_str, dirs)
+
+            # skip cycles that are already complete (and not to be overwritten), or have no files yet
+            if cycle['status'] in ['complete', 'no_files']:
+                continue
+
+            process_cycle(cycle, dirs)
+
+    exit(0)
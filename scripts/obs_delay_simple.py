@@ -7,13 +7,17 @@ which is number of minutes after nominal analysis time.
 
 In the example I attached, the value of 376 minutes roughly represents current global update cutoff time.
 
+With cutOffSweep set, the same obs are also evaluated against each of the update trial cut offs (sweepCutOffs) in
+one pass, optionally saving the full arrival curve at minute resolution.
+
 Created by Adam Maycock
 
 requires module load scitools/experimental_legacy-current as interpreter
 """
 
 #import obsmon.obsodb as odb
-import metdb
+import numpy as np
+import metdb_retrieval as mr
 
 
 def inAssimWindow(obTime=None, rcptTime=None, cycleLength=60, cutOff=0):
@@ -48,10 +52,134 @@ def list_dt_to_python_dt(intime):
 
     return datetime.datetime(year, month, day, hour, minute, second)
 
+
+def elements_to_datetime64(year, month, day, hour, minute, second=None):
+    """
+    Convert arrays of [year, month, day, hour, minute, second] elements to a numpy datetime64 array, in one go.
+    As list_dt_to_python_dt(), the elements are truncated to integers and negative minutes and seconds are set to 0.
+    :return: (numpy array, dtype=datetime64[s])
+    """
+
+    year = np.asarray(year).astype(np.int64)
+    month = np.asarray(month).astype(np.int64)
+    day = np.asarray(day).astype(np.int64)
+    hour = np.asarray(hour).astype(np.int64)
+    minute = np.maximum(np.asarray(minute).astype(np.int64), 0)
+    if second is None:
+        second = np.zeros(year.shape, dtype=np.int64)
+    second = np.maximum(np.asarray(second).astype(np.int64), 0)
+
+    dates = (year - 1970).astype('datetime64[Y]') + (month - 1).astype('timedelta64[M]')
+    dates = dates.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+
+    return dates.astype('datetime64[s]') + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+
+
+def inAssimWindow_vec(obTime, rcptTime, cycleLength=60, cutOff=0):
+    """
+    Vectorised inAssimWindow(): round each ob time to the nearest cycleLength [s] within its day (the assimilation
+    window it belongs to), and check whether the ob was received within cutOff [s] of it.
+    :param obTime: (numpy array, datetime64[s]) observation times
+    :param rcptTime: (numpy array, datetime64[s]) receipt times
+    :return: assimWindow: (numpy array, datetime64[s]), inTime: (numpy array, bool)
+    """
+
+    days = obTime.astype('datetime64[D]').astype('datetime64[s]')
+    seconds = (obTime - days).astype(np.int64)
+    rounding = (seconds + cycleLength // 2) // cycleLength * cycleLength
+    assimWindow = days + rounding.astype('timedelta64[s]')
+    inTime = rcptTime <= assimWindow + np.timedelta64(int(cutOff), 's')
+
+    return assimWindow, inTime
+
+
+def evaluate_arrival_times(obs, cycleLength, cutOff):
+    """
+    Evaluate the delay of every ob and whether it arrived in time for its assimilation window, as array operations
+    over all the obs retrieved from MetDB.
+    :param obs: retrieved obs from metdb.obs() (obs[element].data = 1D np.array)
+    :param cycleLength: assimilation window length [s]
+    :param cutOff: data cut off [s] after the nominal analysis time
+    :return: (dict) 'site_id', 'obtime', 'rcpttime', 'timediff' [s], 'assim_window', 'in_time' arrays
+    """
+
+    site_id = obs['WMO_BLCK_NMBR'].data.astype(np.int64) * 1000 + obs['WMO_STTN_NMBR'].data.astype(np.int64)
+
+    obtime = elements_to_datetime64(obs['YEAR'].data, obs['MNTH'].data, obs['DAY'].data, obs['HOUR'].data,
+                                    obs['MINT'].data)
+    rcpttime = elements_to_datetime64(obs['RCPT_YEAR'].data, obs['RCPT_MNTH'].data, obs['RCPT_DAY'].data,
+                                      obs['RCPT_HOUR'].data, obs['RCPT_MINT'].data)
+    timediff = (rcpttime - obtime).astype(np.float64)
+
+    assim_window, in_time = inAssimWindow_vec(obtime, rcpttime, cycleLength=cycleLength, cutOff=cutOff)
+
+    return {'site_id': site_id, 'obtime': obtime, 'rcpttime': rcpttime, 'timediff': timediff,
+            'assim_window': assim_window, 'in_time': in_time}
+
+
+def window_delays(arrivals):
+    """
+    Delay of each ob after the nominal analysis time of its assimilation window. The window an ob belongs to does not
+    depend on the cut off, so this is all that is needed to say which obs arrive in time for any cut off.
+    :param arrivals: (dict) from evaluate_arrival_times()
+    :return: (numpy array, dtype=int64) delays [s]
+    """
+
+    return (arrivals['rcpttime'] - arrivals['assim_window']).astype(np.int64)
+
+
+def sort_window_delays(arrivals):
+    """
+    window_delays(), sorted
+    :param arrivals: (dict) from evaluate_arrival_times()
+    :return: (numpy array, dtype=int64) sorted delays [s]
+    """
+
+    return np.sort(window_delays(arrivals))
+
+
+def cutoff_sweep(sortedDelays, cutOffs):
+    """
+    Number and fraction of obs received in time for each of a list of cut offs, as inAssimWindow() would find for
+    each cut off in turn (an ob is in time if its delay <= cut off).
+    :param sortedDelays: (numpy array) from sort_window_delays() [s]
+    :param cutOffs: cut offs after the nominal analysis time [s]
+    :return: counts: (numpy array, int), fractions: (numpy array, float; NaN if there are no obs)
+    """
+
+    counts = np.searchsorted(sortedDelays, np.asarray(cutOffs), side='right')
+    numObs = len(sortedDelays)
+    fractions = counts / float(numObs) if numObs > 0 else np.full(counts.shape, np.nan)
+
+    return counts, fractions
+
+
+def arrival_curve(sortedDelays, maxCutOff, step=60):
+    """
+    Cumulative arrival curve: the number and fraction of obs received in time for every cut off from 0 to maxCutOff.
+    :param sortedDelays: (numpy array) from sort_window_delays() [s]
+    :param maxCutOff: last cut off on the curve [s]
+    :keyword step: resolution of the curve [s], default 1 minute
+    :return: cutOffs [s], counts, fractions: (numpy arrays)
+    """
+
+    cutOffs = np.arange(0, maxCutOff + step, step)
+    counts, fractions = cutoff_sweep(sortedDelays, cutOffs)
+
+    return cutOffs, counts, fractions
+
+
 # Initialise
 assimWindowLength = 6 # hours
 dataCutOff = 376 # minutes
 
+# cut off sweep: how many obs would arrive in time for each update trial (hours; see SUITE_DICT in
+# odb2_stat_processing.py), and the arrival curve at minute resolution up to the longest of them
+cutOffSweep = True
+sweepCutOffs = [3.0, 4.0, 5.0, 6.25, 7.25] # hours
+saveArrivalCurve = False
+arrivalCurveFilepath = 'arrival_curve.csv'
+
 # time and domain - fixed format
 # time = 'START TIME YYYYMMDD/HHmmZ (Z is compulsory)
 # Note: for those sub-types stored by the hour, such as satellite data, an END TIME of,
@@ -66,26 +194,41 @@ elements = ['WMO_BLCK_NMBR', 'WMO_STTN_NMBR', 'YEAR', 'MNTH', 'DAY', 'HOUR', 'MI
 # contact = 'adam.maycock@metoffice.gov.uk'
 contact = 'elliott.warren@metoffice.gov.uk'
 subtype = 'LNDSYN' # synoptic land stations
-timediffs = []
-numReceivedInTime = 0
+metdbChunkHours = 3 # retrieve the window in chunks of this many hours
+metdbCacheDir = mr.CACHE_DIR
 
 # Retrieve observations from MetDB (obs = 1D np.array, element=1D np.array, sub-element=item from [elements] variable)
-obs = metdb.obs(contact, subtype, keywords, elements)
+# in time chunks, cached on disk (see metdb_retrieval.py). Each chunk is as from metdb.obs(contact, subtype, keywords,
+# elements) for its part of the window, and is reduced to what is needed before the next one, so the raw obs of the
+# whole window are never in memory at once
+numObs = 0
+numReceivedInTime = 0
+windowDelays = [np.zeros(0, dtype=np.int64)]
+for obs in mr.iter_obs_chunks(contact, subtype, keywords, elements, chunk_hours=metdbChunkHours,
+                              cache_dir=metdbCacheDir):
+
+    # evaluate all the chunk's obs at once (see inAssimWindow() and list_dt_to_python_dt() for the equivalent per ob)
+    arrivals = evaluate_arrival_times(obs, cycleLength=assimWindowLength*60*60, cutOff=dataCutOff*60)
+    numObs += len(arrivals['in_time'])
+    numReceivedInTime += int(np.sum(arrivals['in_time']))
+    if cutOffSweep == True:
+        windowDelays += [window_delays(arrivals)]
+    del obs, arrivals
 
-numObs = len(obs['YEAR'].data)
+print '{:d} / {:d} received in time'.format(numReceivedInTime, numObs)
 
-for ob in range(numObs):
+if cutOffSweep == True:
 
-    site_id = int(obs['WMO_BLCK_NMBR'].data[ob]) * 1000 + int(obs['WMO_STTN_NMBR'].data[ob])
+    # sort the delays once, then every cut off is a binary search
+    sortedDelays = np.sort(np.concatenate(windowDelays))
+    del windowDelays
 
-    obtime = list_dt_to_python_dt([obs['YEAR'].data[ob], obs['MNTH'].data[ob], obs['DAY'].data[ob], obs['HOUR'].data[ob], obs['MINT'].data[ob], 0])
-    rcpttime = list_dt_to_python_dt([obs['RCPT_YEAR'].data[ob], obs['RCPT_MNTH'].data[ob], obs['RCPT_DAY'].data[ob], obs['RCPT_HOUR'].data[ob], obs['RCPT_MINT'].data[ob], 0])
-    timediff = (rcpttime - obtime).total_seconds()
-    timediffs.append(timediff)
-#    print obtime, rcpttime, inAssimWindow(obtime, rcpttime, cycleLength=assimWindowLength*60*60, cutOff = dataCutOff*60)
+    counts, fractions = cutoff_sweep(sortedDelays, [h*60*60 for h in sweepCutOffs])
+    for h, count, fraction in zip(sweepCutOffs, counts, fractions):
+        print '{:.2f} hour cut off: {:d} / {:d} received in time ({:.1f}%)'.format(h, count, numObs, fraction*100.0)
 
-    inTime = inAssimWindow(obtime, rcpttime, cycleLength=assimWindowLength*60*60, cutOff = dataCutOff*60)[1]
-    if inTime == True:
-        numReceivedInTime += 1
-        
-print '{:d} / {:d} received in time'.format(numReceivedInTime, numObs)
+    if saveArrivalCurve == True:
+        curveCutOffs, curveCounts, curveFractions = arrival_curve(sortedDelays, max(sweepCutOffs)*60*60)
+        np.savetxt(arrivalCurveFilepath, np.column_stack([curveCutOffs / 60, curveCounts, curveFractions]),
+                   fmt=['%d', '%d', '%.6f'], delimiter=',', header='cut_off_minutes,num_in_time,fraction_in_time')
+        print 'saved arrival curve: ' + arrivalCurveFilepath
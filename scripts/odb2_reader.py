@@ -0,0 +1,709 @@
+#!/usr/bin/env python2.7
+
+"""
+In-process ODB2 reader, using only numpy. An alternative to running the odb sql binary for the queries in
+obs_analyse.py: only the columns that are needed are decoded, straight into numpy arrays, and the region predicates
+from region_bounds are evaluated as vectorised masks.
+
+ODB2 files are a sequence of frames. Each frame has a header describing its columns (name, type and codec), followed
+by the rows. Each row starts with a marker: the index of the first column whose value changed since the previous row.
+Only the values from that column onwards are stored, so a column keeps its previous value if it is not in the row.
+Finding where each row starts needs a (cheap) sequential scan of the markers. Everything else is done with numpy.
+
+Files using a codec not supported here raise ODB2FormatError, so that the caller can fall back to odb sql.
+
+write_odb2() writes small synthetic ODB2 files in the same layout, for testing without the odb binaries.
+
+EXPERIMENTAL: the reader has only been checked against files from its own write_odb2(), not against real ODB2 files
+or odb sql output. In particular the string table of the 'chars' codecs and the missing values of short_real columns
+are unverified. Cross-check it with odb sql on real files before setting obs_analyse.QUERY_BACKEND = 'numpy'.
+"""
+
+import numpy as np
+import struct
+import hashlib
+import ast
+import gzip
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+ODB2_MAGIC = '\xff\xffODA'
+ODB2_FORMAT_VERSION = (0, 5)
+
+# column data types
+DATA_TYPES = {0: 'ignore', 1: 'integer', 2: 'real', 3: 'string', 4: 'bitfield', 5: 'double'}
+DATA_TYPE_IDS = {value: key for key, value in DATA_TYPES.items()}
+
+# number of bytes each codec uses to store a value, and the numpy dtype to read them as.
+# None = value is not stored in the rows at all (constant for the whole frame)
+CODECS = {'constant': (0, None),
+          'constant_string': (0, None),
+          'constant_or_missing': (1, np.uint8),
+          'int8': (1, np.uint8),
+          'int8_missing': (1, np.uint8),
+          'int16': (2, np.dtype('<u2')),
+          'int16_missing': (2, np.dtype('<u2')),
+          'int32': (4, np.dtype('<i4')),
+          'short_real': (4, np.dtype('<f4')),
+          'short_real2': (4, np.dtype('<f4')),
+          'long_real': (8, np.dtype('<f8')),
+          'chars': (8, None),
+          'int8_string': (1, None),
+          'int16_string': (2, None)}
+
+# integer codecs stored as an offset from the codec's minimum, and the value used to mark a missing value
+OFFSET_CODECS = ['constant_or_missing', 'int8', 'int8_missing', 'int16', 'int16_missing']
+MISSING_MARKERS = {'constant_or_missing': 0xff, 'int8_missing': 0xff, 'int16_missing': 0xffff}
+
+# codecs with a string table in their header
+STRING_TABLE_CODECS = ['chars', 'int8_string', 'int16_string']
+
+# rows in a row with the same marker before the rest of the run is found with numpy rather than row by row
+ROW_RUN_LENGTH = 16
+
+
+class ODB2FormatError(Exception):
+    """
+    The file is not an ODB2 file, or uses parts of the format that this reader does not support.
+    """
+    pass
+
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+# reading
+
+
+class _HeaderStream(object):
+    """
+    Read little endian values from a header buffer.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from('<' + fmt, self.buf, self.pos)
+        self.pos += struct.calcsize('<' + fmt)
+        return values[0] if len(values) == 1 else values
+
+    def read_string(self):
+        length = self.read('i')
+        s = self.buf[self.pos:self.pos + length]
+        self.pos += length
+        return s
+
+
+def _read_exact(f, n):
+    """
+    Read exactly n bytes from f, or raise ODB2FormatError if the file ends early.
+    """
+
+    buf = f.read(n)
+    if len(buf) != n:
+        raise ODB2FormatError('file ends part way through a frame')
+    return buf
+
+
+def _read_column(hs):
+    """
+    Read a column descriptor (name, type, bitfield members and codec) from the frame header.
+    :param hs: _HeaderStream positioned at the start of the column
+    :return: column: (dict)
+    """
+
+    column = {'name': hs.read_string()}
+    data_type = hs.read('i')
+    if data_type not in DATA_TYPES:
+        raise ODB2FormatError('unknown data type ' + str(data_type) + ' for column ' + column['name'])
+    column['type'] = DATA_TYPES[data_type]
+
+    # bitfield member names and sizes [bits]. Members are packed from the least significant bit.
+    column['bitfields'] = []
+    if column['type'] == 'bitfield':
+        names = [hs.read_string() for _ in range(hs.read('i'))]
+        sizes = [hs.read('i') for _ in range(hs.read('i'))]
+        column['bitfields'] = zip(names, sizes)
+
+    column['codec'] = hs.read_string()
+    if column['codec'] not in CODECS:
+        raise ODB2FormatError('unsupported codec ' + column['codec'] + ' for column ' + column['name'])
+    column['width'] = CODECS[column['codec']][0]
+
+    has_missing, column['min'], column['max'], column['missing_value'] = hs.read('iddd')
+    column['has_missing'] = has_missing != 0
+
+    if column['codec'] in STRING_TABLE_CODECS:
+        # (string, count, index) for each string
+        for _ in range(hs.read('i')):
+            hs.read_string()
+            hs.read('ii')
+
+    return column
+
+
+def read_frame(f):
+    """
+    Read the next frame of an ODB2 file.
+    :param f: open (binary) file object, e.g. from open() or gzip.open()
+    :return: frame: (dict) 'columns' descriptors, 'nrows' and the raw row 'data', or None at the end of the file
+    """
+
+    magic = f.read(len(ODB2_MAGIC))
+    if magic == '':
+        return None
+    if magic != ODB2_MAGIC:
+        raise ODB2FormatError('not an ODB2 frame (bad magic number)')
+
+    byte_order, version_major, version_minor = struct.unpack('<iii', _read_exact(f, 12))
+    if byte_order != 1:
+        raise ODB2FormatError('big endian ODB2 files are not supported')
+    if (version_major, version_minor) != ODB2_FORMAT_VERSION:
+        raise ODB2FormatError('unsupported ODB2 format version ' + str(version_major) + '.' + str(version_minor))
+
+    # md5 of the header (not checked), then the header itself
+    _read_exact(f, struct.unpack('<i', _read_exact(f, 4))[0])
+    header_length = struct.unpack('<i', _read_exact(f, 4))[0]
+    hs = _HeaderStream(_read_exact(f, header_length))
+
+    data_size, _, nrows = hs.read('qqq')
+    # flags and properties are not needed
+    hs.read(str(hs.read('i')) + 'd')
+    for _ in range(hs.read('i')):
+        hs.read_string()
+        hs.read_string()
+    columns = [_read_column(hs) for _ in range(hs.read('i'))]
+
+    data = _read_exact(f, data_size)
+
+    return {'columns': columns, 'nrows': nrows, 'data': data}
+
+
+def _row_offsets(frame):
+    """
+    Scan the rows of a frame for where each row starts and its marker (first column stored in the row).
+    A row's length only depends on its marker, so once a few rows in a row share a marker, the rest of that run is
+    found at once with a strided numpy view (all of a frame whose rows store every column).
+    :param frame: (dict) from read_frame()
+    :return: starts: (numpy array) byte offset of each row's first value, markers: (numpy array)
+    """
+
+    columns = frame['columns']
+    nrows = frame['nrows']
+    data = bytearray(frame['data'])
+    marker_bytes = 1 if len(columns) <= 255 else 2
+
+    # bytes used by a row, for each possible marker
+    widths = [c['width'] for c in columns]
+    row_length = [marker_bytes + sum(widths[m:]) for m in range(len(columns))]
+
+    # the marker a row starting at each byte would have
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if marker_bytes == 1:
+        marker_at = raw
+    else:
+        marker_at = (raw[:-1].astype(np.int64) << 8) | raw[1:]
+
+    # rows are collected one by one, and long runs as (first row, start, row length, rows, marker)
+    row_starts, row_markers = [], []
+    add_start, add_marker = row_starts.append, row_markers.append
+    runs = []
+    pos = 0
+    end = len(data)
+    i = 0
+    previous = None
+    same = 0
+    try:
+        while pos < end and i < nrows:
+            if marker_bytes == 1:
+                m = data[pos]
+            else:
+                m = (data[pos] << 8) | data[pos + 1]
+            length = row_length[m]
+            if m != previous:
+                previous = m
+                same = 0
+            elif same < ROW_RUN_LENGTH:
+                same += 1
+            else:
+                # count the rows from pos on with the same marker, looking further ahead while they all have it
+                run = 0
+                window = ROW_RUN_LENGTH
+                while i + run < nrows:
+                    ahead = marker_at[pos + run * length::length][:min(window, nrows - i - run)]
+                    changed = np.flatnonzero(ahead != m)
+                    if changed.size > 0:
+                        run += int(changed[0])
+                        break
+                    run += ahead.size
+                    if ahead.size < window:
+                        break
+                    window *= 4
+
+                runs.append((i, pos, length, run, m))
+                pos += run * length
+                i += run
+                previous = None
+                continue
+
+            add_start(pos)
+            add_marker(m)
+            pos += length
+            i += 1
+    except IndexError:
+        raise ODB2FormatError('frame rows do not match the frame header')
+
+    if pos != end or i != nrows:
+        raise ODB2FormatError('frame rows do not match the frame header')
+
+    starts = np.empty(nrows, dtype=np.int64)
+    markers = np.empty(nrows, dtype=np.int64)
+    in_run = np.zeros(nrows, dtype=bool)
+    if len(runs) > 0:
+        first, run_start, length, count, m = [np.array(x, dtype=np.int64) for x in zip(*runs)]
+        within = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+        rows = np.repeat(first, count) + within
+        starts[rows] = np.repeat(run_start, count) + within * np.repeat(length, count)
+        markers[rows] = np.repeat(m, count)
+        in_run[rows] = True
+    starts[~in_run] = row_starts
+    markers[~in_run] = row_markers
+    starts += marker_bytes
+
+    if i > 0 and markers[0] != 0:
+        raise ODB2FormatError('first row of the frame does not store every column')
+
+    return starts, markers
+
+
+def _decode_column(frame, starts, markers, column_i):
+    """
+    Decode one column of a frame into a numpy array (float64), filling rows that do not store a value with the
+    previous row's value.
+    """
+
+    column = frame['columns'][column_i]
+    width, dtype = CODECS[column['codec']]
+    nrows = starts.size
+
+    if width == 0:
+        return np.full(nrows, column['min'])
+    if dtype is None:
+        raise ODB2FormatError('string column ' + column['name'] + ' can not be decoded as a number')
+
+    # rows that store a value for this column, and the byte offset of the value within them
+    widths = np.array([c['width'] for c in frame['columns']], dtype=np.int64)
+    col_offset = np.concatenate(([0], np.cumsum(widths)))
+    stored = markers <= column_i
+    pos = starts[stored] + (col_offset[column_i] - col_offset[markers[stored]])
+
+    raw = np.frombuffer(frame['data'], dtype=np.uint8)
+    value_bytes = raw[pos[:, None] + np.arange(width)]
+    values = np.ascontiguousarray(value_bytes).view(dtype).ravel().astype(np.float64)
+
+    if column['codec'] in OFFSET_CODECS:
+        missing = values == MISSING_MARKERS.get(column['codec'], -1)
+        values = values + column['min']
+        values[missing] = column['missing_value']
+
+    # carry values forward to the rows that do not store one
+    stored_rows = np.where(stored, np.arange(nrows), 0)
+    stored_rank = np.cumsum(stored) - 1
+    filled = values[stored_rank[np.maximum.accumulate(stored_rows)]]
+
+    return filled
+
+
+def _find_column(columns, name):
+    """
+    Find a column by name, allowing the @table suffix to be left off, and dotted names for bitfield members
+    (e.g. 'datum_status.active').
+    :return: (column index, bitfield member name or None)
+    """
+
+    names = [c['name'] for c in columns]
+    short_names = [n.split('@')[0] for n in names]
+
+    for candidates in [names, short_names]:
+        if name in candidates:
+            return candidates.index(name), None
+
+    if '.' in name:
+        base, member = name.split('.', 1)
+        base = base.split('@')[0]
+        if base in short_names:
+            column_i = short_names.index(base)
+            if member.split('@')[0] in [b[0] for b in columns[column_i]['bitfields']]:
+                return column_i, member.split('@')[0]
+
+    raise ODB2FormatError('column ' + name + ' not found')
+
+
+def decode_frame_columns(frame, names):
+    """
+    Decode the requested columns of a frame into numpy arrays. Only these columns are decoded.
+    :param frame: (dict) from read_frame()
+    :param names: column names, e.g. ['lat', 'lon', 'datum_status.active']
+    :return: (dict) name: numpy array (float64)
+    """
+
+    starts, markers = _row_offsets(frame)
+    out = {}
+
+    for name in names:
+        column_i, member = _find_column(frame['columns'], name)
+        values = _decode_column(frame, starts, markers, column_i)
+        if member is not None:
+            offset = 0
+            for member_name, size in frame['columns'][column_i]['bitfields']:
+                if member_name == member:
+                    break
+                offset += size
+            values = ((values.astype(np.int64) >> offset) & ((1 << size) - 1)).astype(np.float64)
+        out[name] = values
+
+    return out
+
+
+def open_odb2(filepath):
+    """
+    Open an ODB2 file for reading, decompressing it on the fly if it is gzipped (.gz).
+    """
+
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
+
+def read_odb2_columns(filepath, names):
+    """
+    Read the requested columns from every frame of an ODB2 file.
+    :param filepath: ODB2 filepath (can be gzipped)
+    :param names: column names
+    :return: (dict) name: numpy array (float64)
+    """
+
+    parts = {name: [] for name in names}
+
+    with open_odb2(filepath) as f:
+        while True:
+            frame = read_frame(f)
+            if frame is None:
+                break
+            for name, values in decode_frame_columns(frame, names).iteritems():
+                parts[name] += [values]
+
+    return {name: np.concatenate(values) if len(values) > 0 else np.array([])
+            for name, values in parts.iteritems()}
+
+
+# querying
+
+
+def _sql_expression(expression):
+    """
+    Parse an SQL expression such as 'sum((70 > lat > 25) and (28 > lon > -10))' into a python syntax tree. The
+    outer sum() is removed: the expression within it is a predicate to be counted.
+    """
+
+    expression = expression.strip()
+    if expression.startswith('sum(') and expression.endswith(')'):
+        expression = expression[4:-1]
+    try:
+        return ast.parse(expression, mode='eval').body
+    except SyntaxError:
+        raise ODB2FormatError('can not parse SQL expression: ' + expression)
+
+
+def expression_columns(expression):
+    """
+    Column names used in an SQL expression, e.g. ['lat', 'lon'].
+    """
+
+    def names(node):
+        if isinstance(node, ast.Name):
+            return [node.id]
+        if isinstance(node, ast.Attribute):
+            return [_dotted_name(node)]
+        out = []
+        for child in ast.iter_child_nodes(node):
+            out += names(child)
+        return out
+
+    return sorted(set(names(_sql_expression(expression))))
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Attribute):
+        return _dotted_name(node.value) + '.' + node.attr
+    if isinstance(node, ast.Name):
+        return node.id
+    raise ODB2FormatError('unsupported SQL expression')
+
+
+def region_mask(expression, columns):
+    """
+    Evaluate an SQL predicate from region_bounds as a vectorised mask. Supports comparisons (including chained ones
+    like 20 > lat > -20), and, or, not, and +, -, *, / arithmetic.
+    :param expression: (str) e.g. 'sum((-8 > lat > -45) and (157 > lon > 106))'
+    :param columns: (dict) name: numpy array, with every column the expression uses
+    :return: mask: (numpy array, dtype=bool)
+    """
+
+    compare_ops = {ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+                   ast.Eq: np.equal, ast.NotEq: np.not_equal}
+    bin_ops = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide}
+
+    def evaluate(node):
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, (ast.Name, ast.Attribute)):
+            return columns[_dotted_name(node)]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -evaluate(node.operand)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return np.logical_not(evaluate(node.operand))
+        if isinstance(node, ast.BinOp) and type(node.op) in bin_ops:
+            return bin_ops[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return reduce(combine, [evaluate(v) for v in node.values])
+        if isinstance(node, ast.Compare):
+            # a > b > c is (a > b) and (b > c)
+            operands = [evaluate(node.left)] + [evaluate(c) for c in node.comparators]
+            mask = True
+            for i, op in enumerate(node.ops):
+                if type(op) not in compare_ops:
+                    raise ODB2FormatError('unsupported SQL comparison')
+                mask = np.logical_and(mask, compare_ops[type(op)](operands[i], operands[i + 1]))
+            return mask
+        raise ODB2FormatError('unsupported SQL expression')
+
+    n = len(columns.values()[0]) if len(columns) > 0 else 0
+    return np.broadcast_to(evaluate(_sql_expression(expression)), (n,)).astype(bool)
+
+
+def sum_groups(keys, values):
+    """
+    Sum the rows of values that have the same row of keys
+    :param keys: (2D numpy array) group keys, one row per row of values
+    :param values: (2D numpy array)
+    :return: unique keys (sorted), and the summed values of each
+    """
+
+    if keys.shape[0] == 0:
+        return keys, values
+
+    # sort the rows by their keys (lexsort is much faster than np.unique(axis=0)), then sum each run of equal keys
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    starts = np.concatenate([[0], np.nonzero(np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1))[0] + 1])
+
+    return sorted_keys[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+def odb2_select_query(region_bounds, regions, filepath, grid_resolution=None, max_group_rows=1000000):
+    """
+    The numpy equivalent of obs_analyse.sql_ODB2_select_query(): count the observations in each region for each
+    combination of datum_status.active and ops_report_flags.surplus present in the file.
+
+    Only the active, surplus and region columns are decoded, one frame at a time, so the memory needed is set by the
+    largest frame and not by the size of the file.
+    :param region_bounds: the SQL query part that has the boundaries of the region in it
+    :param regions: the regions that match region_bounds
+    :param filepath: ODB2 filepath (can be gzipped)
+    :keyword grid_resolution: (float) if given, also group by lat/lon grid cell of this size [degrees], as the
+        'floor(lat/res), floor(lon/res), count(*)' query in obs_analyse.sql_ODB2_select_query() does
+    :keyword max_group_rows: (int) with grid_resolution, the grouped rows of the frames read so far are summed up
+        together whenever there are more than this many, to bound the memory used
+    :return: out_array: (numpy array, dtype=int64) columns: active, surplus, then one for each region. With
+        grid_resolution, the columns are: active, surplus, lat cell, lon cell, count, then one for each region.
+    """
+
+    flag_names = ['datum_status.active', 'ops_report_flags.surplus']
+    names = flag_names[:]
+    for region in regions:
+        names += [name for name in expression_columns(region_bounds[region]) if name not in names]
+
+    if grid_resolution is not None:
+        return _odb2_grid_select_query(region_bounds, regions, filepath, names, grid_resolution, max_group_rows)
+
+    # counts for each region, keyed by (active, surplus)
+    counts = {}
+
+    with open_odb2(filepath) as f:
+        while True:
+            frame = read_frame(f)
+            if frame is None:
+                break
+            if frame['nrows'] == 0:
+                continue
+            columns = decode_frame_columns(frame, names)
+
+            # group rows by their (active, surplus) combination
+            flag_values = np.column_stack([columns[name] for name in flag_names])
+            combos, group = np.unique(flag_values, axis=0, return_inverse=True)
+            region_counts = np.column_stack(
+                [np.bincount(group, weights=region_mask(region_bounds[region], columns), minlength=len(combos))
+                 for region in regions])
+
+            for i, combo in enumerate(combos):
+                key = tuple(combo)
+                counts[key] = counts.get(key, 0) + region_counts[i].astype(np.int64)
+
+    out_array = np.array([list(key) + list(counts[key]) for key in sorted(counts.keys())], dtype=np.int64)
+
+    return out_array.reshape(-1, len(regions) + 2)
+
+
+def _odb2_grid_select_query(region_bounds, regions, filepath, names, grid_resolution, max_group_rows):
+    """
+    odb2_select_query() grouped by lat/lon grid cell as well. Missing or non-finite positions are put in cell
+    -2147483647, which is off any grid.
+    """
+
+    flag_names = ['datum_status.active', 'ops_report_flags.surplus']
+    names = names + [name for name in ['lat', 'lon'] if name not in names]
+
+    # (keys, sums) of the frames read so far, summed up together every so often to keep them small
+    keys_parts = []
+    sums_parts = []
+    n_parts_rows = 0
+
+    with open_odb2(filepath) as f:
+        while True:
+            frame = read_frame(f)
+            if frame is None:
+                break
+            if frame['nrows'] == 0:
+                continue
+            columns = decode_frame_columns(frame, names)
+
+            cells = [np.floor(columns[name] / grid_resolution) for name in ['lat', 'lon']]
+            for cell in cells:
+                cell[~np.isfinite(cell)] = -2147483647
+            keys = np.column_stack([columns[name] for name in flag_names] + cells)
+            values = np.column_stack([np.ones(frame['nrows'])] +
+                                     [region_mask(region_bounds[region], columns) for region in regions])
+            frame_keys, frame_sums = sum_groups(keys, values)
+
+            keys_parts += [frame_keys]
+            sums_parts += [frame_sums]
+            n_parts_rows += len(frame_keys)
+            if n_parts_rows > max_group_rows:
+                compact_keys, compact_sums = sum_groups(np.concatenate(keys_parts), np.concatenate(sums_parts))
+                keys_parts, sums_parts = [compact_keys], [compact_sums]
+                n_parts_rows = len(compact_keys)
+
+    if len(keys_parts) == 0:
+        return np.zeros((0, len(regions) + 5), dtype=np.int64)
+
+    keys, sums = sum_groups(np.concatenate(keys_parts), np.concatenate(sums_parts))
+
+    return np.column_stack([keys, sums]).astype(np.int64)
+
+
+# writing
+
+
+def _choose_codec(values, data_type):
+    """
+    Pick the smallest codec that stores the values exactly.
+    :return: codec name, minimum value
+    """
+
+    if values.size == 0 or np.all(values == values[0]):
+        return 'constant', float(values[0]) if values.size > 0 else 0.0
+    if data_type in ['integer', 'bitfield']:
+        vmin, vmax = np.min(values), np.max(values)
+        if vmax - vmin < 0xff:
+            return 'int8', float(vmin)
+        if vmax - vmin < 0xffff:
+            return 'int16', float(vmin)
+        return 'int32', 0.0
+    return 'long_real', 0.0
+
+
+def _frame_bytes(columns, rows):
+    """
+    Encode one frame: header and rows.
+    :param columns: list of (name, data type, bitfields) tuples
+    :param rows: list of 1D numpy arrays, one for each column, all the same length
+    """
+
+    nrows = rows[0].size if len(rows) > 0 else 0
+    codecs = [_choose_codec(values, data_type) for values, (_, data_type, _) in zip(rows, columns)]
+
+    # encode each column's values for every row
+    encoded = []
+    for values, (codec, vmin) in zip(rows, codecs):
+        dtype = CODECS[codec][1]
+        if dtype is None:
+            encoded += [[''] * nrows]
+        else:
+            dtype = np.dtype(dtype)
+            stored = values - vmin if codec in OFFSET_CODECS else values
+            as_bytes = stored.astype(dtype).tostring()
+            encoded += [[as_bytes[i * dtype.itemsize:(i + 1) * dtype.itemsize] for i in range(nrows)]]
+
+    # each row only stores the columns from the first one that changed
+    marker_fmt = '>B' if len(columns) <= 255 else '>H'
+    data = []
+    previous = None
+    for i in range(nrows):
+        current = [col[i] for col in encoded]
+        marker = 0
+        if previous is not None:
+            marker = len(columns) - 1
+            for j in range(len(columns)):
+                if current[j] != previous[j]:
+                    marker = j
+                    break
+        data += [struct.pack(marker_fmt, marker)] + current[marker:]
+        previous = current
+    data = ''.join(data)
+
+    def pack_string(s):
+        return struct.pack('<i', len(s)) + s
+
+    header = struct.pack('<qqq', len(data), 0, nrows)
+    header += struct.pack('<i', 0)  # flags
+    header += struct.pack('<i', 0)  # properties
+    header += struct.pack('<i', len(columns))
+    for (name, data_type, bitfields), (codec, vmin), values in zip(columns, codecs, rows):
+        header += pack_string(name) + struct.pack('<i', DATA_TYPE_IDS[data_type])
+        if data_type == 'bitfield':
+            header += struct.pack('<i', len(bitfields)) + ''.join([pack_string(b[0]) for b in bitfields])
+            header += struct.pack('<i', len(bitfields)) + ''.join([struct.pack('<i', b[1]) for b in bitfields])
+        vmax = float(np.max(values)) if values.size > 0 else 0.0
+        header += pack_string(codec) + struct.pack('<iddd', 0, vmin, vmax, -2147483647.0)
+
+    return ODB2_MAGIC + struct.pack('<iii', 1, *ODB2_FORMAT_VERSION) + \
+        pack_string(hashlib.md5(header).hexdigest()) + struct.pack('<i', len(header)) + header + data
+
+
+def write_odb2(filepath, columns, rows_per_frame=10000):
+    """
+    Write a small synthetic ODB2 file, e.g. for testing the reader without the odb binaries.
+    :param filepath: output filepath (gzipped if it ends in .gz)
+    :param columns: list of (name, data type, values) or (name, 'bitfield', values, [(member, bits), ...]) tuples,
+        where data type is 'integer', 'real', 'double' or 'bitfield' and values is a 1D array
+    :keyword rows_per_frame: maximum number of rows in each frame
+    :return:
+    """
+
+    descriptors = [(c[0], c[1], c[3] if len(c) > 3 else []) for c in columns]
+    values = [np.asarray(c[2], dtype=np.float64) for c in columns]
+    nrows = values[0].size
+
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'wb') as f:
+        for start in range(0, max(nrows, 1), rows_per_frame):
+            f.write(_frame_bytes(descriptors, [v[start:start + rows_per_frame] for v in values]))
+
+    return
@@ -4,15 +4,25 @@
 Script to process, analyse and plot the ODB2 statstics created from the obs_analyse.py script.
 
 Created by Elliott Warren - Wed 15th Jan 2020: elliott.warren@metoffice.gov.uk
+
+Usage: python odb2_stat_processing.py [command], where command is one of
+    load        pack (or with --rebuild, repack) the trial cube from the cycle statistics files
+    summarise   print the total mean obs of each suite, relative to the control (with its confidence interval)
+    tables      save the csv tables (--table to pick which)
+    plot        save the figures (--figure, --flag and --region to pick which)
+    all         all of the above, as the script always has done (the default)
+matplotlib is only imported when a figure is drawn.
 """
 
 import numpy as np
 import os
-import subprocess
+import sys
+import argparse
 import datetime as dt
-import ellUtils as eu
-import matplotlib
-import matplotlib.pyplot as plt
+import multiprocessing
+
+import trial_cube as tc
+import bootstrap_ci as bci
 
 # ==============================================================================
 # Setup
@@ -25,6 +35,32 @@ DATADIR = os.getenv('DATADIR')
 PROJECT_DIR = DATADIR + '/R2O_projects/update_cutoff/'
 SAVEDIR = PROJECT_DIR + 'figures'
 
+# cycle statistics from obs_analyse.py, and the trial cube they get packed into (see trial_cube.py)
+CYCLE_STATS_DIR = PROJECT_DIR + 'data/cycle_sql_stats'
+CUBE_DIR = PROJECT_DIR + 'data/trial_cube'
+
+# repack the trial cube from the cycle statistics files, even if one exists for these suites and dates?
+REBUILD_CUBE = False
+
+# number of processes reading the cycle statistics files when packing the trial cube
+NUM_LOAD_WORKERS = 8
+
+# number of processes rendering figures (1 = render in this process)
+RENDER_WORKERS = 4
+
+# save all the figures of each kind as pages of a single pdf (SAVEDIR/[kind].pdf), instead of separate images?
+MULTIPAGE_OUTPUT = False
+
+# confidence intervals of each suite's mean obs relative to the CONTROL_SUITE, from a paired block bootstrap over the
+#   cycles (see bootstrap_ci.py). Shaded on the total mean obs plots (instead of the stdev across the obs types) and
+#   saved as tables.
+BOOTSTRAP_CI = True
+BOOTSTRAP_REPLICATES = 2000
+# consecutive cycles in each resampled block (4 x 6 hourly cycles = 1 day)
+BOOTSTRAP_BLOCK_LENGTH = 4
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_SEED = 0
+
 # suite dictionary
 # key = ID, value = short name
 # offline
@@ -40,8 +76,9 @@ SUITE_DICT = {'u-bp725': {'time_length': 7.25, 'colour': 'purple'},  # Update =
 START_DATE = dt.datetime(2019, 6, 15, 6, 0, 0)
 END_DATE = dt.datetime(2019, 9, 15, 18, 0, 0)
 
-# each cycle
-DATE_RANGE = eu.date_range(START_DATE, END_DATE, 6, 'hours')
+# each cycle (None = every CYCLE_HOURS hours from START_DATE to END_DATE, see trial_date_range())
+DATE_RANGE = None
+CYCLE_HOURS = 6
 
 # date ranges to loop over if in a suite
 # start_date_in=$(rose date -c -f %Y%m%d%H%M)
@@ -86,9 +123,13 @@ UPDATE_TIME_LIST = [SUITE_DICT[suite_id]['time_length'] for suite_id in SUITE_LI
 # fixed list order to the obs catagories
 OBS_LIST_CATS = OBS_DICT_CATS.keys()
 
-# colourmap for catagory plotting (hard coded for 11 colours)
-CMAP_COLOURS = [list(i) for i in matplotlib.cm.get_cmap('tab10').colors]
-CMAP_COLOURS.append([0.15, 0.15, 0.7])
+# figures drawn by the plot command if none are picked
+DEFAULT_FIGURES = ['files_used', 'total_mean_obs', 'mean_obs_by_type_stacked_line', 'mean_obs_by_type_bar_regions']
+
+# plotting libraries and colours, set by load_plotting() when the first figure is drawn
+plt = None
+PdfPages = None
+CMAP_COLOURS = None
 
 # ==============================================================================
 # Functions
@@ -97,111 +138,363 @@ CMAP_COLOURS.append([0.15, 0.15, 0.7])
 # processing
 
 
-def create_cycle_summary_stats():
+def trial_date_range():
+    """
+    The trial's cycles: DATE_RANGE if set, else every CYCLE_HOURS hours from START_DATE to END_DATE (inclusive)
+    :return: date_range: (list of datetimes)
+    """
+
+    if DATE_RANGE is not None:
+        return DATE_RANGE
+
+    return [START_DATE + dt.timedelta(hours=CYCLE_HOURS * i)
+            for i in range(int((END_DATE - START_DATE).total_seconds() // (CYCLE_HOURS * 3600)) + 1)]
+
+
+def load_trial(rebuild=REBUILD_CUBE):
+    """
+    Load the trial cube. The cycle statistics are packed into a single trial cube the first time, which later runs
+    memory-map. Missing or corrupt cycle files are NaN in the cube and listed in its manifest
+    :keyword rebuild: repack the cube even if there is one for these suites and dates
+    :return: cube, meta_cube, cube_index (see trial_cube.load_trial_cube())
+    """
+
+    return tc.get_trial_cube(CUBE_DIR, CYCLE_STATS_DIR, SUITE_LIST, trial_date_range(), FLAG_LIST, REGION_LIST,
+                             OBS_LIST, rebuild=rebuild, num_workers=NUM_LOAD_WORKERS)
+
+
+def obs_category_matrix():
+    """
+    Membership matrix of the observation types in each category, from OBS_DICT_CATS
+    :return: (numpy array) shape (category, obs) in the order of OBS_LIST_CATS and OBS_LIST. 1.0 if the obs type is in
+        the category, else 0.0
+    """
+
+    return np.array([[1.0 if obs in OBS_DICT_CATS[cat_i] else 0.0 for obs in OBS_LIST] for cat_i in OBS_LIST_CATS])
+
+
+def cycle_summary_arrays(cube):
+    """
+    Calculate sampling statistics on the number of observations present across the cycles e.g. mean number of obs,
+    as single reductions over the cycle axis of the trial cube.
+    :param cube: (array) trial cube [suite, cycle, flag, region, obs], in the order of SUITE_LIST, FLAG_LIST,
+        REGION_LIST and OBS_LIST (see trial_cube.py)
+    :return: (dict) statistic: array [suite, flag, region, obs] for 'mean', 'median', 'stdev', 'IQR' and 'total'
     """
-    Calculate sampling statistics on the number of observations present across the cycles e.g. mean number of obs
+
+    # median, lower and upper quartiles in one go
+    median, q25, q75 = np.nanpercentile(cube, [50, 25, 75], axis=1)
+
+    summary_arrays = {'mean': np.nanmean(cube, axis=1),
+                      'median': median,
+                      'stdev': np.nanstd(cube, axis=1),
+                      'IQR': q75 - q25,
+                      'total': np.nansum(cube, axis=1)}
+
+    return summary_arrays
+
+
+def create_cycle_summary_stats(summary_arrays):
+    """
+    Unpack the sampling statistics into the nested dictionary cycle_summary_stats[suite][flag][region][obs][stat]
+    :param summary_arrays: output from cycle_summary_arrays()
     :return: cycle_summary_stats
     """
 
-    # sampling stats with respect to the observations
     cycle_summary_stats = {suite_id: {
         flag_i: {
-            region_i: {}
-            for region_i in REGION_LIST}
-        for flag_i in FLAG_LIST}
-        for suite_id in SUITE_LIST}
-
-    for suite_id in SUITE_LIST:
-        # create mean stddev, med and IQR for each obs type, across all the cycles
-        for flag in FLAG_LIST:
-            cycle_summary_stats[suite_id][flag] = {}
-            for region in REGION_LIST:
-                cycle_summary_stats[suite_id][flag][region] = {}
-                for obs in OBS_LIST:
-                    # if meta says all obs were present...
-                    cycle_summary_stats[suite_id][flag][region][obs] = {
-                        'mean': np.nanmean(suite_data[suite_id][flag][region][obs]),
-                        'median': np.nanmedian(suite_data[suite_id][flag][region][obs]),
-                        'stdev': np.nanstd(suite_data[suite_id][flag][region][obs]),
-                        'IQR': np.nanpercentile(suite_data[suite_id][flag][region][obs], 75) -
-                               np.nanpercentile(suite_data[suite_id][flag][region][obs], 25),
-                        'total': np.nansum(suite_data[suite_id][flag][region][obs])
-                    }
+            region_i: {
+                obs_i: {stat: summary_arrays[stat][s, f, r, o] for stat in summary_arrays}
+                for o, obs_i in enumerate(OBS_LIST)}
+            for r, region_i in enumerate(REGION_LIST)}
+        for f, flag_i in enumerate(FLAG_LIST)}
+        for s, suite_id in enumerate(SUITE_LIST)}
 
     return cycle_summary_stats
 
 
+def control_ratio_ci(cube):
+    """
+    Confidence intervals of each suite's total mean obs, and mean obs in each category, relative to the
+    CONTROL_SUITE, from a paired block bootstrap over the cycles (see bootstrap_ci.py)
+    :param cube: (array) trial cube [suite, cycle, flag, region, obs]
+    :return: ratio_ci: (dict) 'ratio', 'low', 'high', 'prob_above': arrays [suite, flag, region, category], with the
+        total first then the categories in the order of OBS_LIST_CATS
+    """
+
+    return bci.paired_block_bootstrap(cube, SUITE_LIST.index(CONTROL_SUITE), obs_category_matrix(),
+                                      n_replicates=BOOTSTRAP_REPLICATES, block_length=BOOTSTRAP_BLOCK_LENGTH,
+                                      confidence=BOOTSTRAP_CONFIDENCE, seed=BOOTSTRAP_SEED)
+
+
+def create_region_summary(summary_arrays, ratio_ci=None):
+    """
+    Sum up the mean number of obs across all the obs types, and across the obs types in each category, for each
+    suite, flag and region.
+    :param summary_arrays: output from cycle_summary_arrays()
+    :keyword ratio_ci: output from control_ratio_ci(), added as 'ratio_ci' if given
+    :return: region_summary[suite][flag][region] = {'total': , 'stdev': , 'cat_total': {cat: }} and
+        'ratio_ci': {'total': {'ratio': , 'low': , 'high': , 'prob_above': }, 'cat_total': {cat: {...}}}
+    """
+
+    mean = summary_arrays['mean']
+
+    total = np.nansum(mean, axis=-1)
+    stdev = np.nanstd(mean, axis=-1)
+    # NaN means count as 0, the same as np.nansum, shape (suite, flag, region, cat)
+    cat_total = np.dot(np.where(np.isnan(mean), 0.0, mean), obs_category_matrix().T)
+
+    region_summary = {suite_id: {
+        flag_i: {
+            region_i: {'total': total[s, f, r],
+                       'stdev': stdev[s, f, r],
+                       'cat_total': {cat_i: cat_total[s, f, r, c] for c, cat_i in enumerate(OBS_LIST_CATS)}}
+            for r, region_i in enumerate(REGION_LIST)}
+        for f, flag_i in enumerate(FLAG_LIST)}
+        for s, suite_id in enumerate(SUITE_LIST)}
+
+    if ratio_ci is not None:
+
+        def ci_entry(s, f, r, c):
+            return {key: ratio_ci[key][s, f, r, c] for key in ['ratio', 'low', 'high', 'prob_above']}
+
+        for s, suite_id in enumerate(SUITE_LIST):
+            for f, flag_i in enumerate(FLAG_LIST):
+                for r, region_i in enumerate(REGION_LIST):
+                    region_summary[suite_id][flag_i][region_i]['ratio_ci'] = \
+                        {'total': ci_entry(s, f, r, 0),
+                         'cat_total': {cat_i: ci_entry(s, f, r, c + 1) for c, cat_i in enumerate(OBS_LIST_CATS)}}
+
+    return region_summary
+
+
+def print_summary(region_summary, flags=None, regions=None):
+    """
+    Print the total mean number of obs of each suite, and relative to the control with its confidence interval if
+    region_summary has one, for each flag and region.
+    :param region_summary: output from create_region_summary()
+    :keyword flags: flags to print (default: FLAG_LIST)
+    :keyword regions: regions to print (default: REGION_LIST)
+    :return:
+    """
+
+    for flag in FLAG_LIST if flags is None else flags:
+        for region in REGION_LIST if regions is None else regions:
+            print('\n' + flag + ' ' + region)
+            print('%-10s %8s %14s %8s %20s' % ('suite', 'update', 'total mean obs', 'ratio',
+                                               str(int(BOOTSTRAP_CONFIDENCE * 100)) + '% CI'))
+            control_total = region_summary[CONTROL_SUITE][flag][region]['total']
+            for suite_id in SUITE_LIST:
+                entry = region_summary[suite_id][flag][region]
+                line = '%-10s %8.2f %14.1f %8.4f' % (suite_id, SUITE_DICT[suite_id]['time_length'], entry['total'],
+                                                      entry['total'] / control_total)
+                if 'ratio_ci' in entry:
+                    ci = entry['ratio_ci']['total']
+                    line += '     %.4f - %.4f' % (ci['low'], ci['high'])
+                print(line)
+
+    return
+
+
 # plotting
+#
+# Each plot function is split in two: a *_jobs() function that works out the small arrays each figure needs, and a
+#   render_*() function that draws and saves one figure from them. The figures are independent, so render_figures()
+#   can farm them out to a pool of processes.
+#
+# matplotlib is imported by load_plotting() when the first figure is rendered, so the processing and tables do not
+#   need it.
 
 
-def plot_total_mean_obs(region_summary):
+def load_plotting():
 
     """
-    plot the total mean and stdev of all the observations, per region.
+    Import matplotlib, with the non-interactive backend (figures are only saved, and are rendered in worker
+    processes), and set up the category colours.
+    :return:
+    """
+
+    global plt, PdfPages, CMAP_COLOURS
+
+    if plt is not None:
+        return
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    from matplotlib.backends.backend_pdf import PdfPages as pdf_pages
+
+    plt = matplotlib.pyplot
+    PdfPages = pdf_pages
+
+    # colourmap for catagory plotting (hard coded for 11 colours)
+    CMAP_COLOURS = [list(i) for i in matplotlib.cm.get_cmap('tab10').colors]
+    CMAP_COLOURS.append([0.15, 0.15, 0.7])
 
+    return
+
+
+def files_used_jobs(meta_cube, cube_index):
+
+    """
+    Figure job for the metadata plot of how many obs files each suite used in each cycle.
+    :param meta_cube: (array) [suite, cycle, meta key] (see trial_cube.py)
+    :param cube_index: (dict) the cube's axis labels
+    :return: jobs: (list of dicts)
+    """
+
+    if os.path.exists(SAVEDIR) == False:
+        os.system('mkdir -p ' + SAVEDIR)
+
+    m = cube_index['meta_keys'].index('number_obs_used_in_stats')
+    dates = [dt.datetime.strptime(cycle, tc.CYCLE_FMT) for cycle in cube_index['cycles']]
+
+    return [{'kind': 'files_used', 'dates': dates, 'number_obs_used': np.array(meta_cube[:, :, m]),
+             'savepath': SAVEDIR + '/missing ODB2_files.png'}]
+
+
+def render_files_used(job):
+
+    """
+    Plot up metadata statistics on what was available: the number of obs files used in each cycle, for each suite.
+
+    :param job: (dict) from files_used_jobs()
+    :return: fig
+    """
+
+    fig = plt.figure(figsize=(7, 5))
+    for s, suite_id in enumerate(SUITE_LIST):
+        plt.plot_date(job['dates'], job['number_obs_used'][s],
+                      fmt='-', drawstyle='steps', color=SUITE_DICT[suite_id]['colour'], label=suite_id+' ('+str(SUITE_DICT[suite_id]['time_length'])+')')
+
+    ax=plt.gca()
+    ax.tick_params(axis='x', rotation=45)
+    plt.ylabel('Frequency')
+    plt.xlabel('date [YYYY-MM-DD]')
+    plt.xlim([job['dates'][0], job['dates'][-1]])
+    plt.ylim([20.0, 26.0])  # readjust y
+    plt.legend(loc='best')
+    plt.tight_layout()
+
+    return fig
+
+
+def total_mean_obs_jobs(region_summary):
+
+    """
+    Figure jobs for plot_total_mean_obs(): one figure per flag.
     :param region_summary: (dict) region summary statistics
-    :return:
+    :return: jobs: (list of dicts)
     """
 
+    savedir_total_mean_obs = SAVEDIR + '/total_mean_obs_normed'
+    if os.path.exists(savedir_total_mean_obs) == False:
+        os.system('mkdir -p ' + savedir_total_mean_obs)
+
+    jobs = []
     for flag in FLAG_LIST:
 
-        print flag
+        # normalise the total and stdev
+        total_mean = np.array([[region_summary[suite_id][flag][region]['total']/
+                                region_summary[CONTROL_SUITE][flag][region]['total'] for suite_id in SUITE_LIST]
+                               for region in REGION_LIST])
 
-        savedir_total_mean_obs = SAVEDIR + '/total_mean_obs_normed'
-        if os.path.exists(savedir_total_mean_obs) == False:
-            os.system('mkdir -p ' + savedir_total_mean_obs)
+        # stdev for each suite already pre calculated. Find out its relative value compared to the total of each
+        #   suite (to normalise it), so it can be plotted.
+        stdev_mean = np.array([[region_summary[suite_id][flag][region]['stdev']/
+                                region_summary[suite_id][flag][region]['total'] for suite_id in SUITE_LIST]
+                               for region in REGION_LIST])
 
-        fig = plt.figure(figsize=(7, 5))
+        job = {'kind': 'total_mean_obs', 'flag': flag, 'total_mean': total_mean, 'stdev_mean': stdev_mean,
+               'savepath': savedir_total_mean_obs + '/' + flag + '.png'}
 
-        for region in REGION_LIST:
+        # confidence interval of the ratio to the control, if the bootstrap was run (shaded instead of the stdev)
+        if 'ratio_ci' in region_summary[CONTROL_SUITE][flag][REGION_LIST[0]]:
+            job['ci_low'] = np.array([[region_summary[suite_id][flag][region]['ratio_ci']['total']['low']
+                                       for suite_id in SUITE_LIST] for region in REGION_LIST])
+            job['ci_high'] = np.array([[region_summary[suite_id][flag][region]['ratio_ci']['total']['high']
+                                        for suite_id in SUITE_LIST] for region in REGION_LIST])
 
-            # normalise the total and stdev
-            total_mean = np.array([region_summary[suite_id][flag][region]['total']/
-                                   region_summary[CONTROL_SUITE][flag][region]['total'] for suite_id in SUITE_LIST])
+        jobs += [job]
 
-            # stdev for each suite already pre calculated. Find out its relative value compared to the total of each
-            #   suite (to normalise it), so it can be plotted.
-            stdev_mean = np.array([region_summary[suite_id][flag][region]['stdev']/
-                                   region_summary[suite_id][flag][region]['total'] for suite_id in SUITE_LIST])
+    return jobs
 
-            stdev_minus2 = (total_mean - (2.0*stdev_mean))
-            stdev_plus2 = total_mean + (2.0*stdev_mean)
 
-            ax = plt.plot(UPDATE_TIME_LIST, total_mean, color=REGION_COLOURS[region], marker='o', label=region)
-            plt.fill_between(UPDATE_TIME_LIST, stdev_minus2, stdev_plus2, color=REGION_COLOURS[region], alpha=0.1)
-            plt.plot(UPDATE_TIME_LIST, stdev_plus2, color=REGION_COLOURS[region], linestyle='--', alpha=0.4)  #
-            plt.plot(UPDATE_TIME_LIST, stdev_minus2, color=REGION_COLOURS[region], linestyle='--', alpha=0.4)  #
+def render_total_mean_obs(job):
 
-            # prettify
-            plt.axhline(1, linestyle='--')
-            plt.xlabel('update time [hours]')
-            plt.ylabel('number of obs')
-            plt.suptitle('total mean number of obs (normed to control): '+flag)
-            plt.legend(loc=4)
+    """
+    plot the total mean of all the observations, per region, shaded with the bootstrap confidence interval of the
+    ratio to the control (or +/- 2 stdev if there is none).
 
-            plt.savefig(savedir_total_mean_obs +'/'+flag+'.png')
-            #plt.clf()
+    :param job: (dict) from total_mean_obs_jobs()
+    :return: fig
+    """
 
-        plt.close(fig)
+    print job['flag']
 
-    return
+    fig = plt.figure(figsize=(7, 5))
 
+    for r, region in enumerate(REGION_LIST):
 
-def plot_mean_obs_by_type_stacked_line(region_summary):
+        total_mean = job['total_mean'][r]
+        if 'ci_low' in job:
+            lower = job['ci_low'][r]
+            upper = job['ci_high'][r]
+        else:
+            lower = (total_mean - (2.0*job['stdev_mean'][r]))
+            upper = total_mean + (2.0*job['stdev_mean'][r])
+
+        ax = plt.plot(UPDATE_TIME_LIST, total_mean, color=REGION_COLOURS[region], marker='o', label=region)
+        plt.fill_between(UPDATE_TIME_LIST, lower, upper, color=REGION_COLOURS[region], alpha=0.1)
+        plt.plot(UPDATE_TIME_LIST, upper, color=REGION_COLOURS[region], linestyle='--', alpha=0.4)  #
+        plt.plot(UPDATE_TIME_LIST, lower, color=REGION_COLOURS[region], linestyle='--', alpha=0.4)  #
+
+    # prettify
+    plt.axhline(1, linestyle='--')
+    plt.xlabel('update time [hours]')
+    plt.ylabel('number of obs')
+    if 'ci_low' in job:
+        plt.suptitle('total mean number of obs (normed to control, ' + str(int(BOOTSTRAP_CONFIDENCE * 100)) +
+                     '% CI): ' + job['flag'])
+    else:
+        plt.suptitle('total mean number of obs (normed to control): '+job['flag'])
+    plt.legend(loc=4)
+
+    return fig
+
+
+def plot_total_mean_obs(region_summary):
 
     """
-    Stacked line plot showing observation catagories against update cutoff time. Plotted for each region separately.
-    :param region_summary:
+    plot the total mean and stdev of all the observations, per region.
+
+    :param region_summary: (dict) region summary statistics
     :return:
     """
 
-    for flag in FLAG_LIST:
+    render_figures(total_mean_obs_jobs(region_summary))
+
+    return
+
+
+def mean_obs_by_type_jobs(region_summary, kind):
+
+    """
+    Figure jobs for the stacked line and stacked bar plots by observation category: one figure per flag and region.
+    :param region_summary: (dict) region summary statistics
+    :param kind: 'mean_obs_by_type_stacked_line' or 'mean_obs_by_type_bar'
+    :return: jobs: (list of dicts)
+    """
 
-        print flag
+    subdir = {'mean_obs_by_type_stacked_line': '/total_cat_mean_normed_suite_id/',
+              'mean_obs_by_type_bar': '/total_cat_mean_bar/'}[kind]
+
+    jobs = []
+    for flag in FLAG_LIST:
 
         for region in REGION_LIST:
 
-            savedir_total_mean_obs = SAVEDIR + '/total_cat_mean_normed_suite_id/' + region
+            savedir_total_mean_obs = SAVEDIR + subdir + region
             if os.path.exists(savedir_total_mean_obs) == False:
                 os.system('mkdir -p ' + savedir_total_mean_obs)
 
@@ -213,77 +506,95 @@ def plot_mean_obs_by_type_stacked_line(region_summary):
                                         region_summary[suite_id][flag][region]['total'] for suite_id in SUITE_LIST]
                                        for cat_i in OBS_LIST_CATS])
 
-            fig = plt.figure(figsize=(7, 5))
-            ax = plt.subplot(111)
+            jobs += [{'kind': kind, 'flag': flag, 'region': region, 'norm_cat_array': norm_cat_array,
+                      'savepath': savedir_total_mean_obs + '/total_by_cat_' + flag}]
 
-            st_plt = plt.stackplot(UPDATE_TIME_LIST, *norm_cat_array, labels=OBS_LIST_CATS, colors=CMAP_COLOURS)
+    return jobs
 
-            # prettify
-            box = ax.get_position()
-            ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-            plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
-            ax.autoscale(enable=True, axis='x', tight=True)
-            #plt.axhline(1.0, color='black')
-            plt.suptitle('total mean number of obs by type (normed to suite_id): ' + flag + '; ' + region)
-            plt.xlabel('update time [hours]')
-            plt.ylabel('number of obs')
-            plt.savefig(savedir_total_mean_obs + '/total_by_cat_' + flag)
 
+def render_mean_obs_by_type_stacked_line(job):
 
+    """
+    Stacked line plot showing observation catagories against update cutoff time, for one flag and region.
+    :param job: (dict) from mean_obs_by_type_jobs()
+    :return: fig
+    """
 
-            plt.close()
+    fig = plt.figure(figsize=(7, 5))
+    ax = plt.subplot(111)
 
-    return
+    st_plt = plt.stackplot(UPDATE_TIME_LIST, *job['norm_cat_array'], labels=OBS_LIST_CATS, colors=CMAP_COLOURS)
 
-def plot_mean_obs_by_type_bar(region_summary):
+    # prettify
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+    plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
+    ax.autoscale(enable=True, axis='x', tight=True)
+    #plt.axhline(1.0, color='black')
+    plt.suptitle('total mean number of obs by type (normed to suite_id): ' + job['flag'] + '; ' + job['region'])
+    plt.xlabel('update time [hours]')
+    plt.ylabel('number of obs')
+
+    return fig
+
+
+def plot_mean_obs_by_type_stacked_line(region_summary):
 
     """
-    Stacked bar plot showing the same data as in the stacked line plot above, but in bar form.
+    Stacked line plot showing observation catagories against update cutoff time. Plotted for each region separately.
     :param region_summary:
     :return:
     """
-    for flag in FLAG_LIST:
 
-        print flag
+    render_figures(mean_obs_by_type_jobs(region_summary, 'mean_obs_by_type_stacked_line'))
 
-        for region in REGION_LIST:
+    return
 
-            savedir_total_mean_obs_bar = SAVEDIR + '/total_cat_mean_bar/' + region
-            if os.path.exists(savedir_total_mean_obs_bar) == False:
-                os.system('mkdir -p ' + savedir_total_mean_obs_bar)
 
-            # normalise the data with respect to the total obs in each suite.
-            # Dictionary becomes {cat_1:[suite1, suite2, suite3 ...], cat2: [suite1, suite2 ...] ...}
+def render_mean_obs_by_type_bar(job):
 
-            # CTRL vs suite. Change what it is normalised with respect to here AND change the save directory
-            norm_cat_array = np.array([[region_summary[suite_id][flag][region]['cat_total'][cat_i] /
-                                        region_summary[suite_id][flag][region]['total'] for suite_id in SUITE_LIST]
-                                       for cat_i in OBS_LIST_CATS])
+    """
+    Stacked bar plot showing the same data as in the stacked line plot above, but in bar form.
+    :param job: (dict) from mean_obs_by_type_jobs()
+    :return: fig
+    """
+
+    norm_cat_array = job['norm_cat_array']
+
+    fig = plt.figure(figsize=(7, 5))
+    ax = plt.subplot(111)
 
-            fig = plt.figure(figsize=(7, 5))
-            ax = plt.subplot(111)
+    ind = np.arange(len(UPDATE_TIME_LIST))
+    width = 0.40
 
-            ind = np.arange(len(UPDATE_TIME_LIST))
-            width = 0.40
+    bottom = np.zeros(len(UPDATE_TIME_LIST))
+    for i, cat_i in enumerate(OBS_LIST_CATS):
+        colour_i = CMAP_COLOURS[i]
+        plt.bar(ind, norm_cat_array[i, :], width, bottom=bottom, label=cat_i, color=colour_i)
+        bottom = bottom + norm_cat_array[i, :]
 
-            bottom = np.zeros(len(UPDATE_TIME_LIST))
-            for i, cat_i in enumerate(OBS_LIST_CATS):
-                colour_i = CMAP_COLOURS[i]
-                plt.bar(ind, norm_cat_array[i, :], width, bottom=bottom, label=cat_i, color=colour_i)
-                bottom = bottom + norm_cat_array[i, :]
+    # prettify
+    plt.suptitle('total mean number of obs by type (normed to suite_id): ' + job['flag'] + '; ' + job['region'])
+    plt.xlabel('update time [hours]')
+    plt.ylabel('number of obs')
+    plt.xticks(ind, UPDATE_TIME_LIST)
 
-            # prettify
-            plt.suptitle('total mean number of obs by type (normed to suite_id): ' + flag + '; ' + region)
-            plt.xlabel('update time [hours]')
-            plt.ylabel('number of obs')
-            plt.xticks(ind, UPDATE_TIME_LIST)
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+    plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
 
-            box = ax.get_position()
-            ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-            plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
-            plt.savefig(savedir_total_mean_obs_bar + '/total_by_cat_' + flag)
+    return fig
 
-            plt.close()
+
+def plot_mean_obs_by_type_bar(region_summary):
+
+    """
+    Stacked bar plot showing the same data as in the stacked line plot above, but in bar form.
+    :param region_summary:
+    :return:
+    """
+
+    render_figures(mean_obs_by_type_jobs(region_summary, 'mean_obs_by_type_bar'))
 
     return
 
@@ -346,214 +657,315 @@ def save_table_mean_obs_csv(region_summary):
     return
 
 
-def plot_mean_obs_by_type_bar_regions(region_summary):
+def save_table_ratio_ci_csv(region_summary):
 
     """
-    Plots stacked bar chart for all regions, showing the proportion of different observation types assimilated
-    into the control suite.
-
-    :param region_summary:
+    Save the mean number of observations by category type relative to the control, with its bootstrap confidence
+    interval, for each region, as a csv. Each cell is 'ratio (low - high)'.
+    :param region_summary: with 'ratio_ci' (create_region_summary())
     :return:
     """
 
+    print('saving control ratio confidence interval tables...')
     for flag in FLAG_LIST:
 
-        print flag
+        for region in REGION_LIST:
 
-        # list of length REGION_LIST
-        # each element, relative proportion of obs by category
-        norm_cat_array = np.array([[region_summary[CONTROL_SUITE][flag][region]['cat_total'][cat_i] /
-                                    region_summary[CONTROL_SUITE][flag][region]['total'] for cat_i in OBS_LIST_CATS]
-                                   for region in REGION_LIST])
+            # rows of category, then the total. Columns of update time
+            rows = []
+            for cat_i in OBS_LIST_CATS + ['total']:
+                entries = [region_summary[suite_id][flag][region]['ratio_ci']['total'] if cat_i == 'total' else
+                           region_summary[suite_id][flag][region]['ratio_ci']['cat_total'][cat_i]
+                           for suite_id in SUITE_LIST]
+                rows += [[cat_i] + ['%.4f (%.4f - %.4f)' % (e['ratio'], e['low'], e['high']) for e in entries]]
 
-        stdev_mean = np.array([[region_summary[CONTROL_SUITE][flag][region]['stdev'] /
-                                region_summary[CONTROL_SUITE][flag][region]['total'] for cat_i in OBS_LIST_CATS]
-                               for region in REGION_LIST])
+            ci_table = np.array([[''] + [str(t) for t in UPDATE_TIME_LIST]] + rows, dtype='S32')
 
-        savedir_prop = SAVEDIR + '/proportion_obs_cats_' + CONTROL_SUITE + '_' + region
-        if os.path.exists(savedir_prop) == False:
-            os.system('mkdir -p ' + savedir_prop)
+            table_dir = PROJECT_DIR + 'data/category_tables/' + region + '/'
+            if os.path.exists(table_dir) == False:
+                os.system('mkdir -p ' + table_dir)
 
-        fig = plt.figure(figsize=(7, 5))
-        ax = plt.subplot(111)
+            filename = table_dir + flag + '_ratio_to_control_ci.csv'
+            np.savetxt(filename, ci_table, delimiter=',', fmt='%s')
 
-        ind = np.arange(len(REGION_LIST))
-        width = 0.40
+    return
 
-        bottom = np.zeros(len(REGION_LIST))
-        for i, cat_i in enumerate(OBS_LIST_CATS):
-            colour_i = CMAP_COLOURS[i]
-            plt.bar(ind, norm_cat_array[:, i], width, bottom=bottom, label=cat_i, color=colour_i)
-            bottom = bottom + norm_cat_array[:, i]
 
-        # prettify
-        plt.suptitle('total mean number of obs by type: ' + flag)
-        plt.xlabel('Region')
-        plt.xticks(ind, REGION_LIST)
-        plt.ylabel('proportion of total mean observations')
+def mean_obs_by_type_bar_regions_jobs(region_summary):
 
-        box = ax.get_position()
-        ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-        plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
+    """
+    Figure jobs for plot_mean_obs_by_type_bar_regions(): one figure per flag.
+    :param region_summary:
+    :return: jobs: (list of dicts)
+    """
 
-        plt.savefig(savedir_prop + '/total_by_region_' + flag)
+    # all regions go in the one figure. The directory name has the last region in it, as it always has done
+    savedir_prop = SAVEDIR + '/proportion_obs_cats_' + CONTROL_SUITE + '_' + REGION_LIST[-1]
+    if os.path.exists(savedir_prop) == False:
+        os.system('mkdir -p ' + savedir_prop)
 
-        plt.close()
+    jobs = []
+    for flag in FLAG_LIST:
 
-    return
+        # list of length REGION_LIST
+        # each element, relative proportion of obs by category
+        norm_cat_array = np.array([[region_summary[CONTROL_SUITE][flag][region]['cat_total'][cat_i] /
+                                    region_summary[CONTROL_SUITE][flag][region]['total'] for cat_i in OBS_LIST_CATS]
+                                   for region in REGION_LIST])
 
-if __name__ == '__main__':
+        jobs += [{'kind': 'mean_obs_by_type_bar_regions', 'flag': flag, 'norm_cat_array': norm_cat_array,
+                  'savepath': savedir_prop + '/total_by_region_' + flag}]
 
-    # ==============================================================================
-    # Read
-    # ==============================================================================
+    return jobs
 
-    # read in the data
 
-    # initialise the dictionaries ready
-    suite_meta = {key: {} for key in SUITE_LIST}
+def render_mean_obs_by_type_bar_regions(job):
 
-    # large nested dict: suite_cycle_stats => suite => flag => region => obs
-    suite_data = {suite_id:{
-                     flag_i: {
-                         region_i: {
-                            obs_i: [] for obs_i in OBS_LIST}
-                         for region_i in REGION_LIST}
-                     for flag_i in FLAG_LIST}
-                  for suite_id in SUITE_LIST}
+    """
+    Plots stacked bar chart for all regions, showing the proportion of different observation types assimilated
+    into the control suite.
 
-    region_summary = {key: {} for key in SUITE_LIST}
+    :param job: (dict) from mean_obs_by_type_bar_regions_jobs()
+    :return: fig
+    """
 
-    for date_i in DATE_RANGE:
+    print job['flag']
 
-        print('working on: '+str(date_i))
+    norm_cat_array = job['norm_cat_array']
 
-        for suite_id in SUITE_LIST:
+    fig = plt.figure(figsize=(7, 5))
+    ax = plt.subplot(111)
 
-            # filename
-            filepath = DATADIR+'/R2O_projects/update_cutoff/data/cycle_sql_stats/'+suite_id+'/' + \
-                       date_i.strftime('%Y%m%dT%H%MZ')+'_'+suite_id+'_stats.npy'
+    ind = np.arange(len(REGION_LIST))
+    width = 0.40
 
-            # extract statistics and metadata
-            raw = np.load(filepath, allow_pickle=True).flat[0]
-            suite_cycle_meta = raw['suite_cycle_meta']
-            suite_cycle_stats = raw['suite_cycle_stats']
+    bottom = np.zeros(len(REGION_LIST))
+    for i, cat_i in enumerate(OBS_LIST_CATS):
+        colour_i = CMAP_COLOURS[i]
+        plt.bar(ind, norm_cat_array[:, i], width, bottom=bottom, label=cat_i, color=colour_i)
+        bottom = bottom + norm_cat_array[:, i]
 
-            # append metadata to the dictionary
+    # prettify
+    plt.suptitle('total mean number of obs by type: ' + job['flag'])
+    plt.xlabel('Region')
+    plt.xticks(ind, REGION_LIST)
+    plt.ylabel('proportion of total mean observations')
 
-            #metadata
-            # first handful of cases - initialise the lists ready for data if its the first entry
-            if suite_meta[suite_id] == {}:
-                for key in suite_cycle_meta.keys():
-                    # just add the keys
-                    suite_meta[suite_id][key] = []
-            # add the data
-            for key, item in suite_cycle_meta.items():
-                suite_meta[suite_id][key] += [item]
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+    plt.legend(loc='center left', fontsize=8, bbox_to_anchor=(1, 0.5))
 
-            # now fill the data in. The float values in [suite_cycle_stats] will be taken out and appended to lists
-            for flag in FLAG_LIST:
-                for region in REGION_LIST:
-                    for obs in OBS_LIST:
-                        if obs in suite_cycle_stats[flag][region].keys():
-                            suite_data[suite_id][flag][region][obs] += [suite_cycle_stats[flag][region][obs]]
-                        else:
-                            suite_data[suite_id][flag][region][obs] += [np.nan]
+    return fig
 
-    # ==============================================================================
-    # Process
-    # ==============================================================================
 
-    # create the cycle summary statistics: mean stddev, med and IQR for each obs type, across all the cycles
-    cycle_summary_stats = create_cycle_summary_stats()
+def plot_mean_obs_by_type_bar_regions(region_summary):
 
-    # after all cycles have been read in... calculate the SAMPLING statistics (mean.
-    #    median etc through across the cycles)
+    """
+    Plots stacked bar chart for all regions, showing the proportion of different observation types assimilated
+    into the control suite.
 
-    # --------------------
-    # large nested loop: suite_cycle_stats => suite => flag => region => obs
-    region_summary = {suite_id: {
-                     flag_i: {
-                         region_i: {}
-                         for region_i in REGION_LIST}
-                     for flag_i in FLAG_LIST}
-                  for suite_id in SUITE_LIST}
+    :param region_summary:
+    :return:
+    """
 
-    for suite_id in SUITE_LIST:
-        for flag in FLAG_LIST:
-            for region in REGION_LIST:
+    render_figures(mean_obs_by_type_bar_regions_jobs(region_summary))
 
-                # in the region loop, sum up the means across all the obs that were calculated in the dictionary
-                #   above
-                region_summary[suite_id][flag][region] = {
-                    'total': np.nansum([cycle_summary_stats[suite_id][flag][region][obs]['mean'] for obs in OBS_LIST]),
-                    'stdev': np.nanstd([cycle_summary_stats[suite_id][flag][region][obs]['mean'] for obs in OBS_LIST])}
+    return
 
-                # sum up means across each obs catagory
-                region_summary[suite_id][flag][region]['cat_total'] = {
-                    cat_i:   np.nansum([cycle_summary_stats[suite_id][flag][region][obs]['mean'] for obs in OBS_DICT_CATS[cat_i]])
-                        for cat_i in OBS_DICT_CATS.keys()}
 
+# rendering
 
-    # ==============================================================================
-    # Plotting
-    # ==============================================================================
+RENDERERS = {'files_used': render_files_used,
+             'total_mean_obs': render_total_mean_obs,
+             'mean_obs_by_type_stacked_line': render_mean_obs_by_type_stacked_line,
+             'mean_obs_by_type_bar': render_mean_obs_by_type_bar,
+             'mean_obs_by_type_bar_regions': render_mean_obs_by_type_bar_regions}
 
-    # 0. PLot up metadata statistics on what was available, before plotting the data statistics
-    fig = plt.figure(figsize=(7, 5))
-    for suite_id in SUITE_LIST:
-        plt.plot_date(DATE_RANGE, suite_meta[suite_id]['number_obs_used_in_stats'],
-                      fmt='-', drawstyle='steps', color=SUITE_DICT[suite_id]['colour'], label=suite_id+' ('+str(SUITE_DICT[suite_id]['time_length'])+')')
 
-    ax=plt.gca()
-    ax.tick_params(axis='x', rotation=45)
-    plt.ylabel('Frequency')
-    plt.xlabel('date [YYYY-MM-DD]')
-    plt.xlim([DATE_RANGE[0], DATE_RANGE[-1]])
-    plt.ylim([20.0, 26.0])  # readjust y
-    plt.legend(loc='best')
-    plt.tight_layout()
-    plt.savefig(SAVEDIR +'/missing ODB2_files.png')
+def _render_job_group(jobs):
 
+    """
+    Render a group of figure jobs and save them: either each to its own file, or all to a single multi-page pdf
+    if MULTIPAGE_OUTPUT is set (then the jobs must all be of the same kind).
+    :param jobs: (list of dicts) figure jobs
+    :return:
+    """
 
+    load_plotting()
 
-    # plot mean number of obs vs update length (cycle_summary_stats[flag][region][obs]['mean'])
+    if MULTIPAGE_OUTPUT:
+        with PdfPages(SAVEDIR + '/' + jobs[0]['kind'] + '.pdf') as pdf:
+            for job in jobs:
+                fig = RENDERERS[job['kind']](job)
+                pdf.savefig(fig)
+                plt.close(fig)
+    else:
+        for job in jobs:
+            fig = RENDERERS[job['kind']](job)
+            plt.savefig(job['savepath'])
+            plt.close(fig)
 
-    # 1. total mean number of observations, per flag, per region vs update time length (line with stdev shaded)
-    plot_total_mean_obs(region_summary)
+    return
 
-    # 2. plot mean number of obs split by category (stacked lineplot)
-    plot_mean_obs_by_type_stacked_line(region_summary)
 
-    # 3. Tables for the number of observations in each catagory, against cut-off time
-    # Saves arrays as .csv files to be opened and saved in excel or libre office calc
-    save_table_mean_obs_csv(region_summary)
+def render_figures(jobs, num_workers=None):
 
-    # 4. Proportion of observation types per region together in a single chart, for the control suite (bar chart)
-    plot_mean_obs_by_type_bar_regions(region_summary)
+    """
+    Render figure jobs, farming them out to a pool of processes. Only each job's small arrays are sent to the
+    workers. With MULTIPAGE_OUTPUT set, all the figures of one kind go into a single pdf: SAVEDIR/[kind].pdf, with
+    a worker for each kind.
+    :param jobs: (list of dicts) figure jobs, from the *_jobs() functions
+    :keyword num_workers: (int) number of processes, default RENDER_WORKERS. 1 renders in this process.
+    :return:
+    """
 
+    if num_workers is None:
+        num_workers = RENDER_WORKERS
+
+    # import matplotlib before the workers are forked, so they do not each import it
+    load_plotting()
+
+    if MULTIPAGE_OUTPUT:
+        kinds = sorted(set([job['kind'] for job in jobs]))
+        groups = [[job for job in jobs if job['kind'] == kind] for kind in kinds]
+    else:
+        groups = [[job] for job in jobs]
+
+    if num_workers <= 1 or len(groups) <= 1:
+        for group in groups:
+            _render_job_group(group)
+    else:
+        pool = multiprocessing.Pool(min(num_workers, len(groups)))
+        try:
+            pool.map(_render_job_group, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
+    return
 
 
+def figure_jobs(figures, region_summary, meta_cube, cube_index, flags=None, regions=None):
 
+    """
+    Gather the jobs of the figures picked, optionally only for some flags and regions.
+    :param figures: (list) figure kinds, from RENDERERS
+    :param region_summary: output from create_region_summary()
+    :param meta_cube: (array) [suite, cycle, meta key]
+    :param cube_index: (dict) the cube's axis labels
+    :keyword flags: only these flags (default: all)
+    :keyword regions: only these regions (default: all)
+    :return: jobs: (list of dicts)
+    """
 
+    jobs = []
+    for figure in figures:
+        if figure == 'files_used':
+            jobs += files_used_jobs(meta_cube, cube_index)
+        elif figure == 'total_mean_obs':
+            jobs += total_mean_obs_jobs(region_summary)
+        elif figure in ['mean_obs_by_type_stacked_line', 'mean_obs_by_type_bar']:
+            jobs += mean_obs_by_type_jobs(region_summary, figure)
+        elif figure == 'mean_obs_by_type_bar_regions':
+            jobs += mean_obs_by_type_bar_regions_jobs(region_summary)
 
+    return [job for job in jobs
+            if (flags is None or 'flag' not in job or job['flag'] in flags) and
+            (regions is None or 'region' not in job or job['region'] in regions)]
 
 
+def parse_args(argv):
 
+    """
+    Parse the command line (see the module docstring). No command is the same as 'all'.
+    :param argv: command line arguments, without the script name
+    :return: args: (argparse namespace)
+    """
 
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
 
+    load = commands.add_parser('load', help='pack the trial cube from the cycle statistics files')
+    load.add_argument('--rebuild', action='store_true', help='repack the cube even if there is one')
 
+    summarise = commands.add_parser('summarise', help='print the total mean obs of each suite')
+    tables = commands.add_parser('tables', help='save the csv tables')
+    tables.add_argument('--table', nargs='+', choices=['mean_obs', 'ratio_ci'], default=['mean_obs', 'ratio_ci'],
+                        help='tables to save')
+    plot = commands.add_parser('plot', help='save the figures')
+    plot.add_argument('--figure', nargs='+', choices=sorted(RENDERERS.keys()), default=DEFAULT_FIGURES,
+                      help='figures to draw')
+    plot.add_argument('--workers', type=int, default=RENDER_WORKERS, help='processes rendering the figures')
+    everything = commands.add_parser('all', help='load, summarise, plot the default figures and save the tables')
 
+    for command in [summarise, plot]:
+        command.add_argument('--flag', nargs='+', choices=FLAG_LIST, default=None, help='only these flags')
+        command.add_argument('--region', nargs='+', choices=REGION_LIST, default=None, help='only these regions')
+    for command in [summarise, tables, plot, everything]:
+        command.add_argument('--no-ci', action='store_true', help='skip the bootstrap confidence intervals')
 
+    return parser.parse_args(argv if len(argv) > 0 else ['all'])
 
 
+if __name__ == '__main__':
 
+    args = parse_args(sys.argv[1:])
 
+    # ==============================================================================
+    # Read
+    # ==============================================================================
 
+    # read in the data
+    cube, meta_cube, cube_index = load_trial(rebuild=REBUILD_CUBE or getattr(args, 'rebuild', False))
+    if args.command == 'load':
+        exit(0)
 
+    # ==============================================================================
+    # Process
+    # ==============================================================================
+
+    # create the cycle summary statistics: mean stddev, med and IQR for each obs type, across all the cycles
+    # after all cycles have been read in... calculate the SAMPLING statistics (mean.
+    #    median etc through across the cycles)
+    summary_arrays = cycle_summary_arrays(cube)
+
+    # --------------------
+    # confidence intervals of each suite's mean obs relative to the control, from a paired block bootstrap over the
+    #   cycles. Only worked out if something uses them
+    need_ci = BOOTSTRAP_CI and not args.no_ci and \
+        (args.command in ['summarise', 'all'] or
+         (args.command == 'tables' and 'ratio_ci' in args.table) or
+         (args.command == 'plot' and 'total_mean_obs' in args.figure))
+    ratio_ci = control_ratio_ci(cube) if need_ci else None
 
+    # --------------------
+    # sum up the means across all the obs, and across each obs catagory: region_summary => suite => flag => region
+    region_summary = create_region_summary(summary_arrays, ratio_ci=ratio_ci)
 
+    if args.command in ['summarise', 'all']:
+        print_summary(region_summary, flags=getattr(args, 'flag', None), regions=getattr(args, 'region', None))
 
+    # ==============================================================================
+    # Plotting
+    # ==============================================================================
 
+    # 0. metadata statistics on what was available, before plotting the data statistics
+    # 1. total mean number of observations, per flag, per region vs update time length (line with CI shaded)
+    # 2. plot mean number of obs split by category (stacked lineplot)
+    # 4. Proportion of observation types per region together in a single chart, for the control suite (bar chart)
+    # The figures are independent, so their jobs are gathered up and rendered together by a pool of processes
+    if args.command in ['plot', 'all']:
+        jobs = figure_jobs(getattr(args, 'figure', DEFAULT_FIGURES), region_summary, meta_cube, cube_index,
+                           flags=getattr(args, 'flag', None), regions=getattr(args, 'region', None))
+        render_figures(jobs, num_workers=getattr(args, 'workers', RENDER_WORKERS))
 
+    # 3. Tables for the number of observations in each catagory, against cut-off time
+    # Saves arrays as .csv files to be opened and saved in excel or libre office calc
+    if args.command in ['tables', 'all']:
+        table = getattr(args, 'table', ['mean_obs', 'ratio_ci'])
+        if 'mean_obs' in table:
+            save_table_mean_obs_csv(region_summary)
+        if 'ratio_ci' in table and ratio_ci is not None:
+            save_table_ratio_ci_csv(region_summary)
+
+    exit(0)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python2.7
+
+"""
+Online summary statistics for a running trial. Each cycle's statistics from obs_analyse.py are folded into a
+persistent accumulator for the suite as the cycle finishes, so trial-level summary tables are available at any time
+without re-reading every cycle file.
+
+For each flag, region and obs type the accumulator holds:
+    * count, mean and M2 (Welford's algorithm) for the mean and stdev
+    * the total
+    * a log-bucketed quantile sketch (as in DDSketch) for the median and IQR. Values are counted in buckets whose
+      edges grow by a factor of GAMMA, so any quantile is known to within a relative error of SKETCH_ACCURACY.
+All of these can be updated in O(1) per cycle and merged, e.g. to combine accumulators built in parallel.
+
+A cycle that is folded in again with different values (e.g. reprocessed with obs_analyse.OVERRIDE_CYCLE_STATS) has
+its old values, read back from its previous statistics file, taken out before the new ones go in. Only a digest of
+each cycle's values is kept, to check the old values are the ones that were folded in. If they are not known, or do
+not match, the cycle is listed as stale instead, with a warning.
+
+The accumulator is a dictionary of numpy arrays, checkpointed to disk as an .npz file.
+
+Usage: python online_stats.py [accumulator .npz files] to print the summary tables.
+"""
+
+import numpy as np
+import os
+import hashlib
+import sys
+import fcntl
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+# relative accuracy of the quantiles, and the bucket growth factor that gives it
+SKETCH_ACCURACY = 0.01
+GAMMA = (1.0 + SKETCH_ACCURACY) / (1.0 - SKETCH_ACCURACY)
+
+# values from 1 up to 1e10 observations can be bucketed. Values below 1 (i.e. 0 obs) go in their own bucket (0)
+SKETCH_MAX_VALUE = 1.0e10
+NUM_BUCKETS = int(np.ceil(np.log(SKETCH_MAX_VALUE) / np.log(GAMMA))) + 2
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def new_accumulator(flags, regions, obs_list=()):
+    """
+    Create an empty accumulator. The obs axis grows as new obs types are seen.
+    :param flags: flag names
+    :param regions: region names (including 'GLOBAL')
+    :keyword obs_list: obs types known so far
+    :return: acc: (dict)
+    """
+
+    shape = (len(flags), len(regions), len(obs_list))
+
+    acc = {'flags': list(flags),
+           'regions': list(regions),
+           'obs': list(obs_list),
+           'cycles': [],
+           'count': np.zeros(shape, dtype=np.int64),
+           'mean': np.zeros(shape),
+           'M2': np.zeros(shape),
+           'total': np.zeros(shape),
+           'sketch': np.zeros(shape + (NUM_BUCKETS,), dtype=np.int32),
+           # digest of the values folded in for each cycle ('' if not known)
+           'cycle_digests': [],
+           # cycles folded in again with different values, that could not be taken out first
+           'stale_cycles': []}
+
+    return acc
+
+
+def _add_obs(acc, obs_list):
+    """
+    Extend the obs axis of the accumulator with any obs types it does not have yet.
+    """
+
+    new_obs = [obs for obs in obs_list if obs not in acc['obs']]
+    if len(new_obs) == 0:
+        return
+
+    for key in ['count', 'mean', 'M2', 'total', 'sketch']:
+        pad = [(0, 0)] * acc[key].ndim
+        pad[2] = (0, len(new_obs))
+        acc[key] = np.pad(acc[key], pad, mode='constant')
+    acc['obs'] += new_obs
+
+    return
+
+
+def _bucket(values):
+    """
+    Sketch bucket of each value: 0 for values below 1, else 1 + ceil(log_gamma(value))
+    """
+
+    buckets = np.zeros(values.shape, dtype=np.int64)
+    positive = values >= 1.0
+    buckets[positive] = 1 + np.ceil(np.log(values[positive]) / np.log(GAMMA)).astype(np.int64)
+
+    return np.clip(buckets, 0, NUM_BUCKETS - 1)
+
+
+def _bucket_value(buckets):
+    """
+    Representative value of each bucket, within SKETCH_ACCURACY of every value in it.
+    """
+
+    return np.where(buckets == 0, 0.0, 2.0 * GAMMA ** (buckets - 1) / (GAMMA + 1.0))
+
+
+def _cycle_values(acc, suite_cycle_stats):
+    """
+    [flag, region, obs] array of a cycle's values, NaN where an obs is missing
+    """
+
+    return np.array([[[suite_cycle_stats[flag][region].get(obs, np.nan) for obs in acc['obs']]
+                      for region in acc['regions']]
+                     for flag in acc['flags']], dtype=np.float64)
+
+
+def _digest(acc, x):
+    """
+    Digest of a cycle's values, that does not depend on the order of the obs axis
+    :param x: (array) [flag, region, obs] values, NaN where missing
+    """
+
+    f, r, o = np.nonzero(~np.isnan(x))
+    entries = sorted(zip([acc['flags'][i] for i in f], [acc['regions'][i] for i in r], [acc['obs'][i] for i in o],
+                         [repr(float(value)) for value in x[f, r, o]]))
+
+    return hashlib.md5(repr(entries)).hexdigest()
+
+
+def _fold_values(acc, x):
+    """
+    Add one cycle's values to the statistics
+    :param x: (array) [flag, region, obs] values, NaN where missing
+    """
+
+    present = ~np.isnan(x)
+    x0 = np.where(present, x, 0.0)
+
+    # Welford update, only for the entries present this cycle
+    acc['count'] += present
+    delta = x0 - acc['mean']
+    acc['mean'] += np.where(present, delta / np.maximum(acc['count'], 1), 0.0)
+    acc['M2'] += np.where(present, delta * (x0 - acc['mean']), 0.0)
+    acc['total'] += x0
+
+    # add one to the sketch bucket of each entry present
+    f, r, o = np.nonzero(present)
+    np.add.at(acc['sketch'], (f, r, o, _bucket(x[present])), 1)
+
+    return
+
+
+def _unfold_values(acc, x):
+    """
+    Take one cycle's values, added by _fold_values(), back out of the statistics
+    :param x: (array) [flag, region, obs] values, NaN where missing
+    """
+
+    present = ~np.isnan(x)
+    x0 = np.where(present, x, 0.0)
+
+    # Welford update in reverse, only for the entries present in the cycle
+    remaining = acc['count'] - present
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(present, np.where(remaining > 0, (acc['count'] * acc['mean'] - x0) / np.maximum(remaining, 1),
+                                          0.0), acc['mean'])
+        acc['M2'] = np.where(present, np.where(remaining > 0, acc['M2'] - (x0 - mean) * (x0 - acc['mean']), 0.0),
+                             acc['M2'])
+    acc['mean'] = mean
+    acc['count'] = remaining
+    acc['total'] -= x0
+
+    f, r, o = np.nonzero(present)
+    np.add.at(acc['sketch'], (f, r, o, _bucket(x[present])), -1)
+
+    return
+
+
+def update_accumulator(acc, suite_cycle_stats, cycle, previous_cycle_stats=None):
+    """
+    Fold one cycle's statistics into the accumulator. A cycle that has already been folded in is not counted twice:
+    if its values are different this time (e.g. it was reprocessed), its previous values are taken out and the new
+    ones put in. If the previous values are not given, or are not the ones that were folded in, it is listed in
+    acc['stale_cycles'] with a warning, and left as it was.
+    :param acc: (dict) accumulator
+    :param suite_cycle_stats: suite_cycle_stats[flag][region][obs] = value, as saved by obs_analyse.py
+    :param cycle: (str) cycle e.g. '20190615T0600Z'
+    :keyword previous_cycle_stats: the cycle's statistics from before it was reprocessed, in the same form
+    :return: updated: (bool) False if the accumulator is unchanged (the cycle was already in it with the same values)
+    """
+
+    obs_list = set([obs for stats in [suite_cycle_stats, previous_cycle_stats or {}]
+                    for flag in acc['flags'] for region in acc['regions'] if flag in stats
+                    for obs in stats[flag][region].keys()])
+    _add_obs(acc, obs_list)
+
+    x = _cycle_values(acc, suite_cycle_stats)
+    digest = _digest(acc, x)
+
+    if cycle not in acc['cycles']:
+        _fold_values(acc, x)
+        acc['cycles'] += [cycle]
+        acc['cycle_digests'] += [digest]
+        return True
+
+    c = acc['cycles'].index(cycle)
+    if acc['cycle_digests'][c] == digest:
+        return False
+
+    old = None
+    if previous_cycle_stats is not None:
+        old = _cycle_values(acc, previous_cycle_stats)
+    if old is None or acc['cycle_digests'][c] == '' or _digest(acc, old) != acc['cycle_digests'][c]:
+        if cycle in acc['stale_cycles']:
+            return False
+        print('WARNING: ' + cycle + ' is already in the online statistics, with values that are not known, so it can '
+              'not be replaced. The online statistics are stale for it: rebuild them from the cycle files')
+        acc['stale_cycles'] += [cycle]
+        return True
+
+    # the cycle was reprocessed: replace its values
+    _unfold_values(acc, old)
+    _fold_values(acc, x)
+    acc['cycle_digests'][c] = digest
+
+    return True
+
+
+def merge_accumulators(acc_a, acc_b):
+    """
+    Merge two accumulators (with the same flags and regions) into a new one, e.g. built from different cycles.
+    :return: acc: (dict) merged accumulator
+    """
+
+    acc = new_accumulator(acc_a['flags'], acc_a['regions'], acc_a['obs'])
+    _add_obs(acc, acc_b['obs'])
+
+    def aligned(src):
+        out = new_accumulator(acc['flags'], acc['regions'], acc['obs'])
+        idx = [acc['obs'].index(obs) for obs in src['obs']]
+        for key in ['count', 'mean', 'M2', 'total', 'sketch']:
+            out[key][:, :, idx] = src[key]
+        return out
+
+    a, b = aligned(acc_a), aligned(acc_b)
+
+    # Chan et al. parallel combination of the Welford statistics
+    acc['count'] = a['count'] + b['count']
+    n = np.maximum(acc['count'], 1)
+    delta = b['mean'] - a['mean']
+    acc['mean'] = a['mean'] + delta * b['count'] / n
+    acc['M2'] = a['M2'] + b['M2'] + delta ** 2 * a['count'] * b['count'] / n
+    acc['total'] = a['total'] + b['total']
+    acc['sketch'] = a['sketch'] + b['sketch']
+
+    # kept in cycle order
+    cycles = acc_a['cycles'] + acc_b['cycles']
+    order = sorted(range(len(cycles)), key=lambda i: cycles[i])
+    acc['cycles'] = [cycles[i] for i in order]
+    digests = acc_a['cycle_digests'] + acc_b['cycle_digests']
+    acc['cycle_digests'] = [digests[i] for i in order]
+    acc['stale_cycles'] = sorted(set(acc_a['stale_cycles'] + acc_b['stale_cycles']))
+
+    return acc
+
+
+def sketch_quantiles(sketch, quantiles):
+    """
+    Quantiles from the sketch, for every flag, region and obs at once.
+    :param sketch: (array) [..., bucket] counts
+    :param quantiles: list of quantiles in [0, 1]
+    :return: (array) [quantile, ...], NaN where there is no data
+    """
+
+    cumulative = np.cumsum(sketch, axis=-1)
+    n = cumulative[..., -1]
+
+    out = []
+    for q in quantiles:
+        # first bucket whose cumulative count passes the rank of the quantile
+        rank = q * (n - 1)
+        bucket = np.argmax(cumulative > rank[..., None], axis=-1)
+        out += [np.where(n > 0, _bucket_value(bucket), np.nan)]
+
+    return np.array(out)
+
+
+def accumulator_summary(acc):
+    """
+    Summary statistics from the accumulator, in the same shape as a suite's entry in cycle_summary_stats from
+    odb2_stat_processing.py: summary[flag][region][obs] = {'mean', 'median', 'stdev', 'IQR', 'total', 'n_cycles'}
+    The median and quartiles are from the sketch, so are within SKETCH_ACCURACY (relative) of the exact values.
+    :param acc: (dict) accumulator
+    :return: summary: (dict)
+    """
+
+    count = acc['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, acc['mean'], np.nan)
+        stdev = np.where(count > 0, np.sqrt(acc['M2'] / count), np.nan)
+    median, q25, q75 = sketch_quantiles(acc['sketch'], [0.5, 0.25, 0.75])
+
+    summary = {flag_i: {
+        region_i: {
+            obs_i: {'mean': mean[f, r, o],
+                    'median': median[f, r, o],
+                    'stdev': stdev[f, r, o],
+                    'IQR': q75[f, r, o] - q25[f, r, o],
+                    'total': acc['total'][f, r, o],
+                    'n_cycles': count[f, r, o]}
+            for o, obs_i in enumerate(acc['obs'])}
+        for r, region_i in enumerate(acc['regions'])}
+        for f, flag_i in enumerate(acc['flags'])}
+
+    return summary
+
+
+def save_accumulator(filepath, acc):
+    """
+    Checkpoint the accumulator to disk. Written to a temporary file and renamed into place, so a task that dies part
+    way through never leaves a broken checkpoint.
+    """
+
+    tmp_filepath = filepath + '.tmp.npz'
+    np.savez(tmp_filepath, **{key: np.array(value) for key, value in acc.iteritems()})
+    os.rename(tmp_filepath, filepath)
+
+    return
+
+
+def load_accumulator(filepath):
+    """
+    Load a checkpointed accumulator.
+    """
+
+    with np.load(filepath) as data:
+        acc = {key: data[key] for key in data.files}
+    for key in ['flags', 'regions', 'obs', 'cycles', 'stale_cycles']:
+        acc[key] = [str(i) for i in acc.get(key, [])]
+
+    # saved before the digests were kept: each cycle's values are not known
+    if 'cycle_digests' in acc:
+        acc['cycle_digests'] = [str(i) for i in acc['cycle_digests']]
+    else:
+        acc['cycle_digests'] = [''] * len(acc['cycles'])
+    for key in ['cycle_values', 'cycle_known']:
+        acc.pop(key, None)
+
+    return acc
+
+
+def fold_cycle_into_checkpoint(filepath, suite_cycle_stats, cycle, flags, regions, previous_cycle_stats=None):
+    """
+    Load the suite's accumulator checkpoint (or start a new one), fold in this cycle's statistics and save it.
+    A lock file stops cycles running at the same time from overwriting each other's updates.
+    :param filepath: accumulator checkpoint (.npz)
+    :param suite_cycle_stats: suite_cycle_stats[flag][region][obs] = value
+    :param cycle: (str) cycle e.g. '20190615T0600Z'
+    :param flags: flag names
+    :param regions: region names (including 'GLOBAL')
+    :keyword previous_cycle_stats: the cycle's statistics from before it was reprocessed, if it was
+    :return:
+    """
+
+    with open(filepath + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(filepath):
+                acc = load_accumulator(filepath)
+            else:
+                acc = new_accumulator(flags, regions)
+            if update_accumulator(acc, suite_cycle_stats, cycle, previous_cycle_stats=previous_cycle_stats):
+                save_accumulator(filepath, acc)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return
+
+
+def print_summary_table(acc, obs='all_obs'):
+    """
+    Print a live summary table of one obs type (default: the total across all obs) for every flag and region.
+    """
+
+    summary = accumulator_summary(acc)
+    print('%d cycles: %s to %s' % (len(acc['cycles']), min(acc['cycles']), max(acc['cycles'])))
+    if len(acc['stale_cycles']) > 0:
+        print('WARNING: stale for ' + str(len(acc['stale_cycles'])) + ' reprocessed cycles: ' +
+              ' '.join(acc['stale_cycles']))
+    print('%-20s %-8s %14s %14s %14s %14s' % ('flag', 'region', 'mean', 'stdev', 'median', 'IQR'))
+    for flag in acc['flags']:
+        for region in acc['regions']:
+            s = summary[flag][region][obs]
+            print('%-20s %-8s %14.1f %14.1f %14.1f %14.1f' % (flag, region, s['mean'], s['stdev'], s['median'],
+                                                              s['IQR']))
+
+    return
+
+
+if __name__ == '__main__':
+
+    for filepath in sys.argv[1:]:
+        print('\n' + filepath)
+        print_summary_table(load_accumulator(filepath))
+
+    exit(0)
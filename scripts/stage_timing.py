@@ -0,0 +1,192 @@
+#!/usr/bin/env python2.7
+
+"""
+Per-stage timing records for obs_analyse.py. Each stage of a cycle (listing the files on MASS, moo get, gunzip, the
+query and saving the statistics) is timed for each instrument, with the bytes moved, rows returned and the peak
+memory of the process and of its children (moo, gunzip and odb sql) so far. The records for a cycle are written as
+json lines next to the cycle's log file.
+
+Usage: python stage_timing.py [timing files or directories of them] [--top N]
+    to report which stages and instruments take the most time, across all the cycles and suites given.
+"""
+
+import os
+import json
+import glob
+import time
+import resource
+import argparse
+import threading
+from contextlib import contextmanager
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+TIMINGS_SUFFIX = '_obs_analyse_timings.jsonl'
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def timings_filepath(logdir, suite_id, cycle_str):
+    """
+    Timing records filepath for a cycle, next to its log file
+    """
+
+    return logdir + '/' + suite_id + '_' + cycle_str + TIMINGS_SUFFIX
+
+
+def new_timer(filepath, suite_id, cycle_str):
+    """
+    Start collecting the timing records of a cycle. Stages can be timed from several threads at once.
+    :param filepath: where write_timer() will write the records
+    :param suite_id: suite id
+    :param cycle_str: cycle e.g. '20190615T0600Z'
+    :return: timer: (dict)
+    """
+
+    return {'filepath': filepath, 'suite': suite_id, 'cycle': cycle_str, 'records': [], 'lock': threading.Lock()}
+
+
+def _add_record(timer, record, start):
+    """
+    Finish a record started at time start, and add it to the timer
+    """
+
+    record['start'] = start
+    record['wall'] = time.time() - start
+    # ru_maxrss is in kB on linux
+    record['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    record['peak_child_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    with timer['lock']:
+        timer['records'].append(record)
+
+    return
+
+
+@contextmanager
+def stage(timer, stage_name, obs='all'):
+    """
+    Time a stage. The record is yielded so that 'bytes' and 'rows' can be filled in inside the with block.
+    The record is kept whether or not the stage raises, with 'ok' set accordingly.
+    :param timer: (dict) from new_timer(), or None to not time anything
+    :param stage_name: e.g. 'moo_get'
+    :keyword obs: instrument, or 'all' for stages covering the whole cycle
+    """
+
+    record = {'suite': None if timer is None else timer['suite'],
+              'cycle': None if timer is None else timer['cycle'],
+              'obs': obs, 'stage': stage_name, 'bytes': 0, 'rows': 0, 'ok': False}
+    start = time.time()
+    try:
+        yield record
+        record['ok'] = True
+    finally:
+        if timer is not None:
+            _add_record(timer, record, start)
+
+
+def record_since(timer, stage_name, start, obs='all', rows=0, bytes=0):
+    """
+    Record a stage that started at time start (from time.time()) and has just finished, e.g. the whole cycle
+    """
+
+    if timer is not None:
+        _add_record(timer, {'suite': timer['suite'], 'cycle': timer['cycle'], 'obs': obs, 'stage': stage_name,
+                            'bytes': bytes, 'rows': rows, 'ok': True}, start)
+
+    return
+
+
+def write_timer(timer):
+    """
+    Write the cycle's timing records as json lines, replacing any from an earlier run of the cycle
+    """
+
+    with timer['lock']:
+        records = sorted(timer['records'], key=lambda r: r['start'])
+    with open(timer['filepath'], 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    return
+
+
+def read_timings(paths):
+    """
+    Read timing records from files, or from all the timing files in directories
+    :param paths: timing files and/or directories
+    :return: records: (list of dicts)
+    """
+
+    records = []
+    for path in paths:
+        filepaths = sorted(glob.glob(path + '/*' + TIMINGS_SUFFIX)) if os.path.isdir(path) else [path]
+        for filepath in filepaths:
+            with open(filepath, 'r') as f:
+                records += [json.loads(line) for line in f if line.strip() != '']
+
+    return records
+
+
+def aggregate(records, keys):
+    """
+    Aggregate the records by the given keys
+    :param keys: record keys to group by, e.g. ['stage'] or ['obs', 'stage']
+    :return: list of (group, {'n', 'wall', 'max_wall', 'bytes', 'rows', 'failed', 'peak_rss_mb'}), largest total
+        wall time first
+    """
+
+    groups = {}
+    for r in records:
+        group = tuple([r[key] for key in keys])
+        g = groups.setdefault(group, {'n': 0, 'wall': 0.0, 'max_wall': 0.0, 'bytes': 0, 'rows': 0, 'failed': 0,
+                                      'peak_rss_mb': 0.0})
+        g['n'] += 1
+        g['wall'] += r['wall']
+        g['max_wall'] = max(g['max_wall'], r['wall'])
+        g['bytes'] += r['bytes']
+        g['rows'] += r['rows']
+        g['failed'] += 0 if r['ok'] else 1
+        g['peak_rss_mb'] = max(g['peak_rss_mb'], r['peak_rss_mb'], r['peak_child_rss_mb'])
+
+    return sorted(groups.items(), key=lambda item: item[1]['wall'], reverse=True)
+
+
+def print_report(records, top=20):
+    """
+    Print the total time in each stage, then the instrument and stage pairs taking the most time. Stages run at the
+    same time (e.g. with PIPELINE_MODE) overlap, so the stage times can add up to more than the cycle time.
+    """
+
+    cycles = set([(r['suite'], r['cycle']) for r in records])
+    total_wall = sum([r['wall'] for r in records if r['stage'] == 'cycle'])
+    print('%d records from %d suite cycles, %.1f s in total' % (len(records), len(cycles), total_wall))
+
+    header = '%-32s %8s %12s %10s %10s %12s %12s %8s %10s'
+    row = '%-32s %8d %12.1f %10.2f %10.2f %12.1f %12d %8d %10.0f'
+    per_obs_records = [r for r in records if r['obs'] != 'all']
+    for group_records, keys, title in [(records, ['stage'], 'by stage'),
+                                       (per_obs_records, ['obs', 'stage'],
+                                        'by instrument and stage (top ' + str(top) + ')')]:
+        print('\n' + title)
+        print(header % ('', 'n', 'wall [s]', 'mean [s]', 'max [s]', 'MB', 'rows', 'failed', 'RSS [MB]'))
+        for group, g in aggregate(group_records, keys)[:top]:
+            print(row % (' '.join(group), g['n'], g['wall'], g['wall'] / g['n'], g['max_wall'],
+                         g['bytes'] / 1024.0 ** 2, g['rows'], g['failed'], g['peak_rss_mb']))
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='timing files, or directories of them (e.g. the log directories)')
+    parser.add_argument('--top', type=int, default=20, help='number of instrument and stage rows to show')
+    args = parser.parse_args()
+
+    print_report(read_timings(args.paths), top=args.top)
+
+    exit(0)
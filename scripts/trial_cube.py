@@ -0,0 +1,413 @@
+#!/usr/bin/env python2.7
+
+"""
+Consolidated trial cube for the cycle statistics created by obs_analyse.py.
+
+Reading the trial back means reading one _stats.npy file per suite per cycle. Instead, the cycle files are
+packed once into a single dense array on disk, indexed [suite, cycle, flag, region, obs], with the metadata in a
+second array indexed [suite, cycle, meta key] and a small json index sidecar holding the axis labels. Later runs
+memory-map the arrays instead of reading every cycle again. Missing entries are NaN. The cycle files can be in
+either of the formats read by cycle_stats_file.py.
+
+The cycle files are read by a pool of processes. Missing or corrupt cycle files do not stop the build: they are
+listed in a manifest saved next to the cube, and left as NaN so the np.nan* statistics downstream ignore them. The
+manifest also keeps the modification time and size each cycle file had when it was read, so when the cube is loaded
+again the cycle files that have changed since (e.g. rewritten by a rerun of the cycle) or have appeared are read
+again into the cube, without rebuilding it.
+"""
+
+import numpy as np
+import os
+import json
+import datetime as dt
+import multiprocessing
+
+import cycle_stats_file
+
+# ==============================================================================
+# Setup
+# ==============================================================================
+
+CUBE_FILENAME = 'trial_cube.npy'
+META_FILENAME = 'trial_cube_meta.npy'
+INDEX_FILENAME = 'trial_cube_index.json'
+MANIFEST_FILENAME = 'trial_cube_manifest.json'
+
+# metadata saved with each cycle by obs_analyse.create_metadata_num_files()
+META_KEYS = ['number_obs_files_on_mass', 'number_obs_used_in_stats', 'all_obs_files_ok']
+
+CYCLE_FMT = '%Y%m%dT%H%MZ'
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+
+
+def cycle_stats_filepath(data_dir, suite_id, date_i):
+    """
+    Filepath of a suite's cycle statistics, as saved by obs_analyse.py
+    :param data_dir: directory with a subdirectory of cycle statistics for each suite
+    :param suite_id: e.g. 'u-bo796'
+    :param date_i: (datetime) cycle
+    :return: filepath
+    """
+
+    return data_dir + '/' + suite_id + '/' + date_i.strftime(CYCLE_FMT) + '_' + suite_id + '_stats.npy'
+
+
+def read_cycle_stats(filepath):
+    """
+    Read a cycle's statistics and metadata, from a file in either format
+    :param filepath: cycle statistics filepath
+    :return: suite_cycle_stats, suite_cycle_meta
+    """
+
+    suite_cycle_stats, suite_cycle_meta, _ = cycle_stats_file.read_cycle_stats(filepath)
+
+    return suite_cycle_stats, suite_cycle_meta
+
+
+def cycle_entry_arrays(suite_cycle_stats, suite_cycle_meta, index):
+    """
+    Convert one cycle's statistics into arrays ready for the cube. Obs missing from the cycle are NaN.
+    :return: stats_array: [flag, region, obs], meta_array: [meta key]
+    """
+
+    stats_array = np.array([[[suite_cycle_stats[flag][region].get(obs, np.nan) for obs in index['obs']]
+                             for region in index['regions']]
+                            for flag in index['flags']], dtype=np.float64)
+    meta_array = np.array([float(suite_cycle_meta.get(key, np.nan)) for key in index['meta_keys']])
+
+    return stats_array, meta_array
+
+
+def record_entry_arrays(record, index):
+    """
+    Convert one cycle's fixed-schema record (see cycle_stats_file.py) into arrays ready for the cube, by matching its
+    axis labels to the cube's. Flags, regions and obs missing from the cycle are NaN.
+    :return: stats_array: [flag, region, obs], meta_array: [meta key]
+    """
+
+    selection = []
+    for axis in ['flags', 'regions', 'obs']:
+        positions = {str(label): i for i, label in enumerate(record[axis][0])}
+        wanted = [positions.get(label, -1) for label in index[axis]]
+        selection += [(np.array([i for i, p in enumerate(wanted) if p >= 0], dtype=int),
+                       np.array([p for p in wanted if p >= 0], dtype=int))]
+    (flag_to, flag_from), (region_to, region_from), (obs_to, obs_from) = selection
+
+    stats_array = np.full((len(index['flags']), len(index['regions']), len(index['obs'])), np.nan)
+    stats_array[np.ix_(flag_to, region_to, obs_to)] = record['stats'][0][np.ix_(flag_from, region_from, obs_from)]
+    meta_array = np.array([float(record[key][0]) if key in record.dtype.names else np.nan
+                           for key in index['meta_keys']])
+
+    return stats_array, meta_array
+
+
+def file_stamp(filepath):
+    """
+    Modification time and size of a file, to tell whether it has changed since
+    :return: [mtime, size], or None if the file does not exist
+    """
+
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+
+    return [stat.st_mtime, stat.st_size]
+
+
+def _load_cycle_entry(args):
+    """
+    Pool worker: read one cycle file into arrays.
+    :param args: (s, c, filepath, index)
+    :return: s, c, filepath, status ('ok', 'missing' or 'corrupt'), stats_array, meta_array, error message, stamp
+        (from file_stamp(), taken before the file is read, so a file rewritten while it is read is read again later)
+    """
+
+    s, c, filepath, index = args
+
+    stamp = file_stamp(filepath)
+    if stamp is None:
+        return s, c, filepath, 'missing', None, None, '', None
+
+    # a truncated or otherwise bad file can fail in many different ways: record any of them against the file
+    try:
+        if cycle_stats_file.is_legacy_file(filepath):
+            suite_cycle_stats, suite_cycle_meta = read_cycle_stats(filepath)
+            stats_array, meta_array = cycle_entry_arrays(suite_cycle_stats, suite_cycle_meta, index)
+        else:
+            stats_array, meta_array = record_entry_arrays(cycle_stats_file.load_cycle_record(filepath), index)
+    except Exception as e:
+        return s, c, filepath, 'corrupt', None, None, repr(e), stamp
+
+    return s, c, filepath, 'ok', stats_array, meta_array, '', stamp
+
+
+def pack_cycle_entries(tasks, cube, meta_cube, index, manifest, num_workers=8):
+    """
+    Read cycle files into the cube with a pool of processes. Files that are missing or corrupt are set to NaN and
+    listed in the manifest, and the stamp of each file read is kept in the manifest.
+    :param tasks: list of (s, c, filepath, index), see _load_cycle_entry()
+    :param cube: (writeable array) [suite, cycle, flag, region, obs]
+    :param meta_cube: (writeable array) [suite, cycle, meta key]
+    :param index: (dict) axis labels
+    :param manifest: (dict) 'missing', 'corrupt' and 'stamps', updated in place
+    :keyword num_workers: (int) number of processes reading the cycle files
+    :return:
+    """
+
+    pool = multiprocessing.Pool(max(1, min(num_workers, len(tasks))))
+    try:
+        for n, (s, c, filepath, status, stats_array, meta_array, error, stamp) in \
+                enumerate(pool.imap_unordered(_load_cycle_entry, tasks, chunksize=8)):
+            if status == 'ok':
+                cube[s, c] = stats_array
+                meta_cube[s, c] = meta_array
+            else:
+                cube[s, c] = np.nan
+                meta_cube[s, c] = np.nan
+                entry = {'suite': index['suites'][s], 'cycle': index['cycles'][c], 'filepath': filepath}
+                if status == 'corrupt':
+                    entry['error'] = error
+                manifest[status] += [entry]
+            if stamp is not None:
+                manifest['stamps'][filepath] = stamp
+            if (n + 1) % 100 == 0:
+                print('packed ' + str(n + 1) + '/' + str(len(tasks)) + ' cycle files')
+    finally:
+        pool.close()
+        pool.join()
+
+    # keep the manifest in a fixed order, as the files are read in any order
+    for status in ['missing', 'corrupt']:
+        manifest[status] = sorted(manifest[status], key=lambda e: (e['cycle'], e['suite']))
+
+    return
+
+
+def save_manifest(cube_dir, manifest):
+    """
+    Save the manifest of a trial cube. Written to a temporary file and renamed, so it is never left half written.
+    """
+
+    with open(cube_dir + '/' + MANIFEST_FILENAME + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(cube_dir + '/' + MANIFEST_FILENAME + '.tmp', cube_dir + '/' + MANIFEST_FILENAME)
+
+    return
+
+
+def build_trial_cube(cube_dir, data_dir, suite_list, date_range, flag_list, region_list, obs_list, num_workers=8):
+    """
+    Pack all the cycle statistics files into the trial cube, then load it. The files are read by a pool of
+    processes. Missing and corrupt files are left as NaN and listed in the manifest.
+
+    The arrays are written to temporary files first and renamed into place, with the index written last, so an
+    interrupted build never leaves a cube that looks complete.
+    :param cube_dir: directory to save the cube in
+    :param data_dir: directory with a subdirectory of cycle statistics for each suite
+    :param suite_list: suite ids
+    :param date_range: (list of datetimes) cycles
+    :param flag_list: flags, e.g. ['active', 'rejected', ...]
+    :param region_list: regions, e.g. ['SH', 'NH', ..., 'GLOBAL']
+    :param obs_list: observation types
+    :keyword num_workers: (int) number of processes reading the cycle files
+    :return: cube, meta_cube, index (see load_trial_cube())
+    """
+
+    if not os.path.exists(cube_dir):
+        os.system('mkdir -p ' + cube_dir)
+    # any old cube is no longer complete once its arrays start being replaced
+    if os.path.exists(cube_dir + '/' + INDEX_FILENAME):
+        os.remove(cube_dir + '/' + INDEX_FILENAME)
+
+    index = {'suites': list(suite_list),
+             'cycles': [date_i.strftime(CYCLE_FMT) for date_i in date_range],
+             'flags': list(flag_list),
+             'regions': list(region_list),
+             'obs': list(obs_list),
+             'meta_keys': META_KEYS}
+
+    shape = (len(suite_list), len(date_range), len(flag_list), len(region_list), len(obs_list))
+    cube = np.lib.format.open_memmap(cube_dir + '/' + CUBE_FILENAME + '.tmp', mode='w+', dtype=np.float64,
+                                     shape=shape)
+    meta_cube = np.lib.format.open_memmap(cube_dir + '/' + META_FILENAME + '.tmp', mode='w+', dtype=np.float64,
+                                          shape=(len(suite_list), len(date_range), len(META_KEYS)))
+    cube[:] = np.nan
+    meta_cube[:] = np.nan
+
+    manifest = {'missing': [], 'corrupt': [], 'stamps': {}}
+
+    tasks = [(s, c, cycle_stats_filepath(data_dir, suite_id, date_i), index)
+             for c, date_i in enumerate(date_range)
+             for s, suite_id in enumerate(suite_list)]
+
+    pack_cycle_entries(tasks, cube, meta_cube, index, manifest, num_workers=num_workers)
+
+    cube.flush()
+    meta_cube.flush()
+    del cube, meta_cube
+
+    print('packed ' + str(len(tasks)) + ' cycle files: ' + str(len(manifest['missing'])) + ' missing, ' +
+          str(len(manifest['corrupt'])) + ' corrupt (see ' + cube_dir + '/' + MANIFEST_FILENAME + ')')
+
+    for filename in [CUBE_FILENAME, META_FILENAME]:
+        os.rename(cube_dir + '/' + filename + '.tmp', cube_dir + '/' + filename)
+    save_manifest(cube_dir, manifest)
+    with open(cube_dir + '/' + INDEX_FILENAME, 'w') as f:
+        json.dump(index, f)
+
+    return load_trial_cube(cube_dir)
+
+
+def load_manifest(cube_dir):
+    """
+    Load the manifest of missing and corrupt cycle files, made when the trial cube was built.
+    :param cube_dir: directory the cube was saved in
+    :return: manifest: (dict) 'missing' and 'corrupt' lists of {'suite', 'cycle', 'filepath'(, 'error')} entries, and
+        'stamps': stamps[filepath] = [mtime, size] of each file when it was read (see file_stamp())
+    """
+
+    with open(cube_dir + '/' + MANIFEST_FILENAME, 'r') as f:
+        manifest = json.load(f)
+
+    return manifest
+
+
+def load_trial_cube(cube_dir):
+    """
+    Memory-map a trial cube made by build_trial_cube()
+    :param cube_dir: directory the cube was saved in
+    :return: cube: (read only memmap) [suite, cycle, flag, region, obs]
+             meta_cube: (read only memmap) [suite, cycle, meta key]
+             index: (dict) axis labels: 'suites', 'cycles', 'flags', 'regions', 'obs' and 'meta_keys'
+    """
+
+    with open(cube_dir + '/' + INDEX_FILENAME, 'r') as f:
+        index = json.load(f)
+    # json gives back unicode strings
+    index = {str(key): [str(i) for i in value] for key, value in index.iteritems()}
+
+    cube = np.load(cube_dir + '/' + CUBE_FILENAME, mmap_mode='r')
+    meta_cube = np.load(cube_dir + '/' + META_FILENAME, mmap_mode='r')
+
+    return cube, meta_cube, index
+
+
+def update_trial_cube(cube_dir, data_dir, index, num_workers=8):
+    """
+    Bring a saved trial cube up to date with its cycle files, in place: files that have changed since they were read
+    into it, or have been deleted, or have appeared, are read again. The files listed as missing or corrupt in the
+    manifest are checked again every time, so a file fixed since is picked up even if its stamp is the same (e.g.
+    restored from a backup with its old modification time).
+
+    The cube entries are written before the manifest, so if this is interrupted the same files are read again next
+    time.
+    :param cube_dir: directory the cube was saved in
+    :param data_dir: directory with a subdirectory of cycle statistics for each suite
+    :param index: (dict) axis labels of the cube, from load_trial_cube()
+    :keyword num_workers: (int) number of processes reading the cycle files
+    :return: number of cycle files read again (including the corrupt files checked again), or None if the cube has no file stamps (made before they were kept)
+        and must be rebuilt
+    """
+
+    manifest = load_manifest(cube_dir)
+    if 'stamps' not in manifest:
+        return None
+    missing = set([entry['filepath'] for entry in manifest['missing']])
+    corrupt = set([entry['filepath'] for entry in manifest['corrupt']])
+
+    tasks = []
+    for c, cycle_str in enumerate(index['cycles']):
+        date_i = dt.datetime.strptime(cycle_str, CYCLE_FMT)
+        for s, suite_id in enumerate(index['suites']):
+            filepath = cycle_stats_filepath(data_dir, suite_id, date_i)
+            stamp = file_stamp(filepath)
+            if filepath in corrupt:
+                changed = True
+            elif filepath in manifest['stamps']:
+                changed = stamp != manifest['stamps'][filepath]
+            elif filepath in missing:
+                changed = stamp is not None
+            else:
+                # not read into this cube (e.g. data_dir has moved)
+                changed = True
+            if changed:
+                tasks += [(s, c, filepath, index)]
+
+    if len(tasks) == 0:
+        return 0
+
+    # forget what is known of the files to read again
+    reread = set([filepath for _, _, filepath, _ in tasks])
+    for status in ['missing', 'corrupt']:
+        manifest[status] = [entry for entry in manifest[status] if entry['filepath'] not in reread]
+    for filepath in reread:
+        manifest['stamps'].pop(filepath, None)
+
+    cube = np.load(cube_dir + '/' + CUBE_FILENAME, mmap_mode='r+')
+    meta_cube = np.load(cube_dir + '/' + META_FILENAME, mmap_mode='r+')
+    pack_cycle_entries(tasks, cube, meta_cube, index, manifest, num_workers=num_workers)
+    cube.flush()
+    meta_cube.flush()
+    del cube, meta_cube
+
+    save_manifest(cube_dir, manifest)
+
+    return len(tasks)
+
+
+def get_trial_cube(cube_dir, data_dir, suite_list, date_range, flag_list, region_list, obs_list, rebuild=False,
+                   num_workers=8):
+    """
+    Load the trial cube if one already exists for exactly these suites, cycles, flags, regions and obs, after reading
+    again the cycle files that have changed or appeared since (see update_trial_cube()); otherwise (or if rebuild is
+    set) build it from the cycle statistics files first.
+    :return: cube, meta_cube, index (see load_trial_cube())
+    """
+
+    if not rebuild and os.path.exists(cube_dir + '/' + INDEX_FILENAME):
+        cube, meta_cube, index = load_trial_cube(cube_dir)
+        wanted = {'suites': list(suite_list),
+                  'cycles': [date_i.strftime(CYCLE_FMT) for date_i in date_range],
+                  'flags': list(flag_list),
+                  'regions': list(region_list),
+                  'obs': list(obs_list),
+                  'meta_keys': META_KEYS}
+        if index == wanted:
+            del cube, meta_cube
+            n_updated = update_trial_cube(cube_dir, data_dir, index, num_workers=num_workers)
+            if n_updated is not None:
+                print('loaded trial cube: ' + cube_dir + ' (' + str(n_updated) + ' changed cycle files read again)')
+                return load_trial_cube(cube_dir)
+            print('trial cube in ' + cube_dir + ' has no cycle file stamps. Rebuilding')
+        else:
+            print('trial cube in ' + cube_dir + ' does not match the suites, cycles, flags, regions or obs. '
+                  'Rebuilding')
+
+    return build_trial_cube(cube_dir, data_dir, suite_list, date_range, flag_list, region_list, obs_list,
+                            num_workers=num_workers)
+
+
+def cube_to_suite_data(cube, meta_cube, index):
+    """
+    Unpack the cube into the nested dictionaries used by odb2_stat_processing.py. The arrays are views of the cube,
+    so nothing is copied.
+    :return: suite_data: suite => flag => region => obs => (array over cycles)
+             suite_meta: suite => meta key => (array over cycles)
+    """
+
+    suite_data = {suite_id: {
+                     flag_i: {
+                         region_i: {
+                            obs_i: cube[s, :, f, r, o] for o, obs_i in enumerate(index['obs'])}
+                         for r, region_i in enumerate(index['regions'])}
+                     for f, flag_i in enumerate(index['flags'])}
+                  for s, suite_id in enumerate(index['suites'])}
+
+    suite_meta = {suite_id: {key: meta_cube[s, :, k] for k, key in enumerate(index['meta_keys'])}
+                  for s, suite_id in enumerate(index['suites'])}
+
+    return suite_data, suite_meta